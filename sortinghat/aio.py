@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#         Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import itertools
+import threading
+import weakref
+
+from . import api
+from .db.database import POOL_SIZE
+
+
+_executors = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def executor(db):
+    """Get the pool of threads that runs the calls on a database.
+
+    The pool is created the first time it is requested. Its size
+    matches the size of the connection pool of the engines, so calls
+    do not wait for a free connection once they are running.
+
+    :param db: database manager
+
+    :returns: a `ThreadPoolExecutor` object
+    """
+    with _lock:
+        pool = _executors.get(db, None)
+
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=POOL_SIZE)
+            _executors[db] = pool
+
+    return pool
+
+
+def shutdown(db, wait=True):
+    """Shut down the pool of threads of a database.
+
+    :param db: database manager
+    :param wait: wait until the pending calls are finished
+    """
+    with _lock:
+        pool = _executors.pop(db, None)
+
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+async def run(db, func, *args, **kwargs):
+    """Run a function of the API without blocking the event loop.
+
+    The function runs on the pool of threads of the database, so
+    calls made at the same time run concurrently, up to the size
+    of the connection pool of the engine.
+
+    :param db: database manager
+    :param func: function to run; `db` is given as its first parameter
+    :param args: positional parameters of the function
+    :param kwargs: keyword parameters of the function
+
+    :returns: the result of the function
+    """
+    loop = asyncio.get_event_loop()
+    call = functools.partial(func, db, *args, **kwargs)
+
+    return await loop.run_in_executor(executor(db), call)
+
+
+def _coroutine(func):
+    @functools.wraps(func)
+    async def wrapper(db, *args, **kwargs):
+        return await run(db, func, *args, **kwargs)
+
+    return wrapper
+
+
+class _AsyncIterator:
+    """Iterate over a blocking iterator without blocking the event loop.
+
+    Items are fetched in batches of `batch_size` elements, so the
+    pool of threads is only used once for each batch. Concurrent
+    calls to `__anext__` wait for each other, since the underlying
+    iterator cannot be advanced by two threads at the same time.
+    """
+
+    def __init__(self, db, iterator, batch_size=1000):
+        self._db = db
+        self._iterator = iterator
+        # Invalid sizes are reported by the underlying iterator
+        self._batch_size = max(batch_size, 1)
+        self._batch = collections.deque()
+        self._exhausted = False
+        self._lock = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        # The lock is created here to bind it to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if not self._batch and not self._exhausted:
+                batch = await run(self._db, self.__fetch_batch)
+                self._exhausted = len(batch) < self._batch_size
+                self._batch.extend(batch)
+
+            if not self._batch:
+                raise StopAsyncIteration
+
+            return self._batch.popleft()
+
+    def __fetch_batch(self, _):
+        return list(itertools.islice(self._iterator, self._batch_size))
+
+
+def iter_unique_identities(db, source=None, chunk_size=1000):
+    """Iterate over the unique identities of the registry.
+
+    Asynchronous version of `sortinghat.api.iter_unique_identities`.
+    Each chunk is retrieved without blocking the event loop. The
+    iterator can be shared by several tasks; each unique identity
+    is returned only once.
+
+    :param db: database manager
+    :param source: only return unique identities with identities
+        from this source
+    :param chunk_size: number of unique identities retrieved on
+        each query
+
+    :returns: an asynchronous iterator of unique identities
+
+    :raises InvalidValueError: when 'chunk_size' is lower than 1
+    """
+    chunks = api.iter_unique_identities(db, source=source,
+                                        chunk_size=chunk_size)
+
+    return _AsyncIterator(db, chunks, batch_size=chunk_size)
+
+
+add_unique_identity = _coroutine(api.add_unique_identity)
+add_identity = _coroutine(api.add_identity)
+add_organization = _coroutine(api.add_organization)
+add_domain = _coroutine(api.add_domain)
+add_enrollment = _coroutine(api.add_enrollment)
+add_to_matching_blacklist = _coroutine(api.add_to_matching_blacklist)
+edit_profile = _coroutine(api.edit_profile)
+delete_unique_identity = _coroutine(api.delete_unique_identity)
+delete_identity = _coroutine(api.delete_identity)
+delete_organization = _coroutine(api.delete_organization)
+delete_domain = _coroutine(api.delete_domain)
+delete_enrollment = _coroutine(api.delete_enrollment)
+delete_from_matching_blacklist = _coroutine(api.delete_from_matching_blacklist)
+merge_unique_identities = _coroutine(api.merge_unique_identities)
+merge_enrollments = _coroutine(api.merge_enrollments)
+merge_all_enrollments = _coroutine(api.merge_all_enrollments)
+move_identity = _coroutine(api.move_identity)
+match_identities = _coroutine(api.match_identities)
+match_unique_identities = _coroutine(api.match_unique_identities)
+unique_identities = _coroutine(api.unique_identities)
+search_unique_identities = _coroutine(api.search_unique_identities)
+search_unique_identities_slice = _coroutine(api.search_unique_identities_slice)
+search_unique_identities_page = _coroutine(api.search_unique_identities_page)
+search_last_modified_identities = _coroutine(api.search_last_modified_identities)
+search_last_modified_unique_identities = _coroutine(api.search_last_modified_unique_identities)
+search_profiles = _coroutine(api.search_profiles)
+registry = _coroutine(api.registry)
+domains = _coroutine(api.domains)
+countries = _coroutine(api.countries)
+enrollments = _coroutine(api.enrollments)
+enrollments_by_uuid = _coroutine(api.enrollments_by_uuid)
+blacklist = _coroutine(api.blacklist)
+changes = _coroutine(api.changes)
+affiliation_at = _coroutine(api.affiliation_at)
+affiliations_at = _coroutine(api.affiliations_at)
@@ -19,8 +19,15 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import base64
+import datetime
+import itertools
+import json
 import logging
 
+from sqlalchemy import func
+from sqlalchemy.orm import contains_eager, joinedload, selectinload
+
 from . import utils
 from .db.api import (add_unique_identity as add_unique_identity_db,
                      add_identity as add_identity_db,
@@ -41,15 +48,27 @@ from .db.api import (add_unique_identity as add_unique_identity_db,
                      find_unique_identity,
                      find_identity,
                      find_organization,
-                     find_domain)
+                     find_domain,
+                     log_changes,
+                     ENROLLMENT_ENTITY)
+from .db.cache import READ_ONLY_SESSION_KEY, affiliations_cache, \
+    get_affiliations, put_affiliations, top_domains_trie
 from .db.model import MIN_PERIOD_DATE, MAX_PERIOD_DATE, \
-    UniqueIdentity, Identity, Profile, Organization, Domain, Country, Enrollment, \
-    MatchingBlacklist
-from .exceptions import AlreadyExistsError, NotFoundError, InvalidValueError
+    UniqueIdentity, Identity, IdentityTrigram, Profile, Organization, Domain, \
+    Country, Enrollment, MatchingBlacklist, Change
+from .exceptions import AlreadyExistsError, NotFoundError, InvalidValueError, \
+    MatcherNotSupportedError
 
 
 logger = logging.getLogger(__name__)
 
+# Loading strategies for the relationships of the entities returned
+# by this API. Objects are detached from their sessions before they are
+# returned, so everything the callers need must be loaded beforehand.
+UIDENTITY_LOAD_OPTIONS = (selectinload(UniqueIdentity.identities),
+                          joinedload(UniqueIdentity.profile).
+                          joinedload(Profile.country))
+
 
 def add_unique_identity(db, uuid):
     """Add a unique identity to the registry.
@@ -616,17 +635,8 @@ def merge_unique_identities(db, from_uuid, to_uuid):
 
         delete_unique_identity_db(session, fuid)
 
-        # Retrieve of organizations to merge the enrollments,
-        # before closing the session
-        query = session.query(Organization.name).\
-            join(Enrollment).\
-            filter(Enrollment.uidentity == tuid).distinct()
-
-        orgs = [org.name for org in query]
-
-    # Merge enrollments
-    for org in orgs:
-        merge_enrollments(db, to_uuid, org)
+        # Merge enrollments
+        _merge_all_enrollments(session, tuid)
 
 
 def merge_enrollments(db, uuid, organization):
@@ -703,6 +713,93 @@ def merge_enrollments(db, uuid, organization):
             delete_enrollment_db(session, enr)
 
 
+def merge_all_enrollments(db, uuid):
+    """Merge overlapping enrollments of a unique identity.
+
+    This function merges, organization by organization, those enrollments
+    of the given 'uuid' that have overlapping dates. Ranges are merged
+    following the same rules described in `merge_enrollments()`.
+
+    Unlike calling `merge_enrollments()` once per organization, enrollments
+    are loaded only once and the changes are applied within a single
+    transaction using bulk deletions and insertions.
+
+    :param db: database manager
+    :param uuid: unique identifier
+
+    :raises NotFoundError: when 'uuid' is not found in the registry
+    :raises InvalidValueError: when any date is out of bounds
+    """
+    with db.connect() as session:
+        uidentity = find_unique_identity(session, uuid)
+
+        if not uidentity:
+            raise NotFoundError(entity=uuid)
+
+        _merge_all_enrollments(session, uidentity)
+
+
+def _merge_all_enrollments(session, uidentity):
+    """Merge the enrollments of a unique identity within a session"""
+
+    session.flush()
+
+    rows = session.query(Enrollment.id, Enrollment.organization_id,
+                         Enrollment.start, Enrollment.end).\
+        filter(Enrollment.uuid == uidentity.uuid).all()
+
+    periods = {}
+
+    for row in rows:
+        periods.setdefault(row.organization_id, []).append(row)
+
+    to_delete = []
+    to_insert = []
+
+    for org_id, enrollments in periods.items():
+        dates = [(enr.start, enr.end) for enr in enrollments]
+
+        try:
+            merged = set(utils.merge_date_ranges(dates))
+        except ValueError as e:
+            raise InvalidValueError(e)
+
+        # Keep those enrollments that match with a merged
+        # range and add the ranges that are not stored yet
+        stored = set(dates)
+
+        to_delete.extend(enr.id for enr in enrollments
+                         if (enr.start, enr.end) not in merged)
+        to_insert.extend({'uuid': uidentity.uuid,
+                          'organization_id': org_id,
+                          'start': st, 'end': en}
+                         for st, en in sorted(merged - stored))
+
+    if not to_delete and not to_insert:
+        return
+
+    if to_delete:
+        session.query(Enrollment).\
+            filter(Enrollment.id.in_(to_delete)).\
+            delete(synchronize_session=False)
+        log_changes(session, ENROLLMENT_ENTITY, Change.DELETE,
+                    [(eid, uidentity.uuid) for eid in to_delete])
+
+    if to_insert:
+        session.execute(Enrollment.__table__.insert(), to_insert)
+
+        stored_ids = {row.id for row in rows}
+        new_ids = session.query(Enrollment.id).\
+            filter(Enrollment.uuid == uidentity.uuid,
+                   Enrollment.id.notin_(stored_ids)).all()
+        log_changes(session, ENROLLMENT_ENTITY, Change.ADD,
+                    [(row.id, uidentity.uuid) for row in new_ids])
+
+    # Enrollments loaded in the session are no longer valid
+    session.expire(uidentity, ['enrollments'])
+    uidentity.last_modified = datetime.datetime.utcnow()
+
+
 def move_identity(db, from_id, to_uuid):
     """Move an identity to a unique identity.
 
@@ -772,6 +869,7 @@ def match_identities(db, uuid, matcher):
 
         # Get all identities expect of the one requested one query above (uid)
         candidates = session.query(UniqueIdentity).\
+            options(*UIDENTITY_LOAD_OPTIONS).\
             filter(UniqueIdentity.uuid != uuid).\
             order_by(UniqueIdentity.uuid)
 
@@ -786,6 +884,105 @@ def match_identities(db, uuid, matcher):
     return uidentities
 
 
+def match_unique_identities(db, uuids, matcher, chunk_size=1000):
+    """Search for the unique identities similar to a set of them.
+
+    Instead of comparing each unique identity in `uuids` with the
+    rest of the registry, like `match_identities()` does, this
+    function builds an index with the values of the keys returned
+    by `matcher.matching_criteria()` for the identities in `uuids`.
+    Then, the identities of the registry are read once and looked
+    up on that index. Two unique identities match when any of their
+    filtered identities share the value of any of those keys.
+
+    The result is a dictionary indexed by the identifiers given in
+    `uuids`. Each entry stores the sorted list of uuids matching with
+    that unique identity; this list will not include the unique
+    identity itself. Unique identities not found in the registry are
+    not included in the result.
+
+    :param db: database manager
+    :param uuids: list of unique identifiers to match
+    :param matcher: criteria used to match identities
+    :param chunk_size: maximum number of identifiers filtered
+        on each query
+
+    :returns: a dictionary of matched uuids lists indexed by uuid
+
+    :raises MatcherNotSupportedError: when `matcher` does not
+        implement `matching_criteria()`
+    :raises InvalidValueError: when 'chunk_size' is lower than 1
+    """
+    if chunk_size < 1:
+        raise InvalidValueError("'chunk_size' must be greater than 0")
+
+    try:
+        criteria = matcher.matching_criteria()
+    except NotImplementedError:
+        name = "'%s (fast mode)'" % matcher.__class__.__name__.lower()
+        raise MatcherNotSupportedError(matcher=name)
+
+    def filtered_keys(uidentity):
+        for fid in matcher.filter(uidentity):
+            for key in criteria:
+                value = getattr(fid, key, None)
+
+                if value:
+                    yield key, value
+
+    columns = (Identity.id, Identity.name, Identity.email,
+               Identity.username, Identity.source, Identity.uuid)
+
+    uuids = list(dict.fromkeys(uuids))
+    matches = {}
+    index = {}
+
+    with db.connect() as session:
+        for i in range(0, len(uuids), chunk_size):
+            chunk = uuids[i:i + chunk_size]
+
+            query = session.query(UniqueIdentity.uuid).\
+                filter(UniqueIdentity.uuid.in_(chunk))
+            matches.update((row.uuid, set()) for row in query)
+
+            query = session.query(*columns).\
+                filter(Identity.uuid.in_(chunk)).\
+                order_by(Identity.uuid)
+
+            for uidentity in _build_unique_identities(query):
+                for key in filtered_keys(uidentity):
+                    index.setdefault(key, set()).add(uidentity.uuid)
+
+        if index:
+            query = session.query(*columns).\
+                order_by(Identity.uuid).\
+                yield_per(chunk_size)
+
+            for uidentity in _build_unique_identities(query):
+                for key in filtered_keys(uidentity):
+                    for uuid in index.get(key, ()):
+                        if uuid != uidentity.uuid:
+                            matches[uuid].add(uidentity.uuid)
+
+    return {uuid: sorted(matched) for uuid, matched in matches.items()}
+
+
+def _build_unique_identities(rows):
+    """Group identities rows sorted by uuid into unique identities.
+
+    The objects created are not attached to any session; they only
+    store the data needed by the matchers.
+    """
+    for uuid, group in itertools.groupby(rows, key=lambda row: row.uuid):
+        uidentity = UniqueIdentity(uuid=uuid)
+        uidentity.identities = [Identity(id=row.id, name=row.name,
+                                         email=row.email, username=row.username,
+                                         source=row.source, uuid=row.uuid)
+                                for row in group]
+
+        yield uidentity
+
+
 def unique_identities(db, uuid=None, source=None):
     """List the unique identities available in the registry.
 
@@ -807,13 +1004,14 @@ def unique_identities(db, uuid=None, source=None):
     """
     uidentities = []
 
-    with db.connect() as session:
-        query = session.query(UniqueIdentity)
+    with db.connect(read_only=True) as session:
+        query = session.query(UniqueIdentity).\
+            options(*UIDENTITY_LOAD_OPTIONS)
 
         if source:
-            query = query.join(Identity).\
-                filter(UniqueIdentity.uuid == Identity.uuid,
-                       Identity.source == source)
+            uuids = session.query(Identity.uuid).\
+                filter(Identity.source == source)
+            query = query.filter(UniqueIdentity.uuid.in_(uuids.subquery()))
 
         if uuid:
             uidentity = query.\
@@ -833,6 +1031,61 @@ def unique_identities(db, uuid=None, source=None):
     return uidentities
 
 
+def iter_unique_identities(db, source=None, chunk_size=1000):
+    """Iterate over the unique identities available in the registry.
+
+    Generator that returns the unique identities of the registry sorted
+    by their uuid. When `source` is given, only those unique identities
+    with one or more identities related to that source will be returned.
+
+    Unique identities are retrieved in chunks of `chunk_size` elements.
+    Each chunk is read in its own session, selecting the unique identities
+    with a uuid greater than the last one returned. Thus, the memory
+    used does not depend on the size of the registry and the first
+    unique identities are available as soon as the first chunk is read.
+
+    :param db: database manager
+    :param source: source of the identities
+    :param chunk_size: number of unique identities read on each query
+
+    :returns: a generator of unique identities
+
+    :raises InvalidValueError: raised when `chunk_size` is lower than one
+    """
+    if chunk_size < 1:
+        raise InvalidValueError('chunk_size must be greater than 0 - %s given'
+                                % str(chunk_size))
+
+    after = None
+
+    while True:
+        with db.connect(read_only=True) as session:
+            query = session.query(UniqueIdentity).\
+                options(*UIDENTITY_LOAD_OPTIONS)
+
+            if source:
+                uuids = session.query(Identity.uuid).\
+                    filter(Identity.source == source)
+                query = query.filter(UniqueIdentity.uuid.in_(uuids.subquery()))
+
+            if after:
+                query = query.filter(UniqueIdentity.uuid > after)
+
+            uidentities = query.order_by(UniqueIdentity.uuid).\
+                limit(chunk_size).all()
+
+            # Detach objects from the session
+            session.expunge_all()
+
+        for uidentity in uidentities:
+            yield uidentity
+
+        if len(uidentities) < chunk_size:
+            break
+
+        after = uidentities[-1].uuid
+
+
 def search_unique_identities(db, term, source=None):
     """Look for unique identities.
 
@@ -849,28 +1102,25 @@ def search_unique_identities(db, term, source=None):
         any unique identity from the registry
     """
     uidentities = []
-    pattern = '%' + term + '%' if term else None
 
-    with db.connect() as session:
-        query = session.query(UniqueIdentity).\
-            join(Identity).\
-            filter(UniqueIdentity.uuid == Identity.uuid)
+    with db.connect(read_only=True) as session:
+        uuids = session.query(Identity.uuid)
 
         if source:
-            query = query.filter(Identity.source == source)
+            uuids = uuids.filter(Identity.source == source)
 
-        if pattern:
-            query = query.filter(Identity.name.like(pattern)
-                                 | Identity.email.like(pattern)
-                                 | Identity.username.like(pattern)
-                                 | Identity.source.like(pattern))
+        if term:
+            uuids = _filter_by_term(session, uuids, term)
         else:
-            query = query.filter((Identity.name == None)
+            uuids = uuids.filter((Identity.name == None)
                                  | (Identity.email == None)
                                  | (Identity.username == None)
                                  | (Identity.source == None))
 
-        uidentities = query.order_by(UniqueIdentity.uuid).all()
+        uidentities = session.query(UniqueIdentity).\
+            options(*UIDENTITY_LOAD_OPTIONS).\
+            filter(UniqueIdentity.uuid.in_(uuids.subquery())).\
+            order_by(UniqueIdentity.uuid).all()
 
         if not uidentities:
             raise NotFoundError(entity=term)
@@ -902,7 +1152,6 @@ def search_unique_identities_slice(db, term, offset, limit):
         `offset` or `limit` is lower than zero
     """
     uidentities = []
-    pattern = '%' + term + '%' if term else None
 
     if offset < 0:
         raise InvalidValueError('offset must be greater than 0 - %s given'
@@ -911,22 +1160,20 @@ def search_unique_identities_slice(db, term, offset, limit):
         raise InvalidValueError('limit must be greater than 0 - %s given'
                                 % str(limit))
 
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
         query = session.query(UniqueIdentity).\
+            options(*UIDENTITY_LOAD_OPTIONS).\
             join(Identity).\
             filter(UniqueIdentity.uuid == Identity.uuid)
 
-        if pattern:
-            query = query.filter(Identity.name.like(pattern)
-                                 | Identity.email.like(pattern)
-                                 | Identity.username.like(pattern)
-                                 | Identity.source.like(pattern))
+        if term:
+            query = _filter_by_term(session, query, term)
 
         query = query.group_by(UniqueIdentity).\
             order_by(UniqueIdentity.uuid)
 
         # Get the total number of unique identities for that search
-        nuids = query.count()
+        nuids = _count_unique_identities(session, term)
 
         start = offset
         end = offset + limit
@@ -939,6 +1186,85 @@ def search_unique_identities_slice(db, term, offset, limit):
     return uidentities, nuids
 
 
+def search_unique_identities_page(db, term, limit, token=None, count=False):
+    """Look for unique identities using keyset pagination.
+
+    This function returns those unique identities which match with the
+    given `term`, sorted by their uuid. The term will be compared with
+    name, email, username and source values of each identity. When an
+    empty term is given, all unique identities will be returned.
+
+    Unlike `search_unique_identities_slice`, pages are not selected by
+    an offset. Each call returns, at most, `limit` unique identities and
+    an opaque `token` to request the next page. This token must be
+    passed, together with the same `term`, to the next call. The cost
+    of retrieving a page does not depend on its position.
+
+    When `count` is set, the total number of unique identities that
+    match the given `term` is also returned. This number is calculated
+    only once, when the first page is requested, and it is carried by
+    the token from then on.
+
+    :param db: database manager
+    :param term: term to match with unique identities data
+    :param limit: maximum number of unique identities to return
+    :param token: token returned by the previous call; `None` to get
+        the first page
+    :param count: calculate the total number of unique identities
+
+    :returns: a tuple with the list of unique identities, the token
+        of the next page (`None` when there are not more pages) and
+        the total number of unique identities (`None` when `count`
+        is not set)
+
+    :raises InvalidValueError: raised when `limit` is lower than one
+        or when the given `token` is not valid
+    """
+    if limit < 1:
+        raise InvalidValueError('limit must be greater than 0 - %s given'
+                                % str(limit))
+
+    after, nuids = _decode_page_token(token) if token else (None, None)
+
+    with db.connect(read_only=True) as session:
+        if count and nuids is None:
+            nuids = _count_unique_identities(session, term)
+
+        query = session.query(Identity.uuid).\
+            filter(Identity.uuid != None)
+
+        if term:
+            query = _filter_by_term(session, query, term)
+        if after:
+            query = query.filter(Identity.uuid > after)
+
+        # Fetch one more row to know whether there is a next page
+        uuids = [uid.uuid for uid in query.distinct().
+                 order_by(Identity.uuid).limit(limit + 1)]
+
+        next_token = None
+
+        if len(uuids) > limit:
+            uuids = uuids[:limit]
+            next_token = _encode_page_token(uuids[-1], nuids)
+
+        if uuids:
+            uidentities = session.query(UniqueIdentity).\
+                options(*UIDENTITY_LOAD_OPTIONS).\
+                filter(UniqueIdentity.uuid.in_(uuids)).\
+                order_by(UniqueIdentity.uuid).all()
+        else:
+            uidentities = []
+
+        # Detach objects from the session
+        session.expunge_all()
+
+    if not count:
+        nuids = None
+
+    return uidentities, next_token, nuids
+
+
 def search_last_modified_identities(db, after):
     """Look for the uuids of identities modified on or after a given date.
 
@@ -951,7 +1277,7 @@ def search_last_modified_identities(db, after):
 
     :returns: a list of uuids of identities modified
     """
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
         query = session.query(Identity.id).\
             filter(Identity.last_modified >= after)
         ids = [id_.id for id_ in query.order_by(Identity.id).all()]
@@ -972,7 +1298,7 @@ def search_last_modified_unique_identities(db, after):
 
     :returns: a list of uuids of unique identities modified
     """
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
         query = session.query(UniqueIdentity.uuid).\
             filter(UniqueIdentity.last_modified >= after)
         uids = [uid.uuid for uid in query.order_by(UniqueIdentity.uuid).all()]
@@ -980,6 +1306,48 @@ def search_last_modified_unique_identities(db, after):
     return uids
 
 
+def changes(db, after_seq=0, limit=1000):
+    """List the changes made on the registry.
+
+    This function returns, in order, the changes logged after the
+    sequence number `after_seq`. At most `limit` changes are returned,
+    so callers can follow the log calling this function again with the
+    sequence number of the last change they received.
+
+    Sequence numbers are assigned when the transactions that logged
+    the changes commit, in the same order they are committed. Thus,
+    changes committed later will always have greater numbers than
+    those already returned, and callers following the log will not
+    miss any of them.
+
+    Changes are read from the primary database; replicas might not
+    have received the latest entries yet.
+
+    :param db: database manager
+    :param after_seq: return changes with a sequence number
+        greater than this one
+    :param limit: maximum number of changes to return
+
+    :returns: a list of changes sorted by sequence number
+
+    :raises InvalidValueError: when `limit` is lower than 1
+    """
+    if limit < 1:
+        raise InvalidValueError("'limit' must be greater than 0; %s given"
+                                % str(limit))
+
+    with db.connect() as session:
+        entries = session.query(Change).\
+            filter(Change.seq > after_seq).\
+            order_by(Change.seq).\
+            limit(limit).all()
+
+        # Detach objects from the session
+        session.expunge_all()
+
+    return entries
+
+
 def search_profiles(db, no_gender=False):
     """List unique identities profiles.
 
@@ -994,8 +1362,9 @@ def search_profiles(db, no_gender=False):
     """
     profiles = []
 
-    with db.connect() as session:
-        query = session.query(Profile)
+    with db.connect(read_only=True) as session:
+        query = session.query(Profile).\
+            options(joinedload(Profile.country))
 
         if no_gender:
             query = query.filter(Profile.gender == None)
@@ -1027,16 +1396,19 @@ def registry(db, term=None):
     """
     orgs = []
 
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
+        query = session.query(Organization).\
+            options(selectinload(Organization.domains))
+
         if term:
-            orgs = session.query(Organization).\
+            orgs = query.\
                 filter(Organization.name.like('%' + term + '%')).\
                 order_by(Organization.name).all()
 
             if not orgs:
                 raise NotFoundError(entity=term)
         else:
-            orgs = session.query(Organization).\
+            orgs = query.\
                 order_by(Organization.name).all()
 
         # Detach objects from the session
@@ -1068,34 +1440,31 @@ def domains(db, domain=None, top=False):
     """
     doms = []
 
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
+        query = session.query(Domain).\
+            options(joinedload(Domain.organization))
+
         if domain:
-            dom = find_domain(session, domain)
+            dom = query.filter(Domain.domain == domain).first()
 
             if not dom:
                 if not top:
                     raise NotFoundError(entity=domain)
                 else:
-                    # Adds a dot to the beggining of the domain.
-                    # Useful to compare domains like example.com and
-                    # myexample.com
-                    add_dot = lambda d: '.' + d if not d.startswith('.') else d
+                    # Top domains are matched by labels, so domains
+                    # like example.com and myexample.com are different
+                    tops = top_domains_trie(session).matches(domain)
 
-                    d = add_dot(domain)
-
-                    tops = session.query(Domain).\
-                        filter(Domain.is_top_domain).order_by(Domain.domain).all()
-
-                    doms = [t for t in tops
-                            if d.endswith(add_dot(t.domain))]
+                    if tops:
+                        doms = query.\
+                            filter(Domain.domain.in_(tops)).\
+                            order_by(Domain.domain).all()
 
                     if not doms:
                         raise NotFoundError(entity=domain)
             else:
                 doms = [dom]
         else:
-            query = session.query(Domain)
-
             if top:
                 query = query.filter(Domain.is_top_domain)
 
@@ -1145,7 +1514,7 @@ def countries(db, code=None, term=None):
 
     cs = []
 
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
         query = session.query(Country)
 
         if code or term:
@@ -1217,9 +1586,11 @@ def enrollments(db, uuid=None, organization=None, from_date=None, to_date=None):
 
     enrollments = []
 
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
         query = session.query(Enrollment).\
             join(UniqueIdentity, Organization).\
+            options(contains_eager(Enrollment.uidentity),
+                    contains_eager(Enrollment.organization)).\
             filter(Enrollment.start >= from_date,
                    Enrollment.end <= to_date)
 
@@ -1253,6 +1624,201 @@ def enrollments(db, uuid=None, organization=None, from_date=None, to_date=None):
     return enrollments
 
 
+def enrollments_by_uuid(db, uuids, chunk_size=1000):
+    """List the enrollments of a set of unique identities.
+
+    This function returns a dictionary indexed by the identifiers
+    given in 'uuids'. Each entry stores the list of enrollments of
+    that unique identity, sorted by organization and period. Unique
+    identities without enrollments or not found in the registry will
+    get an empty list.
+
+    Enrollments are retrieved with a single query for every
+    'chunk_size' identifiers, so this function should be preferred
+    over calling `enrollments()` once per unique identity.
+
+    :param db: database manager
+    :param uuids: list of unique identifiers
+    :param chunk_size: maximum number of identifiers filtered
+        on each query
+
+    :returns: a dictionary of enrollments lists indexed by uuid
+
+    :raises InvalidValueError: when 'chunk_size' is lower than 1
+    """
+    if chunk_size < 1:
+        raise InvalidValueError("'chunk_size' must be greater than 0")
+
+    uuids = list(dict.fromkeys(uuids))
+    result = {uuid: [] for uuid in uuids}
+
+    with db.connect(read_only=True) as session:
+        for i in range(0, len(uuids), chunk_size):
+            chunk = uuids[i:i + chunk_size]
+
+            query = session.query(Enrollment).\
+                join(UniqueIdentity, Organization).\
+                options(contains_eager(Enrollment.uidentity),
+                        contains_eager(Enrollment.organization)).\
+                filter(Enrollment.uuid.in_(chunk)).\
+                order_by(UniqueIdentity.uuid,
+                         Organization.name,
+                         Enrollment.start,
+                         Enrollment.end)
+
+            for enrollment in query:
+                result[enrollment.uuid].append(enrollment)
+
+        # Detach objects from the session
+        session.expunge_all()
+
+    return result
+
+
+def affiliation_at(db, uuid, date):
+    """Find the organization of a unique identity on a given date.
+
+    The function returns the name of the organization where the
+    unique identity was enrolled on `date`. When several enrollments
+    include that date, the one that started later is selected.
+    Timezone aware dates are converted to UTC; dates without time
+    are considered to be at midnight.
+
+    Use `affiliations_at()` to find the organizations of many
+    unique identities at once.
+
+    :param db: database manager
+    :param uuid: unique identifier
+    :param date: date to look for
+
+    :returns: the name of the organization; `None` when the unique
+        identity was not enrolled on that date
+
+    :raises NotFoundError: when the unique identity is not found
+        in the registry
+    :raises InvalidValueError: when `date` is not a date
+    """
+    date = _affiliation_date(date)
+    index = _affiliation_indexes(db, [uuid])[uuid]
+
+    if index is None:
+        raise NotFoundError(entity=uuid)
+
+    return index.find(date)
+
+
+def affiliations_at(db, pairs, chunk_size=1000):
+    """Find the organizations of several unique identities on given dates.
+
+    For each `(uuid, date)` tuple in `pairs`, this function finds the
+    organization where the unique identity was enrolled on that date,
+    following the same rules as `affiliation_at()`. The enrollments
+    of every unique identity are read only once, with a query for
+    every `chunk_size` identifiers.
+
+    When the cache of affiliations is enabled, the enrollment periods
+    of each unique identity are kept in memory, so next calls will
+    not query the database for them.
+
+    :param db: database manager
+    :param pairs: list of `(uuid, date)` tuples
+    :param chunk_size: maximum number of identifiers filtered
+        on each query
+
+    :returns: a list with the names of the organizations, in the
+        same order as `pairs`; `None` values are returned for those
+        unique identities not enrolled on the date or not found
+        in the registry
+
+    :raises InvalidValueError: when any date is not a date or when
+        'chunk_size' is lower than 1
+    """
+    if chunk_size < 1:
+        raise InvalidValueError("'chunk_size' must be greater than 0")
+
+    pairs = [(uuid, _affiliation_date(date)) for uuid, date in pairs]
+    indexes = _affiliation_indexes(db, [uuid for uuid, _ in pairs],
+                                   chunk_size=chunk_size)
+
+    result = []
+
+    for uuid, date in pairs:
+        index = indexes[uuid]
+        result.append(index.find(date) if index is not None else None)
+
+    return result
+
+
+def _affiliation_date(date):
+    """Convert a date to the naive UTC format of enrollments"""
+
+    if isinstance(date, datetime.datetime):
+        if date.tzinfo is not None:
+            date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return date
+    elif isinstance(date, datetime.date):
+        return datetime.datetime(date.year, date.month, date.day)
+    else:
+        raise InvalidValueError("'date' must be a date; %s given" % str(date))
+
+
+def _affiliation_indexes(db, uuids, chunk_size=1000):
+    """Get the indexes of enrollment periods of a set of unique identities.
+
+    Indexes are taken from the cache of affiliations when available.
+    The remaining ones are built from the registry. Unique identities
+    not found in the registry get a `None` value.
+    """
+    indexes = {}
+    missing = []
+
+    for uuid in dict.fromkeys(uuids):
+        cached = get_affiliations(uuid)
+
+        if cached is None:
+            missing.append(uuid)
+        else:
+            indexes[uuid] = cached[0]
+
+    if not missing:
+        return indexes
+
+    cache = affiliations_cache()
+    generation = cache.generation if cache is not None else None
+
+    with db.connect(read_only=True) as session:
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+
+            query = session.query(UniqueIdentity.uuid).\
+                filter(UniqueIdentity.uuid.in_(chunk))
+            periods = {row.uuid: [] for row in query}
+
+            query = session.query(Enrollment.uuid,
+                                  Enrollment.start,
+                                  Enrollment.end,
+                                  Organization.name).\
+                join(Organization).\
+                filter(Enrollment.uuid.in_(chunk)).\
+                order_by(Organization.name)
+
+            for row in query:
+                periods[row.uuid].append((row.start, row.end, row.name))
+
+            for uuid in chunk:
+                indexes[uuid] = utils.IntervalIndex(periods[uuid]) \
+                    if uuid in periods else None
+
+        # Values read from replicas might be outdated
+        cacheable = not session.info.get(READ_ONLY_SESSION_KEY, False)
+
+    if cache is not None and cacheable:
+        for uuid in missing:
+            put_affiliations(uuid, (indexes[uuid],), generation)
+
+    return indexes
+
+
 def blacklist(db, term=None):
     """List the blacklisted entities available in the registry.
 
@@ -1272,7 +1838,7 @@ def blacklist(db, term=None):
     """
     mbs = []
 
-    with db.connect() as session:
+    with db.connect(read_only=True) as session:
         if term:
             mbs = session.query(MatchingBlacklist).\
                 filter(MatchingBlacklist.excluded.like('%' + term + '%')).\
@@ -1288,3 +1854,68 @@ def blacklist(db, term=None):
         session.expunge_all()
 
     return mbs
+
+
+def _filter_by_term(session, query, term):
+    """Filter the identities of a query which match with `term`.
+
+    When possible, the trigrams index is used to select the candidate
+    identities. Identities with values that cannot be indexed are
+    always candidates. These candidates are checked later against the
+    given term, so the result is the same as the one of a full scan.
+    """
+    pattern = '%' + term + '%'
+
+    # Terms with wildcards or with characters the collation might
+    # consider equal to others can only be matched scanning the table
+    if set(term) & set('%_\\') or not utils.is_trigram_indexable(term):
+        grams = None
+    else:
+        grams = utils.trigrams(term)
+
+    if grams:
+        candidates = session.query(IdentityTrigram.identity_id).\
+            filter(IdentityTrigram.trigram.in_(grams)).\
+            group_by(IdentityTrigram.identity_id).\
+            having(func.count(IdentityTrigram.trigram) == len(grams))
+        unindexed = session.query(IdentityTrigram.identity_id).\
+            filter(IdentityTrigram.trigram == IdentityTrigram.UNINDEXED)
+
+        query = query.filter(Identity.id.in_(candidates.subquery())
+                             | Identity.id.in_(unindexed.subquery()))
+
+    query = query.filter(Identity.name.like(pattern)
+                         | Identity.email.like(pattern)
+                         | Identity.username.like(pattern)
+                         | Identity.source.like(pattern))
+
+    return query
+
+
+def _count_unique_identities(session, term=None):
+    """Count the unique identities which have an identity matching `term`"""
+
+    query = session.query(func.count(Identity.uuid.distinct()))
+
+    if term:
+        query = _filter_by_term(session, query, term)
+
+    return query.scalar()
+
+
+def _encode_page_token(uuid, nuids):
+    """Encode the position of a page into an opaque token"""
+
+    data = json.dumps({'after': uuid, 'total': nuids})
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_page_token(token):
+    """Decode a page token into a tuple of uuid and total number of items"""
+
+    try:
+        data = base64.urlsafe_b64decode(token.encode('ascii'))
+        data = json.loads(data.decode('utf-8'))
+        return data['after'], data['total']
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise InvalidValueError('invalid page token - %s given' % str(token))
@@ -23,7 +23,7 @@ import argparse
 import logging
 
 from .. import api
-from ..command import Command, CMD_SUCCESS, HELP_LIST
+from ..command import Command, CMD_SUCCESS, HELP_LIST, buffered_output
 from ..exceptions import AlreadyExistsError, MatcherNotSupportedError, NotFoundError, InvalidValueError
 from ..matcher import create_identity_matcher
 from ..matching import SORTINGHAT_IDENTITIES_MATCHERS
@@ -105,6 +105,7 @@ class Add(Command):
 
         return code
 
+    @buffered_output
     def add(self, source, email=None, name=None, username=None, uuid=None,
             matching=None, interactive=False):
         """Add an identity to the registry.
@@ -202,6 +203,9 @@ class Add(Command):
     def __read_verification(self):
         answer = None
 
+        # Show the match before asking
+        self.flush()
+
         while answer not in ['y', 'Y', 'n', 'N', '']:
             try:
                 answer = input("Merge unique identities [Y/n]? ")
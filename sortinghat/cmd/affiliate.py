@@ -20,12 +20,21 @@
 #
 
 import argparse
+import datetime
+import json
 import logging
+import os
 import re
 
-from .. import api
-from ..command import Command, CMD_SUCCESS, HELP_LIST
-from ..exceptions import NotFoundError, InvalidValueError
+from sqlalchemy import or_
+
+from .. import api, utils
+from ..command import Command, CMD_SUCCESS, HELP_LIST, buffered_output
+from ..db.api import log_changes, ENROLLMENT_ENTITY
+from ..db.model import MIN_PERIOD_DATE, MAX_PERIOD_DATE, \
+    UniqueIdentity, Identity, Organization, Domain, Enrollment, Change
+from ..exceptions import InvalidDateError, InvalidFormatError, \
+    NotFoundError, InvalidValueError
 
 
 EMAIL_ADDRESS_PATTERN = re.compile(r"^(?P<email>[^\s@]+@[^\s@.]+\.[^\s@]+)$")
@@ -39,12 +48,19 @@ class Affiliate(Command):
     The command affiliates unique identities to organizations using email
     addresses and top/sub domains data. Only new enrollments will be created.
     """
+    CHUNK_SIZE = 1000
+
     def __init__(self, **kwargs):
         super(Affiliate, self).__init__(**kwargs)
 
         self.parser = argparse.ArgumentParser(description=self.description,
                                               usage=self.usage)
 
+        self.parser.add_argument('--since', dest='since', default=None,
+                                 help="affiliate unique identities modified since this date")
+        self.parser.add_argument('--watermark', dest='watermark', default=None,
+                                 help="file to store the state between incremental runs")
+
         # Exit early if help is requested
         if 'cmd_args' in kwargs and [i for i in kwargs['cmd_args'] if i in HELP_LIST]:
             return
@@ -57,65 +73,280 @@ class Affiliate(Command):
 
     @property
     def usage(self):
-        return """%(prog)s affiliate"""
+        return """%(prog)s affiliate [--since <date>] [--watermark <file>]"""
 
     def run(self, *args):
         """Affiliate unique identities to organizations."""
 
-        self.parser.parse_args(args)
+        params = self.parser.parse_args(args)
 
-        code = self.affiliate()
+        try:
+            since = utils.str_to_datetime(params.since)
+        except InvalidDateError as e:
+            self.error(str(e))
+            return e.code
+
+        code = self.affiliate(since=since, watermark=params.watermark)
 
         return code
 
-    def affiliate(self):
+    @buffered_output
+    def affiliate(self, since=None, watermark=None):
         """Affiliate unique identities.
 
         This method enrolls unique identities to organizations using email
         addresses and top/sub domains data. Only new enrollments will be created.
-        """
-        try:
-            uidentities = api.unique_identities(self.db)
 
-            for uid in uidentities:
-                uid.identities.sort(key=lambda x: x.id)
+        Affiliations are calculated in memory. The registry is read only
+        three times, to retrieve the domains, the current enrollments and
+        the email addresses of the identities. New enrollments are stored
+        at once using bulk insertions.
 
-                for identity in uid.identities:
-                    # Only check email address to find new affiliations
-                    if not identity.email:
-                        continue
-                    if not EMAIL_ADDRESS_PATTERN.match(identity.email):
-                        continue
+        When <since> is given, only those unique identities modified on or
+        after that date will be affiliated. Changes on domains cannot be
+        detected using this date, so use <watermark> to take them into
+        account too.
 
-                    domain = identity.email.split('@')[-1]
+        The <watermark> file keeps the state of the last run: its starting
+        date and the domains of the registry at that moment. When it is
+        set, this method will affiliate those unique identities modified
+        since that date and those with email addresses on the domains added,
+        updated or deleted since then. The file is updated after each successful run.
+        When it does not exist, every unique identity will be affiliated.
+        <since> takes precedence over the date stored in the file.
 
-                    try:
-                        doms = api.domains(self.db, domain=domain, top=True)
-                    except NotFoundError as e:
-                        continue
+        :param since: affiliate unique identities modified since this date
+        :param watermark: path to the file that stores the state of the
+            last run
+        """
+        started = datetime.datetime.utcnow()
+
+        try:
+            snapshot = None
 
-                    if len(doms) > 1:
-                        doms.sort(key=lambda d: len(d.domain), reverse=True)
+            if watermark:
+                last_run, snapshot = self.__read_watermark(watermark)
+                since = since or last_run
 
-                        msg = "multiple top domains for %s sub-domain. Domain %s selected."
-                        msg = msg % (domain, doms[0].domain)
-                        self.warning(msg)
+            domains = self.__read_domains()
 
-                    organization = doms[0].organization.name
+            uuids = None
 
-                    # Check enrollments to avoid insert affiliation twice
-                    enrollments = api.enrollments(self.db, uid.uuid,
-                                                  organization)
+            if since:
+                uuids = set(api.search_last_modified_unique_identities(self.db, since))
 
-                    if enrollments:
-                        continue
+                if snapshot is not None:
+                    # Emails on deleted domains might be affiliated
+                    # now to the organization of a top domain
+                    changed = {dom: data[0] for dom, data in domains.items()
+                               if snapshot.get(dom, None) != data}
+                    changed.update((dom, data[0]) for dom, data in snapshot.items()
+                                   if dom not in domains)
+                    uuids.update(self.__find_uuids_by_domain(changed))
 
-                    api.add_enrollment(self.db, uid.uuid, organization)
+            affiliations = self.__find_affiliations(domains, uuids)
+            self.__enroll(affiliations)
 
-                    self.display('affiliate.tmpl', id=uid.uuid,
-                                 email=identity.email, organization=organization)
-        except (NotFoundError, InvalidValueError) as e:
+            for uuid, email, _, organization in affiliations:
+                self.display('affiliate.tmpl', id=uuid,
+                             email=email, organization=organization)
+
+            if watermark:
+                self.__write_watermark(watermark, started, domains)
+        except (NotFoundError, InvalidValueError, InvalidFormatError) as e:
             self.error(str(e))
             return e.code
 
         return CMD_SUCCESS
+
+    def __read_domains(self):
+        """Read the domains of the registry.
+
+        Domains are returned in a dictionary indexed by their lower case
+        form. Each entry stores whether the domain is a top domain or not,
+        and the id and the name of its organization.
+        """
+        with self.db.connect() as session:
+            query = session.query(Domain.domain, Domain.is_top_domain,
+                                  Organization.id, Organization.name).\
+                join(Organization)
+
+            domains = {dom.domain.lower(): (bool(dom.is_top_domain), dom.id, dom.name)
+                       for dom in query}
+
+        return domains
+
+    def __find_uuids_by_domain(self, names):
+        """Find the unique identities with emails on the given domains.
+
+        :param names: dict with the names of the domains and
+            whether they are top domains or not
+        """
+        uuids = set()
+
+        with self.db.connect() as session:
+            for name, is_top_domain in names.items():
+                patterns = [Identity.email.like('%@' + name)]
+
+                if is_top_domain:
+                    patterns.append(Identity.email.like('%.' + name))
+
+                query = session.query(Identity.uuid).\
+                    filter(or_(*patterns)).distinct()
+
+                uuids.update(identity.uuid for identity in query)
+
+        return uuids
+
+    def __find_affiliations(self, domains, uuids=None):
+        """Find the new affiliations of the unique identities.
+
+        When 'uuids' is given, only the identities of those unique
+        identities will be checked.
+
+        Affiliations are returned as a list of tuples composed by
+        the uuid, the email that generated the affiliation and the
+        id and name of the organization.
+        """
+        tops = utils.DomainTrie(dom for dom, data in domains.items() if data[0])
+
+        with self.db.connect() as session:
+            enrolled = set(session.query(Enrollment.uuid,
+                                         Enrollment.organization_id).distinct())
+
+            query = session.query(Identity.uuid, Identity.email).\
+                filter(Identity.email != None).\
+                order_by(Identity.uuid, Identity.id)
+
+            if uuids is None:
+                identities = query.yield_per(self.CHUNK_SIZE)
+            else:
+                identities = self.__filter_by_uuids(query, sorted(uuids))
+
+            affiliations = []
+
+            for identity in identities:
+                # Only check email address to find new affiliations
+                if not EMAIL_ADDRESS_PATTERN.match(identity.email):
+                    continue
+
+                domain = identity.email.split('@')[-1]
+                org = self.__find_organization(domain, domains, tops)
+
+                if not org:
+                    continue
+
+                # Check enrollments to avoid insert affiliation twice
+                org_id, name = org
+
+                if (identity.uuid, org_id) in enrolled:
+                    continue
+
+                enrolled.add((identity.uuid, org_id))
+                affiliations.append((identity.uuid, identity.email,
+                                     org_id, name))
+
+        return affiliations
+
+    def __filter_by_uuids(self, query, uuids):
+        """Run the query for each chunk of uuids"""
+
+        for i in range(0, len(uuids), self.CHUNK_SIZE):
+            chunk = uuids[i:i + self.CHUNK_SIZE]
+
+            for row in query.filter(Identity.uuid.in_(chunk)):
+                yield row
+
+    def __find_organization(self, domain, domains, tops):
+        """Find the organization of a domain.
+
+        The domain is searched first among all the domains. When it is not
+        found, the organization of its longest top domain is selected.
+        """
+        dom = domains.get(domain.lower(), None)
+
+        if not dom:
+            matches = tops.matches(domain)
+
+            if not matches:
+                return None
+
+            if len(matches) > 1:
+                msg = "multiple top domains for %s sub-domain. Domain %s selected."
+                msg = msg % (domain, matches[0])
+                self.warning(msg)
+
+            dom = domains[matches[0]]
+
+        return dom[1:]
+
+    def __enroll(self, affiliations):
+        """Store the new enrollments using bulk insertions"""
+
+        if not affiliations:
+            return
+
+        last_modified = datetime.datetime.utcnow()
+
+        with self.db.connect() as session:
+            for i in range(0, len(affiliations), self.CHUNK_SIZE):
+                chunk = affiliations[i:i + self.CHUNK_SIZE]
+
+                enrollments = [{'uuid': uuid,
+                                'organization_id': org_id,
+                                'start': MIN_PERIOD_DATE,
+                                'end': MAX_PERIOD_DATE}
+                               for uuid, _, org_id, _ in chunk]
+                session.execute(Enrollment.__table__.insert(), enrollments)
+
+                uuids = {affiliation[0] for affiliation in chunk}
+
+                pairs = {(uuid, org_id) for uuid, _, org_id, _ in chunk}
+                rows = session.query(Enrollment.id, Enrollment.uuid,
+                                     Enrollment.organization_id).\
+                    filter(Enrollment.uuid.in_(uuids),
+                           Enrollment.start == MIN_PERIOD_DATE,
+                           Enrollment.end == MAX_PERIOD_DATE).all()
+                log_changes(session, ENROLLMENT_ENTITY, Change.ADD,
+                            [(row.id, row.uuid) for row in rows
+                             if (row.uuid, row.organization_id) in pairs])
+                session.query(UniqueIdentity).\
+                    filter(UniqueIdentity.uuid.in_(uuids)).\
+                    update({UniqueIdentity.last_modified: last_modified},
+                           synchronize_session=False)
+
+    def __read_watermark(self, filepath):
+        """Read the date and the domains stored in a watermark file.
+
+        When the file does not exist, it returns `None` for both.
+        """
+        if not os.path.exists(filepath):
+            return None, None
+
+        try:
+            with open(filepath, 'r') as f:
+                obj = json.load(f)
+
+            since = utils.str_to_datetime(obj['time'])
+            domains = {dom: tuple(data) for dom, data in obj['domains'].items()}
+        except (ValueError, KeyError, TypeError, AttributeError, InvalidDateError) as e:
+            msg = "invalid watermark file %s; %s" % (filepath, str(e))
+            raise InvalidFormatError(cause=msg)
+
+        return since, domains
+
+    def __write_watermark(self, filepath, time, domains):
+        """Store the date and the domains of this run on a watermark file"""
+
+        obj = {
+            'time': time.isoformat(),
+            'domains': domains
+        }
+
+        # Replace the file at once to avoid partial writes
+        tmp = filepath + '.tmp'
+
+        with open(tmp, 'w') as f:
+            json.dump(obj, f, indent=4, sort_keys=True)
+
+        os.replace(tmp, filepath)
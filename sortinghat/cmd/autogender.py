@@ -27,7 +27,7 @@ import requests
 import urllib3.util
 
 from .. import api
-from ..command import Command, CMD_SUCCESS, HELP_LIST
+from ..command import Command, CMD_SUCCESS, HELP_LIST, buffered_output
 from ..exceptions import NotFoundError, InvalidValueError
 
 
@@ -88,6 +88,7 @@ class AutoGender(Command):
 
         return code
 
+    @buffered_output
     def autogender(self, api_token=None, genderize_all=False):
         """Autocomplete gender information of unique identities.
 
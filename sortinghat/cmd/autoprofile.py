@@ -25,7 +25,7 @@ import logging
 import re
 
 from .. import api
-from ..command import Command, CMD_SUCCESS, HELP_LIST
+from ..command import Command, CMD_SUCCESS, HELP_LIST, buffered_output
 from ..exceptions import NotFoundError, InvalidValueError
 
 
@@ -77,6 +77,7 @@ class AutoProfile(Command):
 
         return code
 
+    @buffered_output
     def autocomplete(self, sources):
         """Autocomplete unique identities profiles.
 
@@ -132,7 +133,7 @@ class AutoProfile(Command):
         checked = {}
 
         for source in sources:
-            uids = api.unique_identities(self.db, source=source)
+            uids = api.iter_unique_identities(self.db, source=source)
 
             for uid in uids:
                 if uid.uuid in checked:
@@ -180,17 +180,18 @@ class SortingHatIdentitiesExporter(IdentitiesExporter):
         """
         uidentities = {}
 
-        uids = api.unique_identities(self.db, source=source)
+        uids = api.iter_unique_identities(self.db, source=source)
 
         for uid in uids:
-            enrollments = [rol.to_dict()
-                           for rol in api.enrollments(self.db, uuid=uid.uuid)]
-
             u = uid.to_dict()
             u['identities'].sort(key=lambda x: x['id'])
 
             uidentities[uid.uuid] = u
-            uidentities[uid.uuid]['enrollments'] = enrollments
+
+        enrollments = api.enrollments_by_uuid(self.db, list(uidentities.keys()))
+
+        for uuid, rols in enrollments.items():
+            uidentities[uuid]['enrollments'] = [rol.to_dict() for rol in rols]
 
         blacklist = [mb.excluded for mb in api.blacklist(self.db)]
 
@@ -20,29 +20,57 @@
 #
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import itertools
+import json
 import logging
+import os
+import shutil
 import sys
-
-from .. import api
-from ..command import Command, CMD_SUCCESS, HELP_LIST
-from ..db.api import find_unique_identity, find_identity
-from ..db.model import MIN_PERIOD_DATE, MAX_PERIOD_DATE, Enrollment
+import tempfile
+import threading
+import time
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import DBAPIError, IntegrityError
+
+from .. import api, utils
+from ..command import Command, CMD_SUCCESS, HELP_LIST, buffered_output
+from ..db.api import log_changes, profile_values, validate_period, \
+    ENROLLMENT_ENTITY, IDENTITY_ENTITY, PROFILE_ENTITY, UIDENTITY_ENTITY
+from ..db.cache import clear_entities_cache, invalidate_domains
+from ..db.model import MIN_PERIOD_DATE, MAX_PERIOD_DATE, Change, Country, \
+    Domain, Enrollment, Identity, IdentityTrigram, Organization, Profile, UniqueIdentity, \
+    identity_trigrams
 from ..exceptions import AlreadyExistsError, NotFoundError,\
-    InvalidFormatError, LoadError, MatcherNotSupportedError
+    InvalidFormatError, InvalidValueError, LoadError, MatcherNotSupportedError, \
+    CODE_VALUE_ERROR
 from ..matcher import create_identity_matcher
 from ..matching import SORTINGHAT_IDENTITIES_MATCHERS
-from ..parsing.sh import SortingHatParser
+from ..parsing.sh import SortingHatStreamParser
 
 
 logger = logging.getLogger(__name__)
 
+PROFILE_COLUMNS = ('name', 'email', 'gender', 'gender_acc', 'is_bot', 'country_code')
+
+_IdentityRow = collections.namedtuple('_IdentityRow',
+                                      'id name email username source uuid')
+
+_ParsedData = collections.namedtuple('_ParsedData',
+                                     'blacklist organizations nidentities')
+
 
 class Load(Command):
     """Import data into the registry.
 
     This command is able to import data about identities, organizations and
     domains. Data are read, by default, from the standard input. Files can also
-    be used as data input giving the path to file as a positional argument.
+    be used as data input giving their paths as positional arguments. When
+    a directory is given, the JSON files stored on it will be loaded.
 
     By default, identities and organizations are both loaded but two parameters
     can be used to import some parts from the input. When '--identities' option
@@ -62,7 +90,28 @@ class Load(Command):
     assigned to one organization. If one of the given domains is already on the
     registry, the new relationship will NOT be created unless --overwrite
     option were set.
+
+    Files are loaded one by one unless '--jobs' is greater than one. In that
+    case, files are validated at the same time and their unique identities
+    are read again, in groups of '--jobs' batches, while they are loaded.
+    Each group is split into partitions that do not share any identity,
+    neither on the files nor on the registry. These partitions are loaded
+    concurrently. Partitions that fail because of a conflict are loaded
+    again, one after the other, once the rest of the group was loaded.
+    Take into account that the output of '--verbose' will be interleaved.
+    '--jobs' cannot be used reading from the standard input.
+
+    When loading a single input with one job, '--checkpoint' sets a file
+    where the progress of the load is recorded after storing each batch
+    of unique identities. If the load is interrupted, run it again with
+    '--resume' to skip the unique identities already stored.
     """
+    # Number of unique identities loaded at once
+    BATCH_SIZE = 1000
+
+    # Seconds between progress reports
+    PROGRESS_INTERVAL = 60
+
     def __init__(self, **kwargs):
         super(Load, self).__init__(**kwargs)
 
@@ -94,10 +143,20 @@ class Load(Command):
         group.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                            help="run verbose mode while matching and merging")
 
+        # Concurrency options
+        self.parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                                 help="number of files and partitions loaded at once")
+
+        # Checkpoint options
+        group = self.parser.add_argument_group('checkpoint options')
+        group.add_argument('--checkpoint', dest='checkpoint', default=None,
+                           help="file to record the progress of the load")
+        group.add_argument('--resume', dest='resume', action='store_true',
+                           help="skip the unique identities stored according to the checkpoint file")
+
         # Positional arguments
-        self.parser.add_argument('infile', nargs='?', type=argparse.FileType('r'),
-                                 default=sys.stdin,
-                                 help="input file")
+        self.parser.add_argument('infiles', nargs='*', default=['-'],
+                                 help="input files or directories")
 
         # Exit early if help is requested
         if 'cmd_args' in kwargs and [i for i in kwargs['cmd_args'] if i in HELP_LIST]:
@@ -105,6 +164,7 @@ class Load(Command):
 
         self._set_database(**kwargs)
         self.new_uids = set()
+        self._new_uids_lock = threading.Lock()
 
     @property
     def description(self):
@@ -114,13 +174,14 @@ class Load(Command):
     def usage(self):
         usg = "%(prog)s load"
         usg += " [-v] [--reset] [--identities | --orgs]"
-        usg += " [-m matching] [-n] [--no-strict-matching] [--overwrite] [file]"
+        usg += " [-m matching] [-n] [--no-strict-matching] [--overwrite]"
+        usg += " [-j jobs] [--checkpoint file [--resume]] [file ...]"
         return usg
 
     def log(self, msg, debug=True):
         if debug:
             s = msg + '\n'
-            sys.stdout.write(s)
+            self.write(s)
 
     def warning(self, msg, debug=True):
         if debug:
@@ -129,21 +190,122 @@ class Load(Command):
     def run(self, *args):
         """Import data on the registry.
 
-        By default, it reads the data from the standard input. If a positional
-        argument is given, it will read the data from there.
+        By default, it reads the data from the standard input. If positional
+        arguments are given, it will read the data from those files or from
+        the files stored on those directories.
         """
         params = self.parser.parse_args(args)
 
-        with params.infile as infile:
+        if params.jobs < 1:
+            self.error("'jobs' must be greater than 0")
+            return CODE_VALUE_ERROR
+
+        try:
+            infiles = self.__input_files(params.infiles)
+        except (IOError, TypeError, AttributeError) as e:
+            raise RuntimeError(str(e))
+
+        if params.resume and not params.checkpoint:
+            self.error("'--resume' requires a checkpoint file")
+            return CODE_VALUE_ERROR
+
+        if params.checkpoint and (params.jobs > 1 or len(infiles) > 1):
+            self.error("checkpoints can only be used loading a single input with one job")
+            return CODE_VALUE_ERROR
+
+        if params.jobs > 1:
+            if '-' in infiles:
+                self.error("'--jobs' cannot be used reading from the standard input")
+                return CODE_VALUE_ERROR
+
+            return self.__import_files(infiles, params)
+
+        for infile in infiles:
+            code = self.__import_file(infile, params)
+
+            if code != CMD_SUCCESS:
+                return code
+
+        return CMD_SUCCESS
+
+    def __import_file(self, infile, params):
+        """Import the data from a file or from the standard input"""
+
+        try:
+            infile = sys.stdin if infile == '-' else open(infile, 'r', encoding='utf-8')
+            stream = self.__open_stream(infile)
+        except (IOError, TypeError, AttributeError) as e:
+            raise RuntimeError(str(e))
+
+        with infile, stream as fd:
             try:
-                stream = self.__read_file(infile)
-                parser = SortingHatParser(stream)
+                parser = SortingHatStreamParser(fd)
             except InvalidFormatError as e:
                 self.error(str(e))
                 return e.code
             except (IOError, TypeError, AttributeError) as e:
                 raise RuntimeError(str(e))
 
+            # Invalid data is found while the stream is read
+            try:
+                code = self.__import(parser, params)
+            except InvalidFormatError as e:
+                self.error(str(e))
+                return e.code
+
+        return code
+
+    def __import_files(self, infiles, params):
+        """Import the data from several files at once.
+
+        Files are validated by a pool of `params.jobs` processes,
+        so nothing is imported when any of them is invalid. Then,
+        their data is imported as it was read from a single file.
+        Unique identities are read again from the files while they
+        are loaded, so they are not kept in memory.
+        """
+        blacklist = []
+        organizations = []
+        nidentities = 0
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=params.jobs) as executor:
+            results = [executor.submit(_parse_file, infile) for infile in infiles]
+
+            for infile, result in zip(infiles, results):
+                try:
+                    data = result.result()
+                except InvalidFormatError as e:
+                    self.error("%s: %s" % (infile, str(e)))
+                    return e.code
+                except (IOError, TypeError, AttributeError) as e:
+                    raise RuntimeError(str(e))
+
+                blacklist.extend(data.blacklist)
+                organizations.extend(data.organizations)
+                nidentities += data.nidentities
+
+        parser = _FilesParser(infiles, blacklist, organizations, nidentities)
+
+        return self.__import(parser, params)
+
+    def __input_files(self, infiles):
+        """Get the files to read replacing directories by their JSON files"""
+
+        paths = []
+
+        for infile in infiles:
+            if infile != '-' and os.path.isdir(infile):
+                paths.extend(sorted(os.path.join(infile, name)
+                                    for name in os.listdir(infile)
+                                    if name.endswith('.json')))
+            else:
+                paths.append(infile)
+
+        return paths
+
+    def __import(self, parser, params):
+        """Import the data read by the parser"""
+
         if params.identities:
             self.import_blacklist(parser)
             code = self.import_identities(parser,
@@ -151,7 +313,10 @@ class Load(Command):
                                           match_new=params.match_new,
                                           no_strict_matching=params.no_strict,
                                           reset=params.reset,
-                                          verbose=params.verbose)
+                                          verbose=params.verbose,
+                                          jobs=params.jobs,
+                                          checkpoint=params.checkpoint,
+                                          resume=params.resume)
         elif params.orgs:
             self.import_organizations(parser, params.overwrite)
             code = CMD_SUCCESS
@@ -162,10 +327,14 @@ class Load(Command):
                                           match_new=params.match_new,
                                           no_strict_matching=params.no_strict,
                                           reset=params.reset,
-                                          verbose=params.verbose)
+                                          verbose=params.verbose,
+                                          jobs=params.jobs,
+                                          checkpoint=params.checkpoint,
+                                          resume=params.resume)
 
         return code
 
+    @buffered_output
     def import_blacklist(self, parser):
         """Import blacklist.
 
@@ -200,35 +369,182 @@ class Load(Command):
         the new relationship will NOT be created unless 'overwrite' were set
         to 'True'.
 
+        Organizations and domains of the registry are read at once.
+        Then, new organizations and domains are inserted, and domains
+        are reassigned, using bulk statements within a single transaction.
+        Names are compared in lower case but the registry might consider
+        equal names that differ on more than that, like on their accents.
+        When the registry rejects any insertion because of this, nothing
+        is written by the bulk statements and organizations and domains
+        are added one by one instead.
+
         :param parser: sorting hat parser
         :param overwrite: force to reassign domains
         """
         orgs = parser.organizations
 
+        self.log("Loading organizations...")
+
+        try:
+            norgs, n, ndomains, warnings = self.__import_organizations_in_bulk(orgs, overwrite)
+        except (AlreadyExistsError, IntegrityError) as e:
+            logger.debug("Conflict importing organizations in bulk: %s", str(e))
+            norgs, n, ndomains, warnings = self.__import_organizations_by_row(orgs, overwrite)
+
+        for msg in warnings:
+            self.warning(msg)
+
+        self.log("%d/%d organizations loaded" % (norgs, len(orgs)))
+        self.log("%d/%d domains loaded" % (n, ndomains))
+
+    def __import_organizations_in_bulk(self, orgs, overwrite):
+        """Import organizations using bulk statements.
+
+        :returns: a tuple with the number of added organizations, the
+            number of added or updated domains, the number of domains
+            and the list of warnings
+        """
+        new_orgs = []
+        new_domains = collections.OrderedDict()
+        reassigned = {}
+        warnings = []
+        ndomains = 0
+        n = 0
+
+        with self.db.connect() as session:
+            stored_orgs, stored_domains = self.__read_organizations(session)
+
+            for org in orgs:
+                if not org.name:
+                    raise RuntimeError("'name' cannot be %s" %
+                                       ('None' if org.name is None else 'an empty string'))
+
+                if org.name.lower() not in stored_orgs:
+                    stored_orgs[org.name.lower()] = (None, org.name)
+                    new_orgs.append(org.name)
+
+            if new_orgs:
+                session.execute(Organization.__table__.insert(),
+                                [{'name': name} for name in new_orgs])
+
+                for chunk in _chunks(new_orgs, _LoadState.CHUNK_SIZE):
+                    query = session.query(Organization.id, Organization.name).\
+                        filter(Organization.name.in_(chunk))
+                    stored_orgs.update((row.name.lower(), (row.id, row.name))
+                                       for row in query)
+
+            for org in orgs:
+                org_id = stored_orgs[org.name.lower()][0]
+
+                for dom in org.domains:
+                    ndomains += 1
+
+                    if not dom.domain:
+                        raise RuntimeError("'domain_name' cannot be %s" %
+                                           ('None' if dom.domain is None else 'an empty string'))
+                    if not isinstance(dom.is_top_domain, bool):
+                        raise RuntimeError("'is_top_domain' must have a boolean value")
+
+                    key = dom.domain.lower()
+                    values = {'domain': dom.domain,
+                              'is_top_domain': dom.is_top_domain,
+                              'organization_id': org_id}
+
+                    if key in new_domains or key in stored_domains:
+                        if not overwrite:
+                            domain = new_domains[key]['domain'] if key in new_domains \
+                                else stored_domains[key][1]
+                            e = AlreadyExistsError(entity='Domain', eid=domain)
+                            warnings.append("%s. Not updated." % str(e))
+                            continue
+
+                    if key in stored_domains:
+                        reassigned[key] = (stored_domains[key][0], org_id, dom.is_top_domain)
+                    else:
+                        new_domains[key] = values
+
+                    n += 1
+
+            if new_domains:
+                session.execute(Domain.__table__.insert(),
+                                list(new_domains.values()))
+
+            if reassigned:
+                stmt = Domain.__table__.update().\
+                    where(Domain.__table__.c.id == bindparam('_id')).\
+                    values(organization_id=bindparam('organization_id'),
+                           is_top_domain=bindparam('is_top_domain'))
+
+                session.execute(stmt, [{'_id': dom_id, 'organization_id': org_id,
+                                        'is_top_domain': is_top_domain}
+                                       for dom_id, org_id, is_top_domain
+                                       in reassigned.values()])
+
+        # Bulk statements do not trigger the events that
+        # invalidate the cached domains
+        if new_domains or reassigned:
+            invalidate_domains()
+
+        if reassigned:
+            clear_entities_cache()
+
+        return len(new_orgs), n, ndomains, warnings
+
+    def __import_organizations_by_row(self, orgs, overwrite):
+        """Import organizations one by one using the API.
+
+        :returns: a tuple with the number of added organizations, the
+            number of added or updated domains, the number of domains
+            and the list of warnings
+        """
+        warnings = []
+        norgs = 0
+        ndomains = 0
+        n = 0
+
         for org in orgs:
             try:
                 api.add_organization(self.db, org.name)
+                norgs += 1
             except ValueError as e:
                 raise RuntimeError(str(e))
-            except AlreadyExistsError as e:
+            except AlreadyExistsError:
                 pass
 
             for dom in org.domains:
+                ndomains += 1
+
                 try:
                     api.add_domain(self.db, org.name, dom.domain,
                                    is_top_domain=dom.is_top_domain,
                                    overwrite=overwrite)
-                    self.display('load_domains.tmpl', domain=dom.domain,
-                                 organization=org.name)
+                    n += 1
                 except (ValueError, NotFoundError) as e:
                     raise RuntimeError(str(e))
                 except AlreadyExistsError as e:
-                    msg = "%s. Not updated." % str(e)
-                    self.warning(msg)
+                    warnings.append("%s. Not updated." % str(e))
+
+        return norgs, n, ndomains, warnings
+
+    def __read_organizations(self, session):
+        """Read the organizations and domains of the registry.
 
+        :returns: a dict of `(id, name)` tuples for organizations and
+            a dict of `(id, domain)` tuples for domains; both indexed
+            by their lowercase names
+        """
+        orgs = {row.name.lower(): (row.id, row.name)
+                for row in session.query(Organization.id, Organization.name)}
+        domains = {row.domain.lower(): (row.id, row.domain)
+                   for row in session.query(Domain.id, Domain.domain)}
+
+        return orgs, domains
+
+    @buffered_output
     def import_identities(self, parser, matching=None, match_new=False,
                           no_strict_matching=False,
-                          reset=False, verbose=False):
+                          reset=False, verbose=False, jobs=1,
+                          checkpoint=None, resume=False):
         """Import identities information on the registry.
 
         New unique identities, organizations and enrollment data parsed
@@ -245,14 +561,24 @@ class Load(Command):
         When `reset` is set, relationships and enrollments will be removed
         before loading any data.
 
+        Unique identities are loaded by `jobs` threads. When it is greater
+        than one, they are split in partitions that can be loaded at the
+        same time.
+
         :param parser: sorting hat parser
         :param matching: type of matching used to merge existing identities
         :param match_new: match and merge only the new loaded identities
         :param no_strict_matching: disable strict matching (i.e, well-formed email addresses)
         :param reset: remove relationships and enrollments before loading data
         :param verbose: run in verbose mode when matching is set
+        :param jobs: number of partitions of unique identities loaded at once
+        :param checkpoint: path to the file where the progress of the load
+            is recorded; it can only be used when `jobs` is one
+        :param resume: skip the unique identities stored according to
+            the `checkpoint` file
         """
         matcher = None
+        journal = None
 
         if matching:
             strict = not no_strict_matching
@@ -264,11 +590,27 @@ class Load(Command):
                 self.error(str(e))
                 return e.code
 
+        if checkpoint:
+            try:
+                journal = _Journal(checkpoint, parser.fingerprint, resume)
+            except (InvalidFormatError, LoadError) as e:
+                self.error(str(e))
+                return e.code
+
         uidentities = parser.identities
 
+        if isinstance(uidentities, list):
+            total = len(uidentities)
+            progress = _Progress(self, self.PROGRESS_INTERVAL,
+                                 lambda n: n / total if total else 1.0)
+        else:
+            progress = _Progress(self, self.PROGRESS_INTERVAL,
+                                 lambda n: parser.progress)
+
         try:
             self.__load_unique_identities(uidentities, matcher, match_new,
-                                          reset, verbose)
+                                          reset, verbose, jobs, journal,
+                                          progress)
         except LoadError as e:
             self.error(str(e))
             return e.code
@@ -276,111 +618,465 @@ class Load(Command):
         return CMD_SUCCESS
 
     def __load_unique_identities(self, uidentities, matcher, match_new,
-                                 reset, verbose):
-        """Load unique identities"""
+                                 reset, verbose, jobs=1, journal=None,
+                                 progress=None):
+        """Load unique identities.
+
+        Unique identities are loaded in batches of `BATCH_SIZE`.
+        The data of the registry related to each batch is read
+        at once; then, unique identities are processed in memory,
+        one by one, and the changes are written in bulk.
+
+        When `jobs` is greater than one, `jobs` batches are read at
+        once and split in partitions that are loaded concurrently.
 
+        When a `matcher` is given, the loaded unique identities
+        are matched and merged once all of them were stored.
+
+        After storing each batch, its position on the input and the
+        loaded unique identities are recorded on the `journal`, when
+        it is given. Unique identities recorded there are skipped.
+        """
         self.new_uids.clear()
 
         n = 0
+        total = 0
+        loaded = {}
+
+        if journal:
+            n = journal.count
+            total = journal.position
+            loaded.update((uuid, True) for uuid in journal.loaded)
+            self.new_uids.update(journal.new_uids)
 
-        if reset:
+        # Relationships were already cleared when resuming
+        if reset and not total:
             self.__reset_unique_identities()
 
         self.log("Loading unique identities...")
 
+        if total:
+            self.log("Resuming after %d unique identities" % total)
+
+        uidentities = iter(uidentities)
+
+        # Skip those unique identities already stored
+        collections.deque(itertools.islice(uidentities, total), maxlen=0)
+
+        if progress:
+            progress.start(total)
+
+        while True:
+            batch = list(itertools.islice(uidentities, self.BATCH_SIZE * jobs))
+
+            if not batch:
+                break
+
+            batch_loaded = {}
+
+            total += len(batch)
+
+            if jobs > 1:
+                n += self.__load_partitions(batch, batch_loaded, jobs, verbose)
+            else:
+                n += self.__load_batch(batch, batch_loaded, verbose)
+
+            loaded.update(batch_loaded)
+
+            if journal:
+                journal.commit(total, n, list(batch_loaded),
+                               [uuid for uuid in batch_loaded if uuid in self.new_uids])
+
+            if progress:
+                progress.update(total)
+
+        # Matching already run when the load was completed
+        completed = journal.completed if journal else False
+
+        if matcher and not completed:
+            uuids = [uuid for uuid in loaded
+                     if not match_new or uuid in self.new_uids]
+            self._merge_on_matching(uuids, matcher, verbose)
+
+        if journal and not completed:
+            journal.complete()
+
+        self.log("%d/%d unique identities loaded" % (n, total))
+
+    def __load_partitions(self, uidentities, loaded, jobs, verbose):
+        """Load partitions of unique identities concurrently.
+
+        Organizations are added first, so partitions do not compete
+        to create them. Partitions that fail because of a conflict
+        with other partitions are loaded again, one by one, once
+        the rest were loaded.
+        """
+        self.__add_organizations(uidentities)
+
+        partitions = self.__partition(uidentities)
+        results = [None] * len(partitions)
+        failed = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(self.__load_partition, partition, verbose): i
+                       for i, partition in enumerate(partitions)}
+
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+
+                try:
+                    results[i] = future.result()
+                except (AlreadyExistsError, DBAPIError) as e:
+                    logger.debug("Conflict loading partition %s: %s", i, str(e))
+                    failed.append(i)
+
+        for i in sorted(failed):
+            results[i] = self.__load_partition(partitions[i], verbose)
+
+        n = 0
+
+        for nloaded, uuids in results:
+            n += nloaded
+            loaded.update(uuids)
+
+        return n
+
+    def __load_partition(self, uidentities, verbose):
+        """Load a partition of unique identities.
+
+        :returns: a tuple with the number of loaded unique identities
+            and a dict with their uuids
+        """
+        loaded = {}
+        n = 0
+
+        for i in range(0, len(uidentities), self.BATCH_SIZE):
+            batch = uidentities[i:i + self.BATCH_SIZE]
+            n += self.__load_batch(batch, loaded, verbose)
+
+        return n, loaded
+
+    def __partition(self, uidentities):
+        """Split unique identities into independent partitions.
+
+        Two unique identities are placed on the same partition when
+        they share the uuid or the id of any of their identities, or
+        when any of their identities are assigned to the same unique
+        identity in the registry. Small partitions are packed together
+        up to `BATCH_SIZE` unique identities.
+        """
+        keys = []
+
         for uidentity in uidentities:
-            self.log("\n=====", verbose)
-            self.log("+ Processing %s" % uidentity.uuid, verbose)
+            ids = [uidentity.uuid] if uidentity.uuid else []
+
+            for identity in uidentity.identities:
+                try:
+                    ids.append(utils.uuid(identity.source, email=identity.email,
+                                          name=identity.name, username=identity.username))
+                except ValueError:
+                    pass
+
+            keys.append(ids)
+
+        stored = {}
+        ids = list({key for uids in keys for key in uids})
+
+        with self.db.connect() as session:
+            for i in range(0, len(ids), self.BATCH_SIZE):
+                query = session.query(Identity.id, Identity.uuid).\
+                    filter(Identity.id.in_(ids[i:i + self.BATCH_SIZE]))
+                stored.update((row.id, row.uuid) for row in query)
+
+        sets = _DisjointSets()
+
+        # Unique identities are represented by their position
+        # in the list; keys are strings, so they cannot clash
+        for i, uids in enumerate(keys):
+            sets.add(i)
+
+            for key in uids:
+                sets.union(i, key)
+
+                if key in stored:
+                    sets.union(key, stored[key])
 
+        groups = {}
+
+        for i, uidentity in enumerate(uidentities):
+            groups.setdefault(sets.find(i), []).append(uidentity)
+
+        partitions = []
+        partition = []
+
+        for group in groups.values():
+            if partition and len(partition) + len(group) > self.BATCH_SIZE:
+                partitions.append(partition)
+                partition = []
+
+            partition.extend(group)
+
+        if partition:
+            partitions.append(partition)
+
+        return partitions
+
+    def __add_organizations(self, uidentities):
+        """Add the organizations of the enrollments"""
+
+        names = {rol.organization.name: True
+                 for uidentity in uidentities
+                 for rol in uidentity.enrollments
+                 if rol.organization.name}
+
+        for name in names:
             try:
-                stored_uuid = self.__load_unique_identity(uidentity, verbose)
-            except LoadError as e:
-                self.error("%s Skipping." % str(e))
+                api.add_organization(self.db, name)
+            except AlreadyExistsError:
+                pass
+
+    def __load_batch(self, uidentities, loaded, verbose):
+        """Load a batch of unique identities.
+
+        The uuids of the stored unique identities are added
+        to `loaded`.
+
+        Unique identities that share identities with a previous one
+        of the batch, or with the registry, are loaded on the unique
+        identity of those identities without merging them on the
+        registry.
+        """
+
+        state = _LoadState(self.db, uidentities)
+        collapsed = self.__collapse_duplicates(state, uidentities)
+        n = 0
+
+        try:
+            for uidentity, (shared_id, identities) in zip(uidentities, collapsed):
+                self.log("\n=====", verbose)
+                self.log("+ Processing %s" % uidentity.uuid, verbose)
+
+                # The shared identity might not be stored when
+                # the unique identity that had it was not loaded
+                if shared_id and state.has_identity(shared_id):
+                    stored_uuid = state.identity_uuid(shared_id)
+                    msg = "-- %s shares identities with %s. Loading them together." % \
+                        (uidentity.uuid, stored_uuid)
+                    self.log(msg, verbose)
+
+                    identities = [identity for identity_id, identity in identities
+                                  if identity_id != shared_id]
+                else:
+                    identities = [identity for _, identity in identities]
+
+                    try:
+                        stored_uuid = self.__load_unique_identity(state, uidentity,
+                                                                  identities, verbose)
+                    except LoadError as e:
+                        self.error("%s Skipping." % str(e))
+                        self.log("=====", verbose)
+                        continue
+
+                stored_uuid = self.__load_identities(state, identities,
+                                                     stored_uuid, verbose)
+
+                try:
+                    self.__load_profile(state, uidentity.profile, stored_uuid, verbose)
+                except Exception as e:
+                    self.error("%s. Loading %s profile. Skipping profile." %
+                               (str(e), stored_uuid))
+
+                self.__load_enrollments(state, uidentity.enrollments, stored_uuid,
+                                        verbose)
+
+                loaded[stored_uuid] = True
+
+                self.log("+ %s (old %s) loaded" % (stored_uuid, uidentity.uuid),
+                         verbose)
                 self.log("=====", verbose)
-                continue
+                n += 1
+        finally:
+            # Store the changes made before any error
+            state.flush()
+
+        return n
+
+    def __collapse_duplicates(self, state, uidentities):
+        """Find duplicated identities on a batch of unique identities.
+
+        Identities repeated on the same unique identity are removed.
+        A unique identity that would be created for its first identity
+        and then merged, because any of its identities was already
+        stored or given by a previous unique identity of the batch,
+        can be loaded on the unique identity of that identity instead.
+        For those, the id of the shared identity is returned together
+        with the list of identities. Otherwise, `None` is returned with
+        the list. Identities are given as `(identity_id, identity)`
+        tuples.
+
+        Unique identities that will be skipped because they cannot be
+        created do not share their identities with the next ones.
+
+        :returns: a list with a `(shared_id, identities)` tuple per
+            unique identity
+        """
+        seen = set()
+        collapsed = []
 
-            stored_uuid = self.__load_identities(uidentity.identities, stored_uuid,
-                                                 verbose)
+        for uidentity in uidentities:
+            ids = []
+            identities = []
 
-            try:
-                self.__load_profile(uidentity.profile, stored_uuid, verbose)
-            except Exception as e:
-                self.error("%s. Loading %s profile. Skipping profile." %
-                           (str(e), stored_uuid))
+            for identity in uidentity.identities:
+                try:
+                    identity_id = utils.uuid(identity.source, email=identity.email,
+                                             name=identity.name, username=identity.username)
+                except ValueError:
+                    identity_id = None
 
-            self.__load_enrollments(uidentity.enrollments, stored_uuid,
-                                    verbose)
+                if identity_id and identity_id in ids:
+                    continue
 
-            if matcher and (not match_new or stored_uuid in self.new_uids):
-                stored_uuid = self._merge_on_matching(stored_uuid, matcher,
-                                                      verbose)
+                ids.append(identity_id)
+                identities.append((identity_id, identity))
 
-            self.log("+ %s (old %s) loaded" % (stored_uuid, uidentity.uuid),
-                     verbose)
-            self.log("=====", verbose)
-            n += 1
+            uuid = uidentity.uuid
+            shared_id = None
 
-        self.log("%d/%d unique identities loaded" % (n, len(uidentities)))
+            if uuid and (state.exists(uuid) or uuid in seen):
+                seen.update(identity_id for identity_id in ids if identity_id)
+            elif ids and ids[0]:
+                shared_id = next((identity_id for identity_id in ids
+                                  if identity_id in seen or state.has_identity(identity_id)),
+                                 None)
+                seen.update(identity_id for identity_id in ids if identity_id)
+
+            collapsed.append((shared_id, identities))
+
+        return collapsed
 
     def __reset_unique_identities(self):
-        """Clear identities relationships and enrollments data"""
+        """Clear identities relationships and enrollments data.
 
+        Every identity is moved to the unique identity that has its
+        same identifier, creating it when it does not exist. Unique
+        identities left without identities are removed together with
+        their profiles. The whole reset runs on a single transaction
+        using bulk statements.
+        """
         self.log("Reseting unique identities...")
 
         self.log("Clearing identities relationships")
 
-        nids = 0
-        uidentities = api.unique_identities(self.db)
+        now = datetime.datetime.utcnow()
+        chunk_size = _LoadState.CHUNK_SIZE
 
-        for uidentity in uidentities:
-            for identity in uidentity.identities:
-                api.move_identity(self.db, identity.id, identity.id)
-                nids += 1
+        with self.db.connect() as session:
+            moved = session.query(Identity.id, Identity.uuid).\
+                filter(Identity.uuid != Identity.id).all()
 
-        self.log("Relationships cleared for %s identities" % nids)
+            ids = [id_ for id_, _ in moved]
+            old_uuids = list({uuid for _, uuid in moved})
 
-        self.log("Clearing enrollments")
+            stored = set()
 
-        with self.db.connect() as session:
-            enrollments = session.query(Enrollment).all()
+            for chunk in _chunks(ids, chunk_size):
+                stored.update(uuid for uuid, in session.query(UniqueIdentity.uuid).
+                              filter(UniqueIdentity.uuid.in_(chunk)))
+
+            new_uuids = [id_ for id_ in ids if id_ not in stored]
+
+            if new_uuids:
+                session.execute(UniqueIdentity.__table__.insert(),
+                                [{'uuid': uuid, 'last_modified': now}
+                                 for uuid in new_uuids])
+                session.execute(Profile.__table__.insert(),
+                                [{'uuid': uuid, 'is_bot': False}
+                                 for uuid in new_uuids])
+                log_changes(session, UIDENTITY_ENTITY, Change.ADD,
+                            [(uuid, uuid) for uuid in new_uuids])
+
+            if moved:
+                session.query(Identity).\
+                    filter(Identity.uuid != Identity.id).\
+                    update({Identity.uuid: Identity.id,
+                            Identity.last_modified: now},
+                           synchronize_session=False)
+                log_changes(session, IDENTITY_ENTITY, Change.UPDATE,
+                            [(id_, id_) for id_ in ids])
+
+            # Unique identities without identities are orphaned
+            remaining = set()
+
+            for chunk in _chunks(old_uuids, chunk_size):
+                remaining.update(uuid for uuid, in session.query(Identity.uuid).
+                                 filter(Identity.uuid.in_(chunk)).distinct())
+
+            orphaned = [uuid for uuid in old_uuids if uuid not in remaining]
+
+            self.log("Relationships cleared for %s identities" % len(ids))
+
+            self.log("Clearing enrollments")
+
+            enrollments = session.query(Enrollment.id, Enrollment.uuid).all()
+
+            session.query(Enrollment).delete(synchronize_session=False)
+            log_changes(session, ENROLLMENT_ENTITY, Change.DELETE, enrollments)
 
-            for enr in enrollments:
-                session.delete(enr)
+            for chunk in _chunks(orphaned, chunk_size):
+                session.query(Profile).\
+                    filter(Profile.uuid.in_(chunk)).\
+                    delete(synchronize_session=False)
+                session.query(UniqueIdentity).\
+                    filter(UniqueIdentity.uuid.in_(chunk)).\
+                    delete(synchronize_session=False)
+
+            log_changes(session, UIDENTITY_ENTITY, Change.DELETE,
+                        [(uuid, uuid) for uuid in orphaned])
+
+            modified = (stored | remaining | {uuid for _, uuid in enrollments}) - \
+                set(orphaned)
+
+            for chunk in _chunks(list(modified), chunk_size):
+                session.query(UniqueIdentity).\
+                    filter(UniqueIdentity.uuid.in_(chunk)).\
+                    update({UniqueIdentity.last_modified: now},
+                           synchronize_session=False)
 
         self.log("Enrollments cleared")
 
-    def __load_unique_identity(self, uidentity, verbose):
-        """Seek or store unique identity"""
+    def __load_unique_identity(self, state, uidentity, identities, verbose):
+        """Seek or store unique identity.
+
+        When a new unique identity is created, its first identity
+        is removed from `identities`.
+        """
 
         uuid = uidentity.uuid
 
         if uuid:
-            try:
-                api.unique_identities(self.db, uuid)
+            if state.exists(uuid):
                 self.log("-- %s already exists." % uuid, verbose)
                 return uuid
-            except NotFoundError as e:
+            else:
                 self.log("-- %s not found. Generating a new UUID." % uuid,
                          debug=verbose)
 
         # We don't have a unique identity, so we have to create
         # a new one.
-        if len(uidentity.identities) == 0:
+        if len(identities) == 0:
             msg = "not enough info to load %s unique identity." % uidentity.uuid
             raise LoadError(cause=msg)
 
-        identity = uidentity.identities.pop(0)
+        identity = identities.pop(0)
 
         try:
-            stored_uuid = api.add_identity(self.db, identity.source,
-                                           identity.email,
-                                           identity.name,
-                                           identity.username)
-            self.new_uids.add(stored_uuid)
+            stored_uuid = state.add_identity(identity)
+
+            with self._new_uids_lock:
+                self.new_uids.add(stored_uuid)
         except AlreadyExistsError as e:
-            with self.db.connect() as session:
-                stored_identity = find_identity(session, e.eid)
-                stored_uuid = stored_identity.uuid
+            stored_uuid = state.identity_uuid(e.eid)
             self.warning("-- " + str(e), debug=verbose)
         except ValueError as e:
             raise LoadError(cause=str(e))
@@ -389,57 +1085,54 @@ class Load(Command):
 
         return stored_uuid
 
-    def __load_identities(self, identities, uuid, verbose):
+    def __load_identities(self, state, identities, uuid, verbose):
         """Store identities"""
 
         self.log("-- loading identities", verbose)
 
         for identity in identities:
             try:
-                api.add_identity(self.db, identity.source, identity.email,
-                                 identity.name, identity.username, uuid)
-                self.new_uids.add(uuid)
+                state.add_identity(identity, uuid)
+
+                with self._new_uids_lock:
+                    self.new_uids.add(uuid)
             except AlreadyExistsError as e:
                 self.warning(str(e), verbose)
 
-                with self.db.connect() as session:
-                    stored_identity = find_identity(session, e.eid)
-                    stored_uuid = stored_identity.uuid
+                stored_uuid = state.identity_uuid(e.eid)
 
                 if uuid != stored_uuid:
                     msg = "%s is already assigned to %s. Merging." % (uuid, stored_uuid)
                     self.warning(msg, verbose)
 
-                    api.merge_unique_identities(self.db, uuid, stored_uuid)
-
-                    if uuid in self.new_uids:
-                        self.new_uids.remove(uuid)
+                    state.merge(uuid, stored_uuid)
 
-                    self.new_uids.add(stored_uuid)
+                    with self._new_uids_lock:
+                        self.new_uids.discard(uuid)
+                        self.new_uids.add(stored_uuid)
                     uuid = stored_uuid
 
         self.log("-- identities loaded", verbose)
 
         return uuid
 
-    def __load_profile(self, profile, uuid, verbose):
+    def __load_profile(self, state, profile, uuid, verbose):
         """Create a new profile when the unique identity does not have any."""
 
         def is_empty_profile(prf):
-            return not (prf.name or prf.email or
-                        prf.gender or prf.gender_acc or
-                        prf.is_bot or prf.country_code)
-
-        uid = api.unique_identities(self.db, uuid)[0]
+            return not (prf['name'] or prf['email'] or
+                        prf['gender'] or prf['gender_acc'] or
+                        prf['is_bot'] or prf['country_code'])
 
         if profile:
-            self.__create_profile(profile, uuid, verbose)
-        elif is_empty_profile(uid.profile):
-            self.__create_profile_from_identities(uid.identities, uuid, verbose)
+            self.__create_profile(state, profile, uuid, verbose)
+        elif is_empty_profile(state.profile(uuid)):
+            self.__create_profile_from_identities(state, state.identities(uuid),
+                                                  uuid, verbose)
         else:
             self.log("-- empty profile given for %s. Not updated" % uuid, verbose)
 
-    def __create_profile(self, profile, uuid, verbose):
+    def __create_profile(self, state, profile, uuid, verbose):
         """Create profile information from a profile object"""
 
         # Set parameters to edit
@@ -450,11 +1143,11 @@ class Load(Command):
         kw.pop('uuid')
         kw.pop('country')
 
-        api.edit_profile(self.db, uuid, **kw)
+        state.edit_profile(uuid, **kw)
 
         self.log("-- profile %s updated" % uuid, verbose)
 
-    def __create_profile_from_identities(self, identities, uuid, verbose):
+    def __create_profile_from_identities(self, state, identities, uuid, verbose):
         """Create a profile using the data from the identities"""
 
         import re
@@ -497,11 +1190,11 @@ class Load(Command):
         kw = {'name': name,
               'email': email}
 
-        api.edit_profile(self.db, uuid, **kw)
+        state.edit_profile(uuid, **kw)
 
         self.log("-- profile %s updated" % uuid, verbose)
 
-    def __load_enrollments(self, enrollments, uuid, verbose):
+    def __load_enrollments(self, state, enrollments, uuid, verbose):
         """Store enrollments"""
 
         self.log("-- loading enrollments", verbose)
@@ -512,7 +1205,7 @@ class Load(Command):
             organization = enrollment.organization.name
 
             try:
-                api.add_organization(self.db, organization)
+                state.add_organization(organization)
             except AlreadyExistsError as e:
                 msg = "%s. Organization not updated." % str(e)
                 self.warning(msg, verbose)
@@ -528,8 +1221,7 @@ class Load(Command):
                 self.warning(msg, verbose)
 
             try:
-                api.add_enrollment(self.db, uuid, enrollment.organization.name,
-                                   from_date, to_date)
+                state.enroll(uuid, organization, from_date, to_date)
             except AlreadyExistsError as e:
                 msg = "%s. Enrollment not updated." % str(e)
                 self.warning(msg, verbose)
@@ -537,32 +1229,53 @@ class Load(Command):
                 raise LoadError(cause=str(e))
 
         for organization in organizations:
-            api.merge_enrollments(self.db, uuid, organization)
+            state.merge_enrollments(uuid, organization)
 
         self.log("-- enrollments loaded", verbose)
 
-    def _merge_on_matching(self, uuid, matcher, verbose):
-        """Merge unique identity with uuid when a match is found"""
-
-        matches = api.match_identities(self.db, uuid, matcher)
+    def _merge_on_matching(self, uuids, matcher, verbose):
+        """Merge the loaded unique identities when a match is found.
+
+        Matches are searched at once for all the unique identities
+        in `uuids`. Then, merges are done in the same order as if each
+        unique identity were matched right after loading it: every one
+        of them, following the order of `uuids`, is merged with the
+        unique identities that match it and were already stored at
+        that moment, one after the other, sorted by their uuid. The
+        order matters because merged profiles keep the values of
+        the unique identity they are merged into.
+        """
+        matches = api.match_unique_identities(self.db, uuids, matcher)
 
-        new_uuid = uuid
+        order = {uuid: n for n, uuid in enumerate(uuids)}
 
-        u = api.unique_identities(self.db, uuid)[0]
+        # Only the loaded unique identities have their matches
+        related = collections.defaultdict(set)
 
-        for m in matches:
-            if m.uuid == uuid:
-                continue
+        for uuid, matched in matches.items():
+            for m in matched:
+                related[uuid].add(m)
+                related[m].add(uuid)
 
-            self._merge(u, m, verbose)
+        sets = _DisjointSets()
+        merges = []
 
-            new_uuid = m.uuid
+        for uuid in uuids:
+            # Those loaded later were not stored yet
+            current = sets.find(uuid)
+            targets = {sets.find(m) for m in related[uuid]
+                       if order.get(m, -1) < order[uuid]}
+            targets.discard(current)
 
-            # Swap uids to merge with those that could
-            # remain on the list with updated info
-            u = api.unique_identities(self.db, m.uuid)[0]
+            for target in sorted(targets):
+                merges.append((current, target))
+                sets.union(current, target)
+                current = target
 
-        return new_uuid
+        for from_uuid, to_uuid in merges:
+            from_uid = api.unique_identities(self.db, from_uuid)[0]
+            to_uid = api.unique_identities(self.db, to_uuid)[0]
+            self._merge(from_uid, to_uid, verbose)
 
     def _merge(self, from_uid, to_uid, verbose):
         """Merge unique identity uid on match"""
@@ -575,8 +1288,670 @@ class Load(Command):
         if verbose:
             self.display('merge.tmpl', from_uuid=from_uid.uuid, to_uuid=to_uid.uuid)
 
-    def __read_file(self, infile):
-        """Read a file into a str object"""
+    def __open_stream(self, infile):
+        """Get a seekable stream to read the input.
+
+        Inputs that cannot be read more than once, such as the
+        standard input, are copied to a temporary file first.
+        """
+        if infile.seekable():
+            return _keep_open(infile)
+
+        tmp = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        shutil.copyfileobj(infile, tmp)
+        tmp.seek(0)
+
+        return tmp
+
+
+@contextlib.contextmanager
+def _keep_open(stream):
+    """Use a stream on a 'with' statement without closing it"""
+
+    yield stream
+
+
+def _parse_file(path):
+    """Parse a Sorting Hat file.
+
+    This function is run by the processes of the parsing pool,
+    so it returns the parsed data instead of the parser. Unique
+    identities are validated and counted, but not returned.
+    """
+    with open(path, 'r', encoding='utf-8') as fd:
+        parser = SortingHatStreamParser(fd)
+
+        blacklist = parser.blacklist
+        organizations = parser.organizations
+        nidentities = sum(1 for _ in parser.identities)
+
+        return _ParsedData(blacklist, organizations, nidentities)
+
+
+class _FilesParser(object):
+    """Read the data of several Sorting Hat files as a single input.
+
+    Blacklist entries and organizations are given, as they were
+    already parsed. Unique identities are read from the files, one
+    after the other, each time they are iterated.
+
+    :param paths: paths of the files
+    :param blacklist: blacklist entries of the files
+    :param organizations: organizations of the files
+    :param nidentities: number of unique identities of the files
+    """
+    def __init__(self, paths, blacklist, organizations, nidentities):
+        self.paths = paths
+        self.blacklist = blacklist
+        self.organizations = organizations
+        self.nidentities = nidentities
+        self._read = 0
+
+    @property
+    def identities(self):
+        self._read = 0
+
+        for path in self.paths:
+            with open(path, 'r', encoding='utf-8') as fd:
+                parser = SortingHatStreamParser(fd)
+
+                for uidentity in parser.identities:
+                    self._read += 1
+                    yield uidentity
+
+    @property
+    def progress(self):
+        """Fraction of the unique identities read by the last pass"""
+
+        if not self.nidentities:
+            return 1.0
+
+        return min(self._read / self.nidentities, 1.0)
+
+
+def _chunks(values, size):
+    """Split a list of values in chunks of `size` elements"""
+
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+class _Journal(object):
+    """Checkpoint journal of a load.
+
+    The journal is a file with a JSON object per line. The first one
+    stores the fingerprint of the input. Then, an object is appended
+    each time a batch is stored with the position of the input up to
+    where unique identities were processed, the number of them that
+    were loaded and the uuids loaded in that batch. The last object
+    marks the load as completed.
+
+    When `resume` is set and the file exists, its state is read to
+    continue the load. Otherwise, a new journal is started.
+
+    :param filepath: path to the journal file
+    :param fingerprint: fingerprint of the input
+    :param resume: read the state of the journal
+
+    :raises InvalidFormatError: when the journal file is not valid
+    :raises LoadError: when the journal was recorded for another input
+    """
+    def __init__(self, filepath, fingerprint, resume=False):
+        self.filepath = filepath
+        self.position = 0
+        self.count = 0
+        self.loaded = []
+        self.new_uids = []
+        self.completed = False
+
+        if resume and os.path.exists(filepath):
+            self.__read(fingerprint)
+        else:
+            with open(filepath, 'w') as f:
+                self.__write(f, {'fingerprint': fingerprint,
+                                 'time': datetime.datetime.utcnow().isoformat()})
+
+    def commit(self, position, count, loaded, new_uids):
+        """Record the state after storing a batch"""
+
+        self.__append({'position': position, 'count': count,
+                       'loaded': loaded, 'new': new_uids})
+
+    def complete(self):
+        """Mark the load as completed"""
+
+        self.__append({'completed': True})
+        self.completed = True
+
+    def __read(self, fingerprint):
+        try:
+            with open(self.filepath, 'r') as f:
+                lines = f.read().split('\n')
+
+            # The last line might be a partial write
+            objs = []
+
+            for n, line in enumerate(lines):
+                try:
+                    objs.append(json.loads(line))
+                except ValueError:
+                    if n < len(lines) - 1:
+                        raise
+
+            if not objs or objs[0].get('fingerprint') != fingerprint:
+                msg = "checkpoint file %s does not match the input" % self.filepath
+                raise LoadError(cause=msg)
+
+            for obj in objs[1:]:
+                if obj.get('completed', False):
+                    self.completed = True
+                    continue
+
+                self.position = obj['position']
+                self.count = obj['count']
+                self.loaded.extend(obj['loaded'])
+                self.new_uids.extend(obj['new'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            msg = "invalid checkpoint file %s; %s" % (self.filepath, str(e))
+            raise InvalidFormatError(cause=msg)
+
+        # Drop any partial write before appending new objects
+        with open(self.filepath, 'w') as f:
+            for obj in objs:
+                self.__write(f, obj)
+
+    def __append(self, obj):
+        with open(self.filepath, 'a') as f:
+            self.__write(f, obj)
+
+    @staticmethod
+    def __write(f, obj):
+        f.write(json.dumps(obj, sort_keys=True) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class _Progress(object):
+    """Periodic report of the throughput and the time left of a load.
+
+    :param command: command used to report the progress
+    :param interval: minimum number of seconds between reports
+    :param fraction: function that returns the fraction of the input
+        processed, given the number of unique identities processed
+    """
+    def __init__(self, command, interval, fraction):
+        self.command = command
+        self.interval = interval
+        self.fraction = fraction
+        self.start()
+
+    def start(self, processed=0):
+        """Start measuring the progress"""
+
+        self._started = time.monotonic()
+        self._last = self._started
+        self._processed = processed
+        self._fraction = self.fraction(processed)
+
+    def update(self, processed):
+        """Report the progress when the interval has passed"""
+
+        now = time.monotonic()
+
+        if now - self._last < self.interval:
+            return
+
+        self._last = now
+
+        elapsed = now - self._started
+        rate = (processed - self._processed) / elapsed if elapsed else 0.0
+        fraction = self.fraction(processed)
+
+        msg = "%d unique identities processed (%.1f/s, %d%%" % \
+            (processed, rate, fraction * 100)
+
+        if fraction > self._fraction:
+            left = elapsed * (1.0 - fraction) / (fraction - self._fraction)
+            msg += ", ETA %s" % datetime.timedelta(seconds=int(left))
+
+        self.command.log(msg + ")")
+
+
+class _DisjointSets(object):
+    """Disjoint sets of keys, joined with `union()`"""
+
+    def __init__(self):
+        self._parents = {}
+
+    def __iter__(self):
+        return iter(list(self._parents))
+
+    def add(self, key):
+        self._parents.setdefault(key, key)
+
+    def find(self, key):
+        """Get the representative key of the set of `key`"""
+
+        root = self._parents.setdefault(key, key)
+
+        while root != self._parents[root]:
+            root = self._parents[root]
+
+        # Compress the path to the root
+        while key != root:
+            self._parents[key], key = root, self._parents[key]
+
+        return root
+
+    def union(self, a, b):
+        """Join the sets of `a` and `b`"""
+
+        self._parents[self.find(a)] = self.find(b)
+
+
+class _LoadState(object):
+    """Data of the registry related to a batch of unique identities.
+
+    The data needed to load a batch is read in bulk when the state is
+    created. Then, the changes made while loading each unique identity
+    are applied to this state and kept in memory, so the next unique
+    identities of the batch see them, until `flush()` writes them with
+    bulk statements.
+
+    Operations that cannot be run in memory, like merging unique
+    identities, must flush the changes first and `refresh()` the
+    state afterwards.
+
+    :param db: database manager
+    :param uidentities: list of unique identities to load
+    """
+    CHUNK_SIZE = 1000
+
+    def __init__(self, db, uidentities):
+        self.db = db
+        self.countries = None
+
+        # Keys of the data to read; they are computed before
+        # loading modifies the unique identities of the batch
+        self._keys = set()
+        self._ids = set()
+        self._org_names = set()
+
+        for uidentity in uidentities:
+            if uidentity.uuid:
+                self._keys.add(uidentity.uuid)
+
+            for identity in uidentity.identities:
+                try:
+                    self._ids.add(utils.uuid(identity.source, email=identity.email,
+                                             name=identity.name,
+                                             username=identity.username))
+                except ValueError:
+                    pass
+
+            self._org_names.update(rol.organization.name
+                                   for rol in uidentity.enrollments
+                                   if rol.organization.name)
+
+        self.refresh()
+
+    def refresh(self):
+        """Read the data related to the batch from the registry"""
+
+        ids = self._ids
+        orgs = list(self._org_names)
+        uuids = set(self._keys)
+
+        with self.db.connect() as session:
+            if self.countries is None:
+                self.countries = {c.code.upper(): c.code
+                                  for c in session.query(Country.code)}
+
+            self._identities = {}
+
+            for chunk in self.__chunks(ids):
+                query = session.query(Identity.id, Identity.uuid).\
+                    filter(Identity.id.in_(chunk))
+                self._identities.update((row.id, row.uuid) for row in query)
+
+            uuids.update(ids)
+            uuids.update(self._identities.values())
+
+            self._uuids = set()
+            self._profiles = {}
+            self._uid_identities = {}
+
+            for chunk in self.__chunks(uuids):
+                query = session.query(UniqueIdentity.uuid).\
+                    filter(UniqueIdentity.uuid.in_(chunk))
+                self._uuids.update(row.uuid for row in query)
+
+            for chunk in self.__chunks(self._uuids):
+                query = session.query(Profile.uuid, Profile.name, Profile.email,
+                                      Profile.gender, Profile.gender_acc,
+                                      Profile.is_bot, Profile.country_code).\
+                    filter(Profile.uuid.in_(chunk))
+
+                for row in query:
+                    self._profiles[row.uuid] = self.__profile_values(row)
+
+                query = session.query(Identity.id, Identity.name, Identity.email,
+                                      Identity.username, Identity.source,
+                                      Identity.uuid).\
+                    filter(Identity.uuid.in_(chunk)).\
+                    order_by(Identity.id)
+
+                for row in query:
+                    self._uid_identities.setdefault(row.uuid, []).append(row)
+
+            self._orgs = {}
+
+            for chunk in self.__chunks(orgs):
+                query = session.query(Organization.id, Organization.name).\
+                    filter(Organization.name.in_(chunk))
+                stored = {row.name.lower(): row.id for row in query}
+
+                for name in chunk:
+                    if name.lower() in stored:
+                        self._orgs[name] = stored[name.lower()]
+
+            # The collation may consider equal names that differ on
+            # more than their case; the registry is asked for them
+            for name in orgs:
+                if name not in self._orgs:
+                    self.__find_organization(name, session=session)
+
+            org_ids = list(set(self._orgs.values()))
+            self._enrollments = {}
+
+            for chunk in self.__chunks(self._uuids if org_ids else []):
+                query = session.query(Enrollment.uuid, Enrollment.start,
+                                      Enrollment.end, Enrollment.organization_id).\
+                    filter(Enrollment.uuid.in_(chunk),
+                           Enrollment.organization_id.in_(org_ids))
+
+                for row in query:
+                    key = (row.uuid, row.organization_id)
+                    self._enrollments.setdefault(key, set()).add((row.start, row.end))
+
+        self._stored_enrollments = {key: set(periods)
+                                    for key, periods in self._enrollments.items()}
+
+        self._new_uidentities = []
+        self._new_identities = []
+        self._edited_profiles = set()
+        self._enrolled = set()
+        self._modified = set()
+
+    def exists(self, uuid):
+        """Check whether a unique identity exists"""
+
+        return uuid in self._uuids
+
+    def has_identity(self, identity_id):
+        """Check whether an identity exists"""
+
+        return identity_id in self._identities
+
+    def identity_uuid(self, identity_id):
+        """Get the unique identity of an identity"""
+
+        return self._identities.get(identity_id, identity_id)
+
+    def profile(self, uuid):
+        """Get the values of the profile of a unique identity"""
+
+        return self._profiles[uuid]
+
+    def identities(self, uuid):
+        """Get the identities of a unique identity sorted by id"""
+
+        return sorted(self._uid_identities.get(uuid, []), key=lambda i: i.id)
+
+    def add_identity(self, identity, uuid=None):
+        """Add an identity to a unique identity.
+
+        When `uuid` is not given, a new unique identity is created
+        for the identity. It returns the identifier of the identity.
+        """
+        try:
+            identity_id = utils.uuid(identity.source, email=identity.email,
+                                     name=identity.name, username=identity.username)
+        except ValueError as e:
+            raise InvalidValueError(e)
+
+        if not uuid and identity_id in self._uuids:
+            raise AlreadyExistsError(entity='UniqueIdentity', eid=identity_id)
+
+        if identity_id in self._identities:
+            raise AlreadyExistsError(entity='Identity', eid=identity_id)
+
+        if not uuid:
+            uuid = identity_id
+            self._uuids.add(uuid)
+            self._profiles[uuid] = self.__profile_values(None)
+            self._new_uidentities.append(uuid)
+
+        row = _IdentityRow(identity_id, identity.name, identity.email,
+                           identity.username, identity.source, uuid)
+
+        self._identities[identity_id] = uuid
+        self._uid_identities.setdefault(uuid, []).append(row)
+        self._new_identities.append(row)
+        self._modified.add(uuid)
+
+        return identity_id
+
+    def edit_profile(self, uuid, **kwargs):
+        """Edit the profile of a unique identity"""
+
+        values = profile_values(None, countries=self.countries, **kwargs)
+
+        self._profiles[uuid].update(values)
+        self._edited_profiles.add(uuid)
+        self._modified.add(uuid)
+
+    def add_organization(self, name):
+        """Add an organization when it does not exist.
+
+        New organizations are added to the registry right away,
+        one by one. Thus, the registry decides whether two names
+        are the same organization.
+        """
+        if name in self._orgs:
+            raise AlreadyExistsError(entity='Organization', eid=name)
+
+        try:
+            api.add_organization(self.db, name)
+        except AlreadyExistsError:
+            self.__find_organization(name)
+            raise
+
+        self.__find_organization(name)
+
+    def enroll(self, uuid, organization, from_date, to_date):
+        """Enroll a unique identity in an organization"""
+
+        try:
+            validate_period(from_date, to_date)
+        except ValueError as e:
+            raise InvalidValueError(e)
+
+        key = (uuid, self._orgs[organization])
+        periods = self._enrollments.setdefault(key, set())
+
+        if (from_date, to_date) in periods:
+            eid = '-'.join((uuid, str(key[1]), str(from_date), str(to_date)))
+            raise AlreadyExistsError(entity='Enrollment', eid=eid)
+
+        periods.add((from_date, to_date))
+        self._enrolled.add(key)
+        self._modified.add(uuid)
+
+    def merge_enrollments(self, uuid, organization):
+        """Merge the overlapping enrollments in an organization"""
+
+        key = (uuid, self._orgs[organization])
+        periods = self._enrollments.get(key, set())
+
+        try:
+            merged = set(utils.merge_date_ranges(sorted(periods)))
+        except ValueError as e:
+            raise InvalidValueError(e)
+
+        if merged != periods:
+            self._enrollments[key] = merged
+            self._enrolled.add(key)
+            self._modified.add(uuid)
+
+    def merge(self, from_uuid, to_uuid):
+        """Merge two unique identities on the registry"""
+
+        self.flush()
+        api.merge_unique_identities(self.db, from_uuid, to_uuid)
+        self.refresh()
+
+    def flush(self):
+        """Write the changes kept in memory"""
+
+        if not self._modified:
+            return
+
+        now = datetime.datetime.utcnow()
+
+        with self.db.connect() as session:
+            self.__write_identities(session, now)
+            self.__write_profiles(session)
+            self.__write_enrollments(session)
+
+            modified = list(self._modified)
+
+            for chunk in self.__chunks(modified):
+                session.query(UniqueIdentity).\
+                    filter(UniqueIdentity.uuid.in_(chunk)).\
+                    update({UniqueIdentity.last_modified: now},
+                           synchronize_session=False)
+
+        for key in self._enrolled:
+            self._stored_enrollments[key] = set(self._enrollments[key])
+
+        self._new_uidentities = []
+        self._new_identities = []
+        self._edited_profiles = set()
+        self._enrolled = set()
+        self._modified = set()
+
+    def __write_identities(self, session, now):
+        if self._new_uidentities:
+            session.execute(UniqueIdentity.__table__.insert(),
+                            [{'uuid': uuid, 'last_modified': now}
+                             for uuid in self._new_uidentities])
+            session.execute(Profile.__table__.insert(),
+                            [{'uuid': uuid, 'is_bot': False}
+                             for uuid in self._new_uidentities])
+            log_changes(session, UIDENTITY_ENTITY, Change.ADD,
+                        [(uuid, uuid) for uuid in self._new_uidentities])
+
+        if self._new_identities:
+            session.execute(Identity.__table__.insert(),
+                            [dict(row._asdict(), last_modified=now)
+                             for row in self._new_identities])
+
+            trigrams = [gram for row in self._new_identities
+                        for gram in identity_trigrams(row)]
+
+            if trigrams:
+                session.execute(IdentityTrigram.__table__.insert(), trigrams)
+
+            log_changes(session, IDENTITY_ENTITY, Change.ADD,
+                        [(row.id, row.uuid) for row in self._new_identities])
+
+    def __write_profiles(self, session):
+        if not self._edited_profiles:
+            return
+
+        stmt = Profile.__table__.update().\
+            where(Profile.__table__.c.uuid == bindparam('_uuid')).\
+            values({col: bindparam(col) for col in PROFILE_COLUMNS})
+
+        session.execute(stmt, [dict(self._profiles[uuid], _uuid=uuid)
+                               for uuid in self._edited_profiles])
+        log_changes(session, PROFILE_ENTITY, Change.UPDATE,
+                    [(uuid, uuid) for uuid in self._edited_profiles])
+
+    def __write_enrollments(self, session):
+        if not self._enrolled:
+            return
+
+        to_delete = []
+        to_insert = []
+
+        for key in self._enrolled:
+            uuid, org_id = key
+            stored = self._stored_enrollments.get(key, set())
+            current = self._enrollments[key]
+
+            to_delete.extend((uuid, org_id, st, en) for st, en in stored - current)
+            to_insert.extend((uuid, org_id, st, en) for st, en in current - stored)
+
+        uuids = list({key[0] for key in self._enrolled})
+
+        if to_delete:
+            rows = self.__enrollment_ids(session, uuids)
+            ids = [(rows[period], period[0]) for period in to_delete]
+
+            for chunk in self.__chunks([eid for eid, _ in ids]):
+                session.query(Enrollment).\
+                    filter(Enrollment.id.in_(chunk)).\
+                    delete(synchronize_session=False)
+
+            log_changes(session, ENROLLMENT_ENTITY, Change.DELETE, ids)
+
+        if to_insert:
+            session.execute(Enrollment.__table__.insert(),
+                            [{'uuid': uuid, 'organization_id': org_id,
+                              'start': st, 'end': en}
+                             for uuid, org_id, st, en in to_insert])
+
+            rows = self.__enrollment_ids(session, uuids)
+            log_changes(session, ENROLLMENT_ENTITY, Change.ADD,
+                        [(rows[period], period[0]) for period in to_insert])
+
+    def __enrollment_ids(self, session, uuids):
+        """Get the ids of the enrollments of some unique identities"""
+
+        rows = {}
+
+        for chunk in self.__chunks(uuids):
+            query = session.query(Enrollment.id, Enrollment.uuid,
+                                  Enrollment.organization_id,
+                                  Enrollment.start, Enrollment.end).\
+                filter(Enrollment.uuid.in_(chunk))
+            rows.update(((row.uuid, row.organization_id, row.start, row.end), row.id)
+                        for row in query)
+
+        return rows
+
+    @staticmethod
+    def __profile_values(row):
+        if row is None:
+            return {col: None if col != 'is_bot' else False
+                    for col in PROFILE_COLUMNS}
+
+        return {col: getattr(row, col) for col in PROFILE_COLUMNS}
+
+    def __find_organization(self, name, session=None):
+        """Find the organization the registry stores for a name"""
+
+        if session is None:
+            with self.db.connect() as session:
+                return self.__find_organization(name, session=session)
+
+        row = session.query(Organization.id).\
+            filter(Organization.name == name).first()
+
+        if row:
+            self._orgs[name] = row.id
 
-        content = infile.read()
-        return content
+    def __chunks(self, values):
+        return _chunks(list(values), self.CHUNK_SIZE)
@@ -105,10 +105,12 @@ class Show(Command):
             else:
                 uidentities = api.unique_identities(self.db)
 
+            enrollments = api.enrollments_by_uuid(self.db,
+                                                  [uid.uuid for uid in uidentities])
+
             for uid in uidentities:
                 # Add enrollments to a new property 'roles'
-                enrollments = api.enrollments(self.db, uid.uuid)
-                uid.roles = enrollments
+                uid.roles = enrollments[uid.uuid]
 
             self.display('show.tmpl', uidentities=uidentities)
         except NotFoundError as e:
@@ -26,7 +26,7 @@ import json
 import os
 
 from .. import api
-from ..command import Command, CMD_SUCCESS, HELP_LIST
+from ..command import Command, CMD_SUCCESS, HELP_LIST, buffered_output
 from ..exceptions import MatcherNotSupportedError
 from ..matcher import create_identity_matcher, match
 from ..matching import SORTINGHAT_IDENTITIES_MATCHERS
@@ -98,6 +98,7 @@ class Unify(Command):
 
         return code
 
+    @buffered_output
     def unify(self, matching=None, sources=None,
               fast_matching=False, no_strict_matching=False,
               interactive=False, recovery=False):
@@ -226,6 +227,9 @@ class Unify(Command):
     def __read_verification(self):
         answer = None
 
+        # Show the match before asking
+        self.flush()
+
         while answer not in ['y', 'Y', 'n', 'N', '']:
             try:
                 answer = input("Merge unique identities [Y/n]? ")
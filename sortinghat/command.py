@@ -19,8 +19,11 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import collections
+import functools
 import logging
 import sys
+import threading
 
 import jinja2
 
@@ -35,12 +38,81 @@ CMD_FAILURE = 1
 # List of various help options
 HELP_LIST = ['-h', '--help']
 
+# Templates that display the result of an operation over
+# a single item, and the summaries shown instead of them
+# when the command runs in quiet mode
+ITEM_TEMPLATES = {
+    'affiliate.tmpl': "%d identities affiliated",
+    'autogender.tmpl': "%d gender profiles updated",
+    'autoprofile.tmpl': "%d profiles updated",
+    'load_blacklist.tmpl': "%d blacklist entries added",
+    'merge.tmpl': "%d unique identities merged"
+}
+
+# Compiled templates are shared by every command
+_environment = None
+
+
+def get_template(name):
+    """Get a compiled template from the templates package"""
+
+    global _environment
+
+    if _environment is None:
+        loader = jinja2.PackageLoader('sortinghat', 'templates')
+        _environment = jinja2.Environment(loader=loader, auto_reload=False,
+                                          lstrip_blocks=True, trim_blocks=True)
+
+    return _environment.get_template(name)
+
+
+def buffered_output(method):
+    """Buffer the output written by a method of a command.
+
+    The buffered output is written when the outermost buffered
+    method returns. In quiet mode, the summary of the items
+    processed is displayed after it.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._buffering += 1
+
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._buffering -= 1
+
+            if not self._buffering:
+                self.flush()
+                self._display_summary()
+
+    return wrapper
+
 
 class Command(object):
-    """Abstract class to run commands"""
+    """Abstract class to run commands.
+
+    The output of methods decorated with `buffered_output` is written
+    on the standard output when the buffer is full, before writing
+    an error or a warning and when the method returns.
+
+    When `quiet` is set, the result of the operations over single
+    items (see `ITEM_TEMPLATES`) is not displayed by buffered methods.
+    A summary with the number of them is displayed instead.
+
+    The output can be written by several threads at the same time.
+    """
+    # Number of characters buffered before writing them
+    OUTPUT_BUFFER_SIZE = 65536
 
     def __init__(self, **kwargs):
         self._kwargs = kwargs
+        self.quiet = kwargs.get('quiet', False)
+        self._buffering = 0
+        self._output = []
+        self._output_size = 0
+        self._items = collections.Counter()
+        self._output_lock = threading.RLock()
 
     @property
     def description(self):
@@ -54,21 +126,60 @@ class Command(object):
         raise NotImplementedError
 
     def display(self, template, **kwargs):
-        loader = jinja2.PackageLoader('sortinghat', 'templates')
-        env = jinja2.Environment(loader=loader,
-                                 lstrip_blocks=True, trim_blocks=True)
+        if self.quiet and self._buffering and template in ITEM_TEMPLATES:
+            with self._output_lock:
+                self._items[template] += 1
+            return
 
-        t = env.get_template(template)
+        t = get_template(template)
         s = t.render(**kwargs)
-        sys.stdout.write(s)
+        self.write(s)
+
+    def write(self, s):
+        """Write a string on the standard output or on its buffer"""
+
+        with self._output_lock:
+            if not self._buffering:
+                sys.stdout.write(s)
+                return
+
+            self._output.append(s)
+            self._output_size += len(s)
+
+            if self._output_size >= self.OUTPUT_BUFFER_SIZE:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered output on the standard output"""
+
+        with self._output_lock:
+            output, self._output = self._output, []
+            self._output_size = 0
+
+            if output:
+                sys.stdout.write(''.join(output))
+                sys.stdout.flush()
 
     def error(self, msg):
         s = "Error: %s\n" % msg
-        sys.stderr.write(s)
+
+        with self._output_lock:
+            self.flush()
+            sys.stderr.write(s)
 
     def warning(self, msg):
         s = "Warning: %s\n" % msg
-        sys.stderr.write(s)
+
+        with self._output_lock:
+            self.flush()
+            sys.stderr.write(s)
+
+    def _display_summary(self):
+        with self._output_lock:
+            items, self._items = self._items, collections.Counter()
+
+        for template in sorted(items):
+            self.write(ITEM_TEMPLATES[template] % items[template] + '\n')
 
     def _set_database(self, **kwargs):
         try:
@@ -22,6 +22,10 @@
 import datetime
 import logging
 
+from sqlalchemy import BigInteger, String, cast, event
+from sqlalchemy.orm import Session
+
+from .cache import changes_logged, find_entity
 from .model import (MAX_PERIOD_DATE,
                     MIN_PERIOD_DATE,
                     UniqueIdentity,
@@ -31,11 +35,22 @@ from .model import (MAX_PERIOD_DATE,
                     Domain,
                     Enrollment,
                     Country,
-                    MatchingBlacklist)
+                    MatchingBlacklist,
+                    RegistryInfo,
+                    Change)
 
 
 logger = logging.getLogger(__name__)
 
+# Types of entities stored in the log of changes
+UIDENTITY_ENTITY = 'uidentity'
+IDENTITY_ENTITY = 'identity'
+PROFILE_ENTITY = 'profile'
+ENROLLMENT_ENTITY = 'enrollment'
+
+# Key of the session info where the changes to store are kept
+PENDING_CHANGES_KEY = 'sortinghat_pending_changes'
+
 
 def find_unique_identity(session, uuid):
     """Find a unique identity.
@@ -50,8 +65,8 @@ def find_unique_identity(session, uuid):
     :returns: a unique identity object; `None` when the unique
         identity does not exist
     """
-    uidentity = session.query(UniqueIdentity). \
-        filter(UniqueIdentity.uuid == uuid).first()
+    uidentity = find_entity(session, UniqueIdentity,
+                            UniqueIdentity.uuid, uuid)
 
     return uidentity
 
@@ -69,8 +84,7 @@ def find_identity(session, id_):
     :returns: an identity object; `None` when the identity
         does not exist
     """
-    identity = session.query(Identity). \
-        filter(Identity.id == id_).first()
+    identity = find_entity(session, Identity, Identity.id, id_)
 
     return identity
 
@@ -88,8 +102,8 @@ def find_organization(session, name):
     :returns: an organization object; `None` when the organization
         does not exist
     """
-    organization = session.query(Organization). \
-        filter(Organization.name == name).first()
+    organization = find_entity(session, Organization,
+                               Organization.name, name)
 
     return organization
 
@@ -107,8 +121,7 @@ def find_domain(session, name):
     :returns: a domain object; `None` when the domain
         does not exist
     """
-    domain = session.query(Domain). \
-        filter(Domain.domain == name).first()
+    domain = find_entity(session, Domain, Domain.domain, name)
 
     return domain
 
@@ -127,8 +140,7 @@ def find_country(session, code):
     :return: a country object; `None` when the country
         does not exist
     """
-    country = session.query(Country).\
-        filter(Country.code == code).first()
+    country = find_entity(session, Country, Country.code, code)
 
     return country
 
@@ -164,6 +176,8 @@ def add_unique_identity(session, uuid):
 
     session.add(uidentity)
 
+    log_change(session, UIDENTITY_ENTITY, uuid, Change.ADD, uuid=uuid)
+
     return uidentity
 
 
@@ -177,6 +191,9 @@ def delete_unique_identity(session, uidentity):
     :param session: database session
     :param uidentity: unique identity to remove
     """
+    log_change(session, UIDENTITY_ENTITY, uidentity.uuid, Change.DELETE,
+               uuid=uidentity.uuid)
+
     session.delete(uidentity)
     session.flush()
 
@@ -227,6 +244,9 @@ def add_identity(session, uidentity, identity_id, source,
 
     session.add(identity)
 
+    log_change(session, IDENTITY_ENTITY, identity_id, Change.ADD,
+               uuid=uidentity.uuid)
+
     return identity
 
 
@@ -243,6 +263,9 @@ def delete_identity(session, identity):
     uidentity = identity.uidentity
     uidentity.last_modified = datetime.datetime.utcnow()
 
+    log_change(session, IDENTITY_ENTITY, identity.id, Change.DELETE,
+               uuid=uidentity.uuid)
+
     session.delete(identity)
     session.flush()
 
@@ -366,6 +389,32 @@ def enroll(session, uidentity, organization,
 
     :return: a new enrollment
 
+    :raises ValeError: when either `from_date` or `to_date` are `None`;
+        when `from_date < MIN_PERIOD_DATE`; or `to_date > MAX_PERIOD_DATE`
+        or `from_date > to_date`.
+    """
+    validate_period(from_date, to_date)
+
+    enrollment = Enrollment(uidentity=uidentity,
+                            organization=organization,
+                            start=from_date, end=to_date)
+    uidentity.last_modified = datetime.datetime.utcnow()
+
+    session.add(enrollment)
+    session.flush()
+
+    log_change(session, ENROLLMENT_ENTITY, enrollment.id, Change.ADD,
+               uuid=uidentity.uuid)
+
+    return enrollment
+
+
+def validate_period(from_date, to_date):
+    """Check the dates of an enrollment period.
+
+    :param from_date: date when the period starts
+    :param to_date: date when the period ends
+
     :raises ValeError: when either `from_date` or `to_date` are `None`;
         when `from_date < MIN_PERIOD_DATE`; or `to_date > MAX_PERIOD_DATE`
         or `from_date > to_date`.
@@ -383,15 +432,6 @@ def enroll(session, uidentity, organization,
         raise ValueError("'from_date' %s cannot be greater than %s"
                          % (from_date, to_date))
 
-    enrollment = Enrollment(uidentity=uidentity,
-                            organization=organization,
-                            start=from_date, end=to_date)
-    uidentity.last_modified = datetime.datetime.utcnow()
-
-    session.add(enrollment)
-
-    return enrollment
-
 
 def withdraw(session, uidentity, organization,
              from_date=MIN_PERIOD_DATE, to_date=MAX_PERIOD_DATE):
@@ -440,6 +480,8 @@ def withdraw(session, uidentity, organization,
     ndeleted = 0
 
     for enrollment in enrollments:
+        log_change(session, ENROLLMENT_ENTITY, enrollment.id, Change.DELETE,
+                   uuid=uidentity.uuid)
         session.delete(enrollment)
         ndeleted += 1
 
@@ -461,6 +503,9 @@ def delete_enrollment(session, enrollment):
     uidentity = enrollment.uidentity
     uidentity.last_modified = datetime.datetime.utcnow()
 
+    log_change(session, ENROLLMENT_ENTITY, enrollment.id, Change.DELETE,
+               uuid=uidentity.uuid)
+
     session.delete(enrollment)
     session.flush()
 
@@ -493,15 +538,51 @@ def edit_profile(session, uidentity, **kwargs):
     :raises ValueError: raised when `is_bot` does not have a boolean value;
         `gender_acc` is not an `int` or is not in range.
     """
+    profile = uidentity.profile
+
+    for attr, value in profile_values(session, **kwargs).items():
+        setattr(profile, attr, value)
+
+    uidentity.last_modified = datetime.datetime.utcnow()
+
+    session.add(profile)
+
+    log_change(session, PROFILE_ENTITY, uidentity.uuid, Change.UPDATE,
+               uuid=uidentity.uuid)
+
+    return profile
+
+
+def profile_values(session, countries=None, **kwargs):
+    """Validate the values to edit on a profile.
+
+    This function checks the parameters accepted by `edit_profile`,
+    returning the values each attribute of the profile will take.
+    Only the attributes related to the given parameters are returned.
+
+    Country codes are looked up in the registry unless a dictionary
+    of `countries` is given. It must map the upper case version of
+    the valid codes to their stored value.
+
+    :param session: database session
+    :param countries: dictionary of valid country codes
+    :param kwargs: parameters to edit the profile
+
+    :return: a dictionary with the new values of the profile
+
+    :raises ValueError: raised when `is_bot` does not have a boolean value;
+        `gender_acc` is not an `int` or is not in range; or the country
+        code is not valid.
+    """
     def to_none_if_empty(x):
         return None if not x else x
 
-    profile = uidentity.profile
+    values = {}
 
     if 'name' in kwargs:
-        profile.name = to_none_if_empty(kwargs['name'])
+        values['name'] = to_none_if_empty(kwargs['name'])
     if 'email' in kwargs:
-        profile.email = to_none_if_empty(kwargs['email'])
+        values['email'] = to_none_if_empty(kwargs['email'])
 
     if 'is_bot' in kwargs:
         is_bot = kwargs['is_bot']
@@ -509,22 +590,24 @@ def edit_profile(session, uidentity, **kwargs):
         if not isinstance(is_bot, bool):
             raise ValueError("'is_bot' must have a boolean value")
 
-        profile.is_bot = is_bot
+        values['is_bot'] = is_bot
 
     if 'country_code' in kwargs:
         code = to_none_if_empty(kwargs['country_code'])
         country_code = None
 
         if code:
-            country = find_country(session, code)
+            if countries is None:
+                country = find_country(session, code)
+                country_code = country.code if country else None
+            else:
+                country_code = countries.get(code.upper(), None)
 
-            if not country:
+            if not country_code:
                 raise ValueError("'country_code' (%s) does not match with a valid code"
                                  % str(code))
 
-            country_code = country.code
-
-        profile.country_code = country_code
+        values['country_code'] = country_code
 
     if 'gender' in kwargs:
         gender = to_none_if_empty(kwargs['gender'])
@@ -539,16 +622,12 @@ def edit_profile(session, uidentity, **kwargs):
                 raise ValueError("'gender_acc' (%d) is not in range (1,100)"
                                  % gender_acc)
 
-        profile.gender = gender
-        profile.gender_acc = gender_acc
+        values['gender'] = gender
+        values['gender_acc'] = gender_acc
     elif 'gender_acc' in kwargs:
         raise ValueError("'gender_acc' can only be set when 'gender' is given")
 
-    uidentity.last_modified = datetime.datetime.utcnow()
-
-    session.add(profile)
-
-    return profile
+    return values
 
 
 def move_identity(session, identity, uidentity):
@@ -584,6 +663,9 @@ def move_identity(session, identity, uidentity):
     session.add(uidentity)
     session.add(old_uidentity)
 
+    log_change(session, IDENTITY_ENTITY, identity.id, Change.UPDATE,
+               uuid=uidentity.uuid)
+
     return True
 
 
@@ -619,9 +701,127 @@ def move_enrollment(session, enrollment, uidentity):
     session.add(uidentity)
     session.add(old_uidentity)
 
+    log_change(session, ENROLLMENT_ENTITY, enrollment.id, Change.UPDATE,
+               uuid=uidentity.uuid)
+
     return True
 
 
+def log_change(session, entity, eid, action, uuid=None):
+    """Log a change on the registry.
+
+    This function adds a new entry to the log of changes of the
+    registry. The entry is stored when the transaction of the
+    session commits, so it is discarded when the transaction is
+    rolled back. Its sequence number is assigned at that moment
+    too. See `store_pending_changes()` for more details.
+
+    :param session: database session
+    :param entity: type of the modified entity
+    :param eid: identifier of the modified entity
+    :param action: type of change; one of `Change.ADD`,
+        `Change.UPDATE` or `Change.DELETE`
+    :param uuid: unique identity related to the modified entity
+
+    :return: a new change
+    """
+    change = Change(entity=entity, eid=str(eid),
+                    uuid=uuid, action=action,
+                    timestamp=datetime.datetime.utcnow())
+
+    pending = session.info.setdefault(PENDING_CHANGES_KEY, [])
+    pending.append(change)
+
+    changes_logged(session, entity, action, [uuid])
+
+    return change
+
+
+def log_changes(session, entity, action, entries):
+    """Log a set of changes on the registry at once.
+
+    This function is intended for those operations that modify
+    the registry using bulk statements. Like `log_change()`, entries
+    are stored when the transaction of the session commits, using
+    a single insertion.
+
+    :param session: database session
+    :param entity: type of the modified entities
+    :param action: type of change; one of `Change.ADD`,
+        `Change.UPDATE` or `Change.DELETE`
+    :param entries: list of `(eid, uuid)` tuples with the identifiers
+        of the modified entities and their related unique identities
+    """
+    if not entries:
+        return
+
+    timestamp = datetime.datetime.utcnow()
+
+    pending = session.info.setdefault(PENDING_CHANGES_KEY, [])
+    pending.extend(Change(entity=entity, eid=str(eid), uuid=uuid,
+                          action=action, timestamp=timestamp)
+                   for eid, uuid in entries)
+
+    changes_logged(session, entity, action, {uuid for _, uuid in entries})
+
+
+def store_pending_changes(session):
+    """Store the changes logged during the transaction of a session.
+
+    Sequence numbers are taken from a counter stored in the registry.
+    Its row stays locked until the transaction commits, so concurrent
+    transactions that logged changes commit one after the other, in
+    the same order as their sequence numbers. Thus, once a change is
+    visible, every change with a lower number is visible too.
+
+    This function is called before any commit; there is no need
+    to call it directly.
+
+    :param session: database session
+    """
+    pending = session.info.pop(PENDING_CHANGES_KEY, None)
+
+    if not pending:
+        return
+
+    # Updating the counter first locks it on every backend
+    table = RegistryInfo.__table__
+    value = cast(cast(table.c.value, BigInteger) + len(pending), String)
+
+    session.execute(table.update().
+                    where(table.c.name == RegistryInfo.CHANGES_SEQ).
+                    values(value=value))
+
+    counter = session.query(RegistryInfo).\
+        filter(RegistryInfo.name == RegistryInfo.CHANGES_SEQ).\
+        with_for_update().populate_existing().one()
+    seq = int(counter.value) - len(pending)
+
+    changes = []
+
+    for change in pending:
+        seq += 1
+        changes.append({'seq': seq,
+                        'entity': change.entity,
+                        'eid': change.eid,
+                        'uuid': change.uuid,
+                        'action': change.action,
+                        'timestamp': change.timestamp})
+        change.seq = seq
+
+    session.execute(Change.__table__.insert(), changes)
+
+
+@event.listens_for(Session, 'before_commit')
+def _transaction_committing(session):
+    store_pending_changes(session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _transaction_rolled_back(session, previous_transaction):
+    session.info.pop(PENDING_CHANGES_KEY, None)
+
+
 def add_to_matching_blacklist(session, term):
     """Add term to the matching blacklist.
 
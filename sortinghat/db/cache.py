@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#         Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import collections
+import threading
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached, object_mapper, object_session
+from sqlalchemy.orm.util import identity_key
+
+from ..utils import DomainTrie
+from .model import UniqueIdentity, Identity, Organization, Domain, Country, Change
+
+
+# Tries of top domains, one per engine
+_top_domains = weakref.WeakKeyDictionary()
+_domains_generation = 0
+_lock = threading.Lock()
+
+INVALIDATE_DOMAINS_KEY = 'sortinghat_invalidate_domains'
+READ_ONLY_SESSION_KEY = 'sortinghat_read_only'
+
+
+def top_domains_trie(session):
+    """Get the trie of top domains of the registry.
+
+    The trie is built the first time this function is called for
+    the engine bound to the session. Next calls will reuse it until
+    the table of domains is modified.
+
+    :param session: database session
+
+    :returns: a `DomainTrie` object with the top domains
+    """
+    engine = session.get_bind()
+
+    with _lock:
+        trie = _top_domains.get(engine, None)
+        generation = _domains_generation
+
+    if trie is not None:
+        return trie
+
+    query = session.query(Domain.domain).\
+        filter(Domain.is_top_domain)
+
+    trie = DomainTrie(dom.domain for dom in query)
+
+    # Do not store the trie when the domains were modified
+    # while it was being built
+    with _lock:
+        if _domains_generation == generation:
+            _top_domains[engine] = trie
+
+    return trie
+
+
+def invalidate_domains():
+    """Remove the cached top domains.
+
+    Tries of every engine are removed, as read-only engines
+    replicate the changes written on the primary one.
+    """
+    global _domains_generation
+
+    with _lock:
+        _top_domains.clear()
+        _domains_generation += 1
+
+
+@event.listens_for(Domain, 'after_insert')
+@event.listens_for(Domain, 'after_update')
+@event.listens_for(Domain, 'after_delete')
+def _domain_modified(mapper, connection, target):
+    invalidate_domains()
+
+    # Invalidate again once the transaction ends to discard
+    # the tries built by other sessions in the meantime
+    session = object_session(target)
+
+    if session is not None:
+        session.info[INVALIDATE_DOMAINS_KEY] = True
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _transaction_finished(session, *args):
+    if session.info.pop(INVALIDATE_DOMAINS_KEY, False):
+        invalidate_domains()
+
+
+# Entities cache
+
+DEFAULT_CACHE_SIZE = 10000
+
+STAGED_ENTITIES_KEY = 'sortinghat_staged_entities'
+INVALIDATED_ENTITIES_KEY = 'sortinghat_invalidated_entities'
+
+CACHED_MODELS = (UniqueIdentity, Identity, Organization, Domain, Country)
+
+_entities_cache = None
+
+
+class EntitiesCache(object):
+    """LRU cache of entities of the registry.
+
+    Entities are stored as dictionaries of column values, indexed by
+    the model and the column used to find them. The cache is bounded
+    to `max_size` entries; the least recently used entries are removed
+    first when it is full.
+
+    Any invalidation increases the generation of the cache. Values read
+    on a previous generation may be outdated, so they are not stored.
+
+    :param max_size: maximum number of entries
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        if max_size < 1:
+            raise ValueError("'max_size' must be greater than 0")
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._keys = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get the values stored under a key; `None` when not found"""
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        return entry[1]
+
+    def put(self, key, pk, values, generation):
+        """Store the values of an entity read on the given generation"""
+
+        with self._lock:
+            if generation != self.generation:
+                return
+
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (pk, values)
+            self._keys.setdefault((key[0], pk), set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, model, pk):
+        """Remove the entries of an entity"""
+
+        with self._lock:
+            self.generation += 1
+
+            for key in self._keys.pop((model, pk), set()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry"""
+
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def stats(self):
+        """Return the size and the number of hits and misses"""
+
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key):
+        pk, _ = self._entries.pop(key)
+        keys = self._keys.get((key[0], pk), None)
+
+        if keys is not None:
+            keys.discard(key)
+
+            if not keys:
+                del self._keys[(key[0], pk)]
+
+
+def enable_entities_cache(max_size=DEFAULT_CACHE_SIZE):
+    """Enable the process-wide cache of entities.
+
+    Once enabled, the `find_*` functions will look for the entities
+    on the cache before querying the database. Entities are stored
+    on the cache once the transaction that read them is committed
+    and they are removed when they are modified or deleted through
+    any session of this process.
+
+    :param max_size: maximum number of entities to store
+
+    :returns: the new cache
+    """
+    global _entities_cache
+
+    _entities_cache = EntitiesCache(max_size=max_size)
+
+    return _entities_cache
+
+
+def disable_entities_cache():
+    """Disable the process-wide cache of entities"""
+
+    global _entities_cache
+
+    _entities_cache = None
+
+
+def entities_cache():
+    """Return the process-wide cache of entities; `None` when disabled"""
+
+    return _entities_cache
+
+
+def clear_entities_cache():
+    """Remove every entity from the cache, when it is enabled"""
+
+    cache = _entities_cache
+
+    if cache is not None:
+        cache.clear()
+
+
+def find_entity(session, model, column, value):
+    """Find an entity by the value of one of its columns.
+
+    When the cache is enabled, the entity is looked up there first.
+    Cached entities are attached to the session without querying
+    the database.
+
+    :param session: database session
+    :param model: model of the entity
+    :param column: column to filter by
+    :param value: value of the column
+
+    :returns: the entity; `None` when it does not exist
+    """
+    cache = _entities_cache
+    query = session.query(model).filter(column == value)
+
+    if cache is None:
+        return query.first()
+
+    key = (model, column.key, value)
+    values = cache.get(key)
+
+    if values is not None:
+        return _attach_entity(session, model, values)
+
+    generation = cache.generation
+    entity = query.first()
+
+    # Entities read from replicas might be outdated
+    if entity is not None and not session.info.get(READ_ONLY_SESSION_KEY, False):
+        mapper = object_mapper(entity)
+        pk = mapper.primary_key_from_instance(entity)[0]
+        values = {attr.key: getattr(entity, attr.key)
+                  for attr in mapper.column_attrs}
+
+        # Entities are cached only when the transaction succeeds
+        staged = session.info.setdefault(STAGED_ENTITIES_KEY, [])
+        staged.append((key, pk, values, generation))
+
+    return entity
+
+
+def _attach_entity(session, model, values):
+    """Attach a cached entity to the session"""
+
+    pk = values[model.__mapper__.primary_key[0].key]
+    entity = session.identity_map.get(identity_key(model, pk), None)
+
+    # Do not overwrite the state of the entities of the session
+    if entity is not None:
+        return entity
+
+    # Bypass the constructor of the model, which may not
+    # accept every column as a parameter
+    entity = model.__mapper__.class_manager.new_instance()
+
+    for attr, value in values.items():
+        setattr(entity, attr, value)
+
+    make_transient_to_detached(entity)
+
+    return session.merge(entity, load=False)
+
+
+def _invalidate_entity(target, cascade=False):
+    cache = _entities_cache
+
+    if cache is None:
+        return
+
+    # Deletions may cascade to other entities on the
+    # database, so the whole cache is invalidated
+    if cascade:
+        model, pk = None, None
+        cache.clear()
+    else:
+        model = type(target)
+        pk = object_mapper(target).primary_key_from_instance(target)[0]
+        cache.invalidate(model, pk)
+
+    # Invalidate again once the transaction ends to discard
+    # the values read by other sessions in the meantime
+    session = object_session(target)
+
+    if session is not None:
+        invalidated = session.info.setdefault(INVALIDATED_ENTITIES_KEY, set())
+        invalidated.add((model, pk))
+
+
+def _entity_updated(mapper, connection, target):
+    # Changes on relationships do not modify the cached values
+    session = object_session(target)
+
+    if session is not None and not session.is_modified(target, include_collections=False):
+        return
+
+    _invalidate_entity(target)
+
+
+def _entity_deleted(mapper, connection, target):
+    _invalidate_entity(target, cascade=True)
+
+
+for _model in CACHED_MODELS:
+    event.listen(_model, 'after_update', _entity_updated)
+    event.listen(_model, 'after_delete', _entity_deleted)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _bulk_operation(context):
+    clear_entities_cache()
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_entities(session):
+    staged = session.info.pop(STAGED_ENTITIES_KEY, [])
+    invalidated = session.info.pop(INVALIDATED_ENTITIES_KEY, set())
+
+    cache = _entities_cache
+
+    if cache is None:
+        return
+
+    for model, pk in invalidated:
+        if model is None:
+            cache.clear()
+        else:
+            cache.invalidate(model, pk)
+
+    for key, pk, values, generation in staged:
+        cache.put(key, pk, values, generation)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_entities(session, previous_transaction):
+    session.info.pop(STAGED_ENTITIES_KEY, None)
+    session.info.pop(INVALIDATED_ENTITIES_KEY, None)
+
+
+# Affiliations cache
+
+INVALIDATED_AFFILIATIONS_KEY = 'sortinghat_invalidated_affiliations'
+
+AFFILIATIONS_KEY = 'affiliations'
+
+_affiliations_cache = None
+
+
+def enable_affiliations_cache(max_size=DEFAULT_CACHE_SIZE):
+    """Enable the process-wide cache of affiliations.
+
+    The cache stores the enrollment periods of unique identities,
+    indexed by their uuid. Entries are removed when any change on
+    the enrollments of a unique identity is logged by a session
+    of this process.
+
+    :param max_size: maximum number of unique identities to store
+
+    :returns: the new cache
+    """
+    global _affiliations_cache
+
+    _affiliations_cache = EntitiesCache(max_size=max_size)
+
+    return _affiliations_cache
+
+
+def disable_affiliations_cache():
+    """Disable the process-wide cache of affiliations"""
+
+    global _affiliations_cache
+
+    _affiliations_cache = None
+
+
+def affiliations_cache():
+    """Return the process-wide cache of affiliations; `None` when disabled"""
+
+    return _affiliations_cache
+
+
+def clear_affiliations_cache():
+    """Remove every affiliation from the cache, when it is enabled"""
+
+    cache = _affiliations_cache
+
+    if cache is not None:
+        cache.clear()
+
+
+def get_affiliations(uuid):
+    """Get the cached affiliations of a unique identity.
+
+    :param uuid: unique identifier
+
+    :returns: a tuple with the values stored for the unique
+        identity; `None` when they are not cached
+    """
+    cache = _affiliations_cache
+
+    if cache is None:
+        return None
+
+    return cache.get((AFFILIATIONS_KEY, uuid))
+
+
+def put_affiliations(uuid, values, generation):
+    """Store the affiliations of a unique identity read on a generation"""
+
+    cache = _affiliations_cache
+
+    if cache is not None:
+        cache.put((AFFILIATIONS_KEY, uuid), uuid, values, generation)
+
+
+def invalidate_affiliations(session, uuids):
+    """Remove the cached affiliations of some unique identities.
+
+    When `uuids` is `None`, the whole cache is invalidated.
+
+    :param session: session that modified the affiliations
+    :param uuids: list of unique identifiers
+    """
+    cache = _affiliations_cache
+
+    if cache is None:
+        return
+
+    if uuids is None:
+        cache.clear()
+    else:
+        for uuid in uuids:
+            cache.invalidate(AFFILIATIONS_KEY, uuid)
+
+    # Invalidate again once the transaction ends to discard
+    # the values read by other sessions in the meantime
+    if session is not None:
+        invalidated = session.info.setdefault(INVALIDATED_AFFILIATIONS_KEY, set())
+
+        if uuids is None:
+            invalidated.add(None)
+        else:
+            invalidated.update(uuids)
+
+
+def changes_logged(session, entity, action, uuids):
+    """Invalidate the affiliations modified by a set of logged changes.
+
+    :param session: session that logged the changes
+    :param entity: type of the modified entities
+    :param action: type of change
+    :param uuids: unique identities related to the changes
+    """
+    if entity not in ('uidentity', 'enrollment'):
+        return
+
+    # Moved enrollments modify the affiliations of two
+    # unique identities but only the new one is logged
+    if entity == 'enrollment' and action == Change.UPDATE:
+        uuids = None
+
+    invalidate_affiliations(session, uuids)
+
+
+@event.listens_for(Organization, 'after_delete')
+def _organization_deleted(mapper, connection, target):
+    invalidate_affiliations(object_session(target), None)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_soft_rollback')
+def _affiliations_transaction_finished(session, *args):
+    invalidated = session.info.pop(INVALIDATED_AFFILIATIONS_KEY, None)
+
+    if not invalidated:
+        return
+
+    if None in invalidated:
+        invalidate_affiliations(None, None)
+    else:
+        invalidate_affiliations(None, invalidated)
@@ -20,24 +20,31 @@
 #
 
 import re
+import threading
 
 from contextlib import contextmanager
 import logging
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, inspect
 from sqlalchemy.exc import OperationalError, ProgrammingError, InternalError, IntegrityError
-from sqlalchemy.engine.url import URL
+from sqlalchemy.engine.url import URL, make_url
 from sqlalchemy.orm import mapper, sessionmaker
 from sqlalchemy.orm.exc import FlushError
 from sqlalchemy.pool import QueuePool
 from sqlalchemy.schema import MetaData
 
 from sortinghat.exceptions import DatabaseError, DatabaseExists, AlreadyExistsError
-from sortinghat.db.model import ModelBase
+from sortinghat.db.cache import READ_ONLY_SESSION_KEY, clear_affiliations_cache, \
+    clear_entities_cache, invalidate_domains
+from sortinghat.db.model import ModelBase, UniqueIdentity, Identity, IdentityTrigram, \
+    RegistryInfo, Change, identity_trigrams
 
 
 logger = logging.getLogger(__name__)
 
+# Number of connections kept by the pool of each engine
+POOL_SIZE = 25
+
 
 class Database(object):
 
@@ -50,7 +57,8 @@ class Database(object):
     MYSQL_FLUSH_ERROR_REGEX = re.compile(
         r"New instance <(?P<entity>.+) at .+<class '.+'>, \('(?P<eid>.+)',.+\)\sconflicts")
 
-    def __init__(self, user, password, database, host='localhost', port='3306'):
+    def __init__(self, user, password, database, host='localhost', port='3306',
+                 read_only_url=None):
         self._engine = self.build_engine(user, password, database, host, port)
         self._Session = sessionmaker(bind=self._engine)
 
@@ -59,9 +67,31 @@ class Database(object):
         except OperationalError as e:
             raise DatabaseError(error=e.orig.args[1], code=e.orig.args[0])
 
+        # Engine for read-only operations, usually a replica
+        if read_only_url:
+            self._ro_engine = self.build_read_only_engine(read_only_url)
+            self._ro_Session = sessionmaker(bind=self._ro_engine)
+        else:
+            self._ro_engine = None
+            self._ro_Session = None
+
+        self._local = threading.local()
+
     @contextmanager
-    def connect(self):
-        session = self._Session()
+    def connect(self, read_only=False):
+        """Open a new session with the database.
+
+        When `read_only` is set and a read-only engine is available,
+        the session will be bound to that engine unless reads from
+        the primary were requested with `read_from_primary()`.
+
+        :param read_only: the session is only used to read data
+        """
+        if read_only and self._ro_Session and not self.reading_from_primary:
+            session = self._ro_Session()
+            session.info[READ_ONLY_SESSION_KEY] = True
+        else:
+            session = self._Session()
 
         try:
             yield session
@@ -71,14 +101,42 @@ class Database(object):
         finally:
             session.close()
 
+    @property
+    def reading_from_primary(self):
+        """Whether read-only sessions are bound to the primary on this thread"""
+
+        return getattr(self._local, 'primary', 0) > 0
+
+    @contextmanager
+    def read_from_primary(self):
+        """Bind the read-only sessions of this thread to the primary.
+
+        Use this context manager to read data written before, which
+        may not be available on the read-only engine yet.
+        """
+        self._local.primary = getattr(self._local, 'primary', 0) + 1
+
+        try:
+            yield self
+        finally:
+            self._local.primary -= 1
+
     def clear(self):
         session = self._Session()
 
         for table in reversed(ModelBase.metadata.sorted_tables):
+            # Information about the registry is still valid
+            if table is RegistryInfo.__table__:
+                continue
+
             session.execute(table.delete())
             session.commit()
         session.close()
 
+        invalidate_domains()
+        clear_entities_cache()
+        clear_affiliations_cache()
+
     @classmethod
     def create(cls, user, password, database, host='localhost', port='3306'):
         engine = cls.build_engine(user, password, None, host, port)
@@ -112,6 +170,13 @@ class Database(object):
         except OperationalError as e:
             raise DatabaseError(error=e.orig.args[1], code=e.orig.args[0])
 
+    @classmethod
+    def build_read_only_engine(cls, url):
+        try:
+            return create_read_only_engine(url)
+        except OperationalError as e:
+            raise DatabaseError(error=e.orig.args[1], code=e.orig.args[0])
+
     @classmethod
     def handle_database_error(cls, session, exception):
         """Rollback changes made and handle any type of error raised by the DBMS."""
@@ -169,6 +234,85 @@ class Database(object):
     def __create_schema(self, engine):
         ModelBase.metadata.create_all(engine)
 
+        # Registries created with older versions, or indexed with
+        # another version of the trigrams, need to index the
+        # identities they already store
+        if self.__trigrams_version() != IdentityTrigram.VERSION:
+            self.__index_identities(engine)
+
+        self.__create_missing_indexes(engine)
+        self.__create_changes_counter()
+
+    def __create_missing_indexes(self, engine):
+        """Create the indexes added to tables that already existed"""
+
+        inspector = inspect(engine)
+
+        for table in (UniqueIdentity.__table__, Identity.__table__):
+            names = {index['name'] for index in inspector.get_indexes(table.name)}
+
+            for index in table.indexes:
+                if index.name not in names:
+                    index.create(engine)
+
+    def __create_changes_counter(self):
+        """Create the counter that assigns sequence numbers to changes"""
+
+        session = self._Session()
+
+        try:
+            found = session.query(RegistryInfo).\
+                filter(RegistryInfo.name == RegistryInfo.CHANGES_SEQ).first()
+
+            if found:
+                return
+
+            last = session.query(func.max(Change.seq)).scalar() or 0
+            session.add(RegistryInfo(name=RegistryInfo.CHANGES_SEQ,
+                                     value=str(last)))
+            session.commit()
+        except IntegrityError:
+            # Created by another process in the meantime
+            session.rollback()
+        finally:
+            session.close()
+
+    def __trigrams_version(self):
+        session = self._Session()
+
+        try:
+            info = session.query(RegistryInfo).\
+                filter(RegistryInfo.name == RegistryInfo.TRIGRAMS_VERSION).first()
+            return info.value if info else None
+        finally:
+            session.close()
+
+    def __index_identities(self, engine, chunk_size=1000):
+        session = self._Session()
+
+        try:
+            session.query(IdentityTrigram).delete(synchronize_session=False)
+
+            rows = []
+            query = session.query(Identity.id, Identity.name, Identity.email,
+                                  Identity.username, Identity.source)
+
+            for identity in query.yield_per(chunk_size):
+                rows.extend(identity_trigrams(identity))
+
+                if len(rows) >= chunk_size:
+                    session.execute(IdentityTrigram.__table__.insert(), rows)
+                    rows = []
+
+            if rows:
+                session.execute(IdentityTrigram.__table__.insert(), rows)
+
+            session.merge(RegistryInfo(name=RegistryInfo.TRIGRAMS_VERSION,
+                                       value=IdentityTrigram.VERSION))
+            session.commit()
+        finally:
+            session.close()
+
 
 def create_database_engine(user, password, database, host, port):
     """Create a database engine"""
@@ -185,7 +329,7 @@ def create_database_engine(user, password, database, host, port):
     #
     engine_params = {
         'poolclass': QueuePool,
-        'pool_size': 25,
+        'pool_size': POOL_SIZE,
         'pool_pre_ping': True,
         'echo': False,
         'connect_args': {
@@ -208,6 +352,26 @@ def create_database_engine(user, password, database, host, port):
     return engine
 
 
+def create_read_only_engine(url):
+    """Create a database engine for read-only operations"""
+
+    url = make_url(url)
+
+    engine_params = {
+        'pool_pre_ping': True,
+        'echo': False
+    }
+
+    if url.get_backend_name() == 'mysql':
+        engine_params['poolclass'] = QueuePool
+        engine_params['pool_size'] = POOL_SIZE
+
+    engine = create_engine(url, **engine_params)
+    engine.connect().close()
+
+    return engine
+
+
 def create_database_session(engine):
     """Connect to the database"""
 
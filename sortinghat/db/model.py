@@ -22,8 +22,8 @@
 import datetime
 import logging
 
-from sqlalchemy import Column, Integer, String, DateTime,\
-    ForeignKey, UniqueConstraint
+from sqlalchemy import BigInteger, Column, Integer, String, DateTime,\
+    ForeignKey, UniqueConstraint, VARBINARY, event
 from sqlalchemy.dialects.mysql import DATETIME
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.ext.associationproxy import association_proxy
@@ -60,7 +60,7 @@ class Organization(ModelBase):
     domains = relationship('Domain', backref='organizations',
                            order_by='Domain.domain',
                            collection_class=ordering_list('domain'),
-                           lazy='joined', cascade="save-update, merge, delete")
+                           cascade="save-update, merge, delete")
 
     # Enrollment relationships
     enrollments = association_proxy('enrollments', 'uidentities')
@@ -87,8 +87,7 @@ class Domain(ModelBase):
                              nullable=False)
 
     # Many-to-One relationship
-    organization = relationship("Organization", backref='domains_organizations',
-                                lazy='joined')
+    organization = relationship("Organization", backref='domains_organizations')
 
     __table_args__ = (UniqueConstraint('domain', name='_domain_unique'),
                       MYSQL_CHARSET)
@@ -130,16 +129,17 @@ class UniqueIdentity(ModelBase):
 
     uuid = Column(String(128), primary_key=True)
     last_modified = Column(DATETIME(fsp=6),
-                           default=datetime.datetime.utcnow(),
-                           onupdate=datetime.datetime.utcnow())
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow,
+                           index=True)
 
     # One to one relationship
     profile = relationship('Profile', backref='uidentities', uselist=False,
-                           lazy='joined', cascade="save-update, merge, delete")
+                           cascade="save-update, merge, delete")
 
     # One-to-Many relationship
     identities = relationship('Identity', backref='uidentities',
-                              lazy='joined', cascade="save-update, merge, delete")
+                              cascade="save-update, merge, delete")
 
     # Many-to-many association proxy
     organizations = association_proxy('enrollments', 'organizations')
@@ -172,12 +172,12 @@ class Identity(ModelBase):
     uuid = Column(String(128),
                   ForeignKey('uidentities.uuid', ondelete='CASCADE'))
     last_modified = Column(DATETIME(fsp=6),
-                           default=datetime.datetime.utcnow(),
-                           onupdate=datetime.datetime.utcnow())
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow,
+                           index=True)
 
     # Many-to-One relationship
-    uidentity = relationship('UniqueIdentity', backref='uuid_identy',
-                             lazy='joined')
+    uidentity = relationship('UniqueIdentity', backref='uuid_identy')
 
     __table_args__ = (UniqueConstraint('name', 'email', 'username', 'source',
                                        name='_identity_unique'),
@@ -194,6 +194,100 @@ class Identity(ModelBase):
                 }
 
 
+class IdentityTrigram(ModelBase):
+    __tablename__ = 'identities_trigrams'
+
+    # Identities with values that cannot be matched using their
+    # trigrams are stored with this mark, which is not a trigram
+    UNINDEXED = b'\x00'
+
+    # Version of the way trigrams are calculated. Identities are
+    # indexed again when the registry was indexed with another one.
+    VERSION = '2'
+
+    # Trigrams are stored as binary strings to avoid collations
+    # considering equal two different trigrams
+    trigram = Column(VARBINARY(12), primary_key=True)
+    identity_id = Column(String(128),
+                         ForeignKey('identities.id', ondelete='CASCADE'),
+                         primary_key=True)
+
+    __table_args__ = (MYSQL_CHARSET)
+
+
+class RegistryInfo(ModelBase):
+    __tablename__ = 'registry_info'
+
+    TRIGRAMS_VERSION = 'trigrams_version'
+    CHANGES_SEQ = 'changes_seq'
+
+    name = Column(String(32), primary_key=True)
+    value = Column(String(128), nullable=True)
+
+    __table_args__ = (MYSQL_CHARSET)
+
+
+class Change(ModelBase):
+    __tablename__ = 'changes'
+
+    ADD = 'add'
+    UPDATE = 'update'
+    DELETE = 'delete'
+
+    # Assigned when the transaction that logged the change commits
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'),
+                 primary_key=True, autoincrement=False)
+    entity = Column(String(32), nullable=False)
+    eid = Column(String(128), nullable=False)
+    uuid = Column(String(128), nullable=True)
+    action = Column(String(16), nullable=False)
+    timestamp = Column(DATETIME(fsp=6), nullable=False,
+                       default=datetime.datetime.utcnow)
+
+    __table_args__ = (MYSQL_CHARSET)
+
+    def to_dict(self):
+        return {
+                'seq': self.seq,
+                'entity': self.entity,
+                'eid': self.eid,
+                'uuid': self.uuid,
+                'action': self.action,
+                'timestamp': self.timestamp
+                }
+
+    def __repr__(self):
+        return "%s - %s %s %s" % (self.seq, self.action, self.entity, self.eid)
+
+
+def identity_trigrams(identity):
+    """Get the trigrams of the data of an identity"""
+
+    from ..utils import is_trigram_indexable, trigrams
+
+    grams = set()
+
+    for value in (identity.name, identity.email,
+                  identity.username, identity.source):
+        grams |= trigrams(value)
+
+        if not is_trigram_indexable(value):
+            grams.add(IdentityTrigram.UNINDEXED)
+
+    return [{'trigram': gram, 'identity_id': identity.id}
+            for gram in grams]
+
+
+@event.listens_for(Identity, 'after_insert')
+def index_identity(mapper, connection, target):
+    """Store the trigrams of a new identity"""
+
+    rows = identity_trigrams(target)
+
+    if rows:
+        connection.execute(IdentityTrigram.__table__.insert(), rows)
+
+
 class Profile(ModelBase):
     __tablename__ = 'profiles'
 
@@ -208,8 +302,7 @@ class Profile(ModelBase):
     country_code = Column(String(2),
                           ForeignKey('countries.code', ondelete='CASCADE'))
 
-    country = relationship('Country', backref='profile_country',
-                           lazy='joined')
+    country = relationship('Country', backref='profile_country')
 
     __table_args__ = (MYSQL_CHARSET)
 
@@ -245,14 +338,12 @@ class Enrollment(ModelBase):
     # Bidirectional attribute/collection of "upeople"/"enrollments"
     uidentity = relationship(UniqueIdentity,
                              backref=backref('enrollments',
-                                             cascade="all, delete-orphan"),
-                             lazy='joined')
+                                             cascade="all, delete-orphan"))
 
     # Reference to the "Organization" object
     organization = relationship(Organization,
                                 backref=backref('enrollments',
-                                                cascade="all, delete-orphan"),
-                                lazy='joined')
+                                                cascade="all, delete-orphan"))
 
     __table_args__ = (UniqueConstraint('uuid', 'organization_id',
                                        'start', 'end',
@@ -19,6 +19,7 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import functools
 import logging
 
 
@@ -56,6 +57,11 @@ class BaseError(Exception):
     def __int__(self):
         return self.code
 
+    def __reduce__(self):
+        # Errors are built with keyword arguments, so they
+        # are needed to rebuild the error when it is unpickled
+        return functools.partial(self.__class__, **self.args[0]), ()
+
 
 class AlreadyExistsError(BaseError):
     """Exception raised when an entity already exists in the registry"""
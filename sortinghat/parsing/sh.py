@@ -19,7 +19,11 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import hashlib
+import io
+import json
 import logging
+import re
 
 from ..db.model import UniqueIdentity, Identity, Profile,\
     Enrollment, Organization, Domain, Country, MatchingBlacklist
@@ -55,6 +59,18 @@ class SortingHatParser(object):
         self._identities = []
         self._organizations = {}
         self.__parse(stream)
+        self._stream = stream
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """SHA-1 hash of the contents of the stream"""
+
+        if self._fingerprint is None:
+            data = self._stream.encode('utf-8', 'surrogatepass')
+            self._fingerprint = hashlib.sha1(data).hexdigest()
+
+        return self._fingerprint
 
     @property
     def blacklist(self):
@@ -108,11 +124,7 @@ class SortingHatParser(object):
         """
         try:
             for entry in json['blacklist']:
-                if not entry:
-                    msg = "invalid json format. Blacklist entries cannot be null or empty"
-                    raise InvalidFormatError(cause=msg)
-
-                excluded = self.__encode(entry)
+                excluded = _parse_blacklist_entry(entry)
 
                 bl = self._blacklist.get(excluded, None)
 
@@ -195,85 +207,7 @@ class SortingHatParser(object):
         """
         try:
             for uidentity in json['uidentities'].values():
-                uuid = self.__encode(uidentity['uuid'])
-
-                uid = UniqueIdentity(uuid=uuid)
-
-                if uidentity['profile']:
-                    profile = uidentity['profile']
-
-                    if type(profile['is_bot']) != bool:
-                        msg = "invalid json format. 'is_bot' must have a bool value"
-                        raise InvalidFormatError(cause=msg)
-
-                    is_bot = profile['is_bot']
-
-                    gender = profile.get('gender', None)
-
-                    if gender is not None:
-                        gender = self.__encode(gender)
-
-                    gender_acc = profile.get('gender_acc', None)
-
-                    if gender_acc is not None:
-                        if type(gender_acc) != int:
-                            msg = "invalid json format. 'gender_acc' must have an integer value"
-                            raise InvalidFormatError(cause=msg)
-                        elif not 0 <= gender_acc <= 100:
-                            msg = "invalid json format. 'gender_acc' is not in range (0,100)"
-                            raise InvalidFormatError(cause=msg)
-
-                    name = self.__encode(profile['name'])
-                    email = self.__encode(profile['email'])
-
-                    prf = Profile(uuid=uuid, name=name, email=email,
-                                  gender=gender, gender_acc=gender_acc,
-                                  is_bot=is_bot)
-
-                    if profile['country']:
-                        alpha3 = self.__encode(profile['country']['alpha3'])
-                        code = self.__encode(profile['country']['code'])
-                        name = self.__encode(profile['country']['name'])
-
-                        c = Country(alpha3=alpha3, code=code, name=name)
-
-                        prf.country_code = code
-                        prf.country = c
-
-                    uid.profile = prf
-
-                for identity in uidentity['identities']:
-                    identity_id = self.__encode(identity['id'])
-                    name = self.__encode(identity['name'])
-                    email = self.__encode(identity['email'])
-                    username = self.__encode(identity['username'])
-                    source = self.__encode(identity['source'])
-
-                    sh_id = Identity(id=identity_id, name=name,
-                                     email=email, username=username,
-                                     source=source, uuid=uuid)
-
-                    uid.identities.append(sh_id)
-
-                for enrollment in uidentity['enrollments']:
-                    organization = self.__encode(enrollment['organization'])
-
-                    org = self._organizations.get(organization, None)
-
-                    if not org:
-                        org = Organization(name=organization)
-                        self._organizations[organization] = org
-
-                    try:
-                        start = str_to_datetime(enrollment['start'])
-                        end = str_to_datetime(enrollment['end'])
-                    except InvalidDateError as e:
-                        raise InvalidFormatError(cause=str(e))
-
-                    rol = Enrollment(start=start, end=end, organization=org)
-
-                    uid.enrollments.append(rol)
-
+                uid = _parse_uidentity(uidentity, self._organizations)
                 self._identities.append(uid)
         except KeyError as e:
             msg = "invalid json format. Attribute %s not found" % e.args
@@ -310,7 +244,7 @@ class SortingHatParser(object):
         """
         try:
             for organization in json['organizations']:
-                name = self.__encode(organization)
+                name = _encode(organization)
 
                 org = self._organizations.get(name, None)
 
@@ -318,16 +252,7 @@ class SortingHatParser(object):
                     org = Organization(name=name)
                     self._organizations[name] = org
 
-                domains = json['organizations'][organization]
-
-                for domain in domains:
-                    if type(domain['is_top']) != bool:
-                        msg = "invalid json format. 'is_top' must have a bool value"
-                        raise InvalidFormatError(cause=msg)
-
-                    dom = Domain(domain=domain['domain'],
-                                 is_top_domain=domain['is_top'])
-                    org.domains.append(dom)
+                _parse_domains(org, json['organizations'][organization])
         except KeyError as e:
             msg = "invalid json format. Attribute %s not found" % e.args
             raise InvalidFormatError(cause=msg)
@@ -335,13 +260,629 @@ class SortingHatParser(object):
     def __load_json(self, stream):
         """Load json stream into a dict object """
 
-        import json
-
         try:
             return json.loads(stream)
         except ValueError as e:
             cause = "invalid json format. %s" % str(e)
             raise InvalidFormatError(cause=cause)
 
-    def __encode(self, s):
-        return s if s else None
+
+class SortingHatStreamParser(object):
+    """Parse identities and organizations incrementally.
+
+    This parser reads Sorting Hat streams from a file object
+    instead of loading the whole document in memory. It accepts
+    the same format as `SortingHatParser`, but unique identities
+    are returned one at a time, in the order they are stored
+    on the stream, while they are read.
+
+    The stream is read and validated once, from the beginning to
+    the end, while its data is requested. The blacklist and the
+    organizations found on the way are kept in memory; unique
+    identities are parsed only when they are returned. Format errors
+    are raised when the invalid data is reached, so some entities
+    may have been returned before. When the unique identities are
+    stored before other requested sections, they are validated and
+    skipped, and the file object is read again to return them,
+    so it must be seekable.
+
+    Organizations only found on enrollments are included on the list
+    of organizations once the unique identities have been read.
+
+    :param fd: file object to parse
+
+    :raises InvalidFormatError: raised when the stream is empty
+    """
+    SECTIONS = ('organizations', 'uidentities', 'blacklist')
+
+    def __init__(self, fd):
+        self._fd = fd
+        self._fingerprint = None
+
+        self._fd.seek(0, io.SEEK_END)
+        self._size = self._fd.tell()
+        self._fd.seek(0)
+
+        self._reader = JSONStreamReader(self._fd)
+
+        if self._reader.peek() is None:
+            raise InvalidFormatError(cause="stream cannot be empty or None")
+
+        self._keys = self._reader.iter_object()
+        self._done = False
+        self._found = set()
+        self._on_uidentities = False
+
+        self._blacklist = None
+        self._organizations = None
+        self._enrollment_orgs = set()
+
+    @property
+    def fingerprint(self):
+        """SHA-1 hash of the contents of the stream"""
+
+        if self._fingerprint is None:
+            position = self._fd.tell()
+            self._fd.seek(0)
+
+            sha1 = hashlib.sha1()
+
+            for chunk in iter(lambda: self._fd.read(65536), ''):
+                sha1.update(chunk.encode('utf-8', 'surrogatepass'))
+
+            self._fd.seek(position)
+            self._fingerprint = sha1.hexdigest()
+
+        return self._fingerprint
+
+    @property
+    def progress(self):
+        """Fraction of the stream read by the last pass over it"""
+
+        if not self._size:
+            return 1.0
+
+        return min(self._fd.tell() / self._size, 1.0)
+
+    @property
+    def blacklist(self):
+        if self._blacklist is None:
+            self.__read_until('blacklist')
+
+        return [MatchingBlacklist(excluded=e) for e in sorted(self._blacklist)]
+
+    @property
+    def identities(self):
+        if self._on_uidentities or self.__read_until('uidentities'):
+            self._on_uidentities = False
+            reader = self._reader
+            forward = True
+        else:
+            # Read again the unique identities skipped before
+            self.__read_until()
+            reader = self.__seek('uidentities')
+            forward = False
+
+        for uid in self.__parse_uidentities(reader):
+            yield uid
+
+        # Validate the rest of the stream
+        if forward:
+            self.__read_until()
+
+    @property
+    def organizations(self):
+        if self._organizations is None:
+            self.__read_until('organizations')
+
+        orgs = dict(self._organizations)
+
+        # Organizations only found on enrollments
+        for name in self._enrollment_orgs:
+            if name not in orgs:
+                orgs[name] = Organization(name=name)
+
+        return [orgs[name] for name in sorted(orgs)]
+
+    def __read_until(self, target=None):
+        """Read the stream until the value of a top level key.
+
+        Sections found before `target` are parsed and validated,
+        so they are not read again. When `target` is `None`, the
+        stream is read to the end.
+
+        :returns: `True` when the reader is positioned on the value
+            of `target`; `False` when `target` was read before
+
+        :raises InvalidFormatError: when `target` is not found
+        """
+        if self._on_uidentities:
+            self._on_uidentities = False
+
+            for _ in self.__parse_uidentities(self._reader):
+                pass
+
+        reader = self._reader
+
+        for key in self._keys:
+            if key not in self.SECTIONS or key in self._found:
+                reader.skip_value()
+                continue
+
+            self._found.add(key)
+
+            if reader.peek() not in ('{', '['):
+                msg = "invalid json format. Attribute %s has an invalid value" % key
+                raise InvalidFormatError(cause=msg)
+
+            if key == 'uidentities' and target == key:
+                self._on_uidentities = True
+                return True
+            elif key == 'organizations':
+                self._organizations = self.__parse_organizations(reader)
+            elif key == 'blacklist':
+                self._blacklist = self.__parse_blacklist(reader)
+            else:
+                for _ in self.__parse_uidentities(reader):
+                    pass
+
+            if key == target:
+                return True
+
+        if not self._done:
+            reader.expect_end()
+            self._done = True
+
+        if target is not None and target not in self._found:
+            msg = "invalid json format. Attribute %s not found" % target
+            raise InvalidFormatError(cause=msg)
+
+        return False
+
+    def __parse_blacklist(self, reader):
+        excluded = set()
+        entries = reader.iter_array()
+
+        for _ in entries:
+            entry = self.__parse_value(reader, entries, _parse_blacklist_entry)
+            excluded.add(entry)
+
+        return excluded
+
+    def __parse_organizations(self, reader):
+        orgs = {}
+        members = reader.iter_object()
+
+        for name in members:
+            name = _encode(name)
+
+            org = orgs.get(name, None)
+
+            if not org:
+                org = Organization(name=name)
+                orgs[name] = org
+
+            self.__parse_value(reader, members,
+                               lambda domains: _parse_domains(org, domains))
+
+        return orgs
+
+    def __parse_uidentities(self, reader):
+        members = reader.iter_object()
+
+        for _ in members:
+            uid = self.__parse_value(reader, members,
+                                     lambda uidentity: _parse_uidentity(uidentity, {}))
+            self._enrollment_orgs.update(rol.organization.name
+                                         for rol in uid.enrollments)
+            yield uid
+
+    def __parse_value(self, reader, members, parse):
+        """Read the next value and parse it checking its format.
+
+        When the format is not valid, the rest of the stream is read
+        before raising the error. Thus, syntax errors are reported
+        first, the same way `SortingHatParser` does.
+        """
+        value = reader.read_value()
+
+        try:
+            return parse(value)
+        except (KeyError, InvalidFormatError, TypeError, AttributeError) as e:
+            error = e
+
+            if isinstance(e, KeyError):
+                msg = "invalid json format. Attribute %s not found" % e.args
+                error = InvalidFormatError(cause=msg)
+
+        # Other passes read a stream already validated
+        if reader is self._reader:
+            for _ in members:
+                reader.skip_value()
+            for _ in self._keys:
+                reader.skip_value()
+            reader.expect_end()
+
+        raise error
+
+    def __seek(self, key):
+        """Get a reader positioned on the value of a top level key"""
+
+        self._fd.seek(0)
+        reader = JSONStreamReader(self._fd)
+
+        for k in reader.iter_object():
+            if k == key:
+                return reader
+            reader.skip_value()
+
+        msg = "invalid json format. Attribute %s not found" % key
+        raise InvalidFormatError(cause=msg)
+
+
+class JSONStreamReader(object):
+    """Incremental reader of JSON documents.
+
+    The reader walks through the objects and arrays of a document,
+    reading the file object in chunks. Only the value being read
+    is kept in memory, so large documents can be processed when
+    their values are small enough.
+
+    Errors are reported with the same messages `json.loads` uses,
+    including their position on the whole document.
+
+    :param fd: file object to read
+    :param chunk_size: number of characters read on each call
+    """
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    STRUCTURAL = re.compile(r'["{}\[\]]')
+    STRING = re.compile(r'["\\]')
+    SCALAR_END = re.compile(r'[ \t\n\r,:{}\[\]"]')
+
+    def __init__(self, fd, chunk_size=65536):
+        self._fd = fd
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+        # Position of the buffer on the document
+        self._offset = 0
+        self._lineno = 1
+        self._line_start = 0
+
+    def peek(self):
+        """Skip whitespaces and return the next character; `None` at the end"""
+
+        while True:
+            self._pos = self.WHITESPACE.match(self._buf, self._pos).end()
+
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return None
+
+    def read_value(self):
+        """Read and decode the next value"""
+
+        if self.peek() is None:
+            raise self._error("Expecting value", self._pos)
+
+        # Make sure the whole value is on the buffer
+        self._value_end()
+
+        try:
+            value, end = self._decoder.raw_decode(self._buf, self._pos)
+        except json.JSONDecodeError as e:
+            raise self._error(e.msg, e.pos)
+
+        self._pos = end
+
+        return value
+
+    def skip_value(self):
+        """Read the next value, validating it, without keeping it"""
+
+        c = self.peek()
+
+        if c == '{':
+            for _ in self.iter_object():
+                self.read_value()
+        elif c == '[':
+            for _ in self.iter_array():
+                self.read_value()
+        else:
+            self.read_value()
+
+    def iter_object(self):
+        """Iterate over the members of the next object.
+
+        The generator yields the key of each member. The caller must
+        read or skip its value before getting the next key.
+        """
+        if self.peek() != '{':
+            raise self._error("Expecting object", self._pos)
+
+        self._pos += 1
+
+        if self.peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            if self.peek() != '"':
+                raise self._error("Expecting property name enclosed in double quotes",
+                                  self._pos)
+
+            key = self.read_value()
+
+            if self.peek() != ':':
+                raise self._error("Expecting ':' delimiter", self._pos)
+
+            self._pos += 1
+
+            yield key
+
+            c = self.peek()
+            self._pos += 1
+
+            if c == '}':
+                return
+            elif c != ',':
+                raise self._error("Expecting ',' delimiter", self._pos - 1)
+
+    def iter_array(self):
+        """Iterate over the elements of the next array.
+
+        The generator yields `None` for each element. The caller must
+        read or skip the element before getting the next one.
+        """
+        if self.peek() != '[':
+            raise self._error("Expecting array", self._pos)
+
+        self._pos += 1
+
+        if self.peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield None
+
+            c = self.peek()
+            self._pos += 1
+
+            if c == ']':
+                return
+            elif c != ',':
+                raise self._error("Expecting ',' delimiter", self._pos - 1)
+
+    def expect_end(self):
+        """Check there is no data after the document"""
+
+        if self.peek() is not None:
+            raise self._error("Extra data", self._pos)
+
+    def _fill(self):
+        """Read a new chunk removing the data already consumed"""
+
+        if self._eof:
+            return False
+
+        data = self._fd.read(self._chunk_size)
+
+        if not data:
+            self._eof = True
+            return False
+
+        if self._pos:
+            consumed = self._buf[:self._pos]
+            nlines = consumed.count('\n')
+
+            if nlines:
+                self._lineno += nlines
+                self._line_start = self._offset + consumed.rindex('\n') + 1
+
+            self._offset += self._pos
+            self._buf = self._buf[self._pos:]
+            self._pos = 0
+
+        self._buf += data
+
+        return True
+
+    def _value_end(self):
+        """Find where the next value ends, reading data when needed.
+
+        Brackets and strings are matched without decoding the value;
+        it will be validated once decoded. When the stream ends before
+        the value, the end of the buffer is returned.
+        """
+        i = self._pos
+        c = self._buf[i]
+
+        if c not in '{["':
+            while True:
+                m = self.SCALAR_END.search(self._buf, i)
+
+                if m:
+                    return m.start()
+
+                i = len(self._buf) - self._pos
+
+                if not self._fill():
+                    return len(self._buf)
+
+                i += self._pos
+
+        depth = 0
+        in_string = False
+
+        while True:
+            pattern = self.STRING if in_string else self.STRUCTURAL
+            m = pattern.search(self._buf, i)
+
+            if not m:
+                # Keep the position relative to the value
+                # because the buffer is compacted on reads
+                i = max(i, len(self._buf)) - self._pos
+
+                if not self._fill():
+                    return len(self._buf)
+
+                i += self._pos
+                continue
+
+            ch = m.group()
+            i = m.end()
+
+            if in_string:
+                if ch == '\\':
+                    i += 1
+                    continue
+
+                in_string = False
+
+                if depth == 0:
+                    return i
+            elif ch == '"':
+                in_string = True
+            elif ch in '{[':
+                depth += 1
+            else:
+                depth -= 1
+
+                if depth == 0:
+                    return i
+
+    def _error(self, msg, pos):
+        """Build a format error for a position of the buffer"""
+
+        abs_pos = self._offset + pos
+        nlines = self._buf.count('\n', 0, pos)
+
+        if nlines:
+            colno = pos - self._buf.rindex('\n', 0, pos)
+        else:
+            colno = abs_pos - self._line_start + 1
+
+        cause = "invalid json format. %s: line %d column %d (char %d)" % \
+            (msg, self._lineno + nlines, colno, abs_pos)
+
+        return InvalidFormatError(cause=cause)
+
+
+def _parse_uidentity(uidentity, organizations):
+    """Build a unique identity from its Sorting Hat representation.
+
+    Organizations found on the enrollments are taken from or
+    added to `organizations` dict.
+    """
+    uuid = _encode(uidentity['uuid'])
+
+    uid = UniqueIdentity(uuid=uuid)
+
+    if uidentity['profile']:
+        profile = uidentity['profile']
+
+        if type(profile['is_bot']) != bool:
+            msg = "invalid json format. 'is_bot' must have a bool value"
+            raise InvalidFormatError(cause=msg)
+
+        is_bot = profile['is_bot']
+
+        gender = profile.get('gender', None)
+
+        if gender is not None:
+            gender = _encode(gender)
+
+        gender_acc = profile.get('gender_acc', None)
+
+        if gender_acc is not None:
+            if type(gender_acc) != int:
+                msg = "invalid json format. 'gender_acc' must have an integer value"
+                raise InvalidFormatError(cause=msg)
+            elif not 0 <= gender_acc <= 100:
+                msg = "invalid json format. 'gender_acc' is not in range (0,100)"
+                raise InvalidFormatError(cause=msg)
+
+        name = _encode(profile['name'])
+        email = _encode(profile['email'])
+
+        prf = Profile(uuid=uuid, name=name, email=email,
+                      gender=gender, gender_acc=gender_acc,
+                      is_bot=is_bot)
+
+        if profile['country']:
+            alpha3 = _encode(profile['country']['alpha3'])
+            code = _encode(profile['country']['code'])
+            name = _encode(profile['country']['name'])
+
+            c = Country(alpha3=alpha3, code=code, name=name)
+
+            prf.country_code = code
+            prf.country = c
+
+        uid.profile = prf
+
+    for identity in uidentity['identities']:
+        identity_id = _encode(identity['id'])
+        name = _encode(identity['name'])
+        email = _encode(identity['email'])
+        username = _encode(identity['username'])
+        source = _encode(identity['source'])
+
+        sh_id = Identity(id=identity_id, name=name,
+                         email=email, username=username,
+                         source=source, uuid=uuid)
+
+        uid.identities.append(sh_id)
+
+    for enrollment in uidentity['enrollments']:
+        organization = _encode(enrollment['organization'])
+
+        org = organizations.get(organization, None)
+
+        if not org:
+            org = Organization(name=organization)
+            organizations[organization] = org
+
+        try:
+            start = str_to_datetime(enrollment['start'])
+            end = str_to_datetime(enrollment['end'])
+        except InvalidDateError as e:
+            raise InvalidFormatError(cause=str(e))
+
+        rol = Enrollment(start=start, end=end, organization=org)
+
+        uid.enrollments.append(rol)
+
+    return uid
+
+
+def _parse_domains(org, domains):
+    """Add the domains in Sorting Hat format to an organization"""
+
+    for domain in domains:
+        if type(domain['is_top']) != bool:
+            msg = "invalid json format. 'is_top' must have a bool value"
+            raise InvalidFormatError(cause=msg)
+
+        dom = Domain(domain=domain['domain'],
+                     is_top_domain=domain['is_top'])
+        org.domains.append(dom)
+
+
+def _parse_blacklist_entry(entry):
+    """Validate a blacklist entry, returning the excluded term"""
+
+    if not entry:
+        msg = "invalid json format. Blacklist entries cannot be null or empty"
+        raise InvalidFormatError(cause=msg)
+
+    return _encode(entry)
+
+
+def _encode(s):
+    return s if s else None
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2018 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#         Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import json
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+API_MODULE = 'sortinghat.api'
+CMD_MODULE_PREFIX = 'sortinghat.cmd.'
+UNKNOWN_CALLER = '<unknown>'
+
+START_TIMES_KEY = 'sortinghat_query_start_times'
+
+MAX_SLOWEST_QUERIES = 10
+MAX_STATEMENT_LENGTH = 200
+
+
+class QueryProfiler(object):
+    """Collect statistics about the SQL statements run by Sorting Hat.
+
+    The profiler listens to the events of every database engine. Each
+    statement is attributed to the outermost function of `sortinghat.api`
+    found on the call stack; when the statement is not run by the API,
+    it is attributed to the innermost function of the commands. Number
+    of statements, rows and time spent are aggregated by function.
+
+    :param command: name of the command that is profiled
+    """
+    def __init__(self, command=None):
+        self.command = command
+        self.functions = {}
+        self.slowest = []
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start listening to the statements of the engines"""
+
+        self.started_at = time.time()
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+
+    def stop(self):
+        """Stop listening to the statements of the engines"""
+
+        event.remove(Engine, 'before_cursor_execute', self._before_execute)
+        event.remove(Engine, 'after_cursor_execute', self._after_execute)
+        self.finished_at = time.time()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def summary(self):
+        """Return the statistics collected.
+
+        :returns: a dict with the name of the command, the total number
+            of statements, rows and time, the statistics of each function
+            sorted by time and the slowest statements
+        """
+        with self._lock:
+            functions = [dict(stats, function=name)
+                         for name, stats in self.functions.items()]
+            slowest = [dict(query) for query in self.slowest]
+
+        functions.sort(key=lambda f: f['time'], reverse=True)
+
+        elapsed = None
+        if self.started_at is not None:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+
+        return {
+            'command': self.command,
+            'elapsed': elapsed,
+            'statements': sum(f['statements'] for f in functions),
+            'rows': sum(f['rows'] for f in functions),
+            'time': sum(f['time'] for f in functions),
+            'functions': functions,
+            'slowest': slowest
+        }
+
+    def report(self, stream=sys.stderr):
+        """Write a table with the statistics collected.
+
+        :param stream: stream where the table is written
+        """
+        summary = self.summary()
+
+        header = "%-50s %10s %10s %12s %12s"
+        line = "%-50s %10d %10d %12.3f %12.3f"
+
+        stream.write("Profile of '%s' command\n" % (summary['command'] or UNKNOWN_CALLER))
+        stream.write(header % ('function', 'statements', 'rows', 'time (ms)', 'max (ms)') + '\n')
+
+        for stats in summary['functions']:
+            stream.write(line % (stats['function'], stats['statements'], stats['rows'],
+                                 stats['time'] * 1000, stats['max_time'] * 1000) + '\n')
+
+        max_time = max([f['max_time'] for f in summary['functions']] or [0])
+
+        stream.write(line % ('total', summary['statements'], summary['rows'],
+                             summary['time'] * 1000, max_time * 1000) + '\n')
+
+        if summary['slowest']:
+            stream.write("\nSlowest statements\n")
+
+            for query in summary['slowest']:
+                stream.write("%12.3f ms  %s  %s\n" % (query['time'] * 1000,
+                                                      query['function'],
+                                                      query['statement']))
+
+    def dump(self, filepath):
+        """Write the statistics collected to a JSON file.
+
+        :param filepath: path of the file
+        """
+        with open(filepath, 'w') as f:
+            json.dump(self.summary(), f, indent=4, sort_keys=True)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(START_TIMES_KEY, []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get(START_TIMES_KEY, None)
+
+        if not start_times:
+            return
+
+        elapsed = time.perf_counter() - start_times.pop()
+        rows = max(cursor.rowcount, 0)
+        caller = find_caller()
+
+        with self._lock:
+            stats = self.functions.setdefault(caller, {'statements': 0,
+                                                       'rows': 0,
+                                                       'time': 0.0,
+                                                       'max_time': 0.0})
+            stats['statements'] += 1
+            stats['rows'] += rows
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+
+            self._add_slowest(statement, caller, elapsed)
+
+    def _add_slowest(self, statement, caller, elapsed):
+        if len(self.slowest) >= MAX_SLOWEST_QUERIES:
+            if elapsed <= self.slowest[-1]['time']:
+                return
+            self.slowest.pop()
+
+        self.slowest.append({'statement': ' '.join(statement.split())[:MAX_STATEMENT_LENGTH],
+                             'function': caller,
+                             'time': elapsed})
+        self.slowest.sort(key=lambda q: q['time'], reverse=True)
+
+
+def find_caller():
+    """Find the function to attribute a statement to.
+
+    It returns the name of the outermost function of `sortinghat.api`
+    on the call stack. When there is not any, the innermost function
+    of the commands is returned.
+    """
+    frame = sys._getframe(1)
+    caller = None
+    command = None
+
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+
+        if module == API_MODULE:
+            caller = frame.f_code.co_name
+        elif command is None and module.startswith(CMD_MODULE_PREFIX):
+            command = module[len(CMD_MODULE_PREFIX):] + '.' + frame.f_code.co_name
+
+        frame = frame.f_back
+
+    if caller:
+        return 'api.' + caller
+    elif command:
+        return 'cmd.' + command
+    else:
+        return UNKNOWN_CALLER
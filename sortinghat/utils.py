@@ -19,9 +19,13 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import bisect
+import datetime
 import dateutil.parser
+import functools
 import hashlib
 import logging
+import re
 import unicodedata
 
 from .db.model import MIN_PERIOD_DATE, MAX_PERIOD_DATE
@@ -29,6 +33,24 @@ from .exceptions import InvalidDateError
 
 logger = logging.getLogger(__name__)
 
+# Dates with these ISO-8601 shapes are parsed without dateutil
+ISO_DATETIME_REGEX = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}:\d{2})?$")
+
+# Letters that the collation of the registry considers equal
+# to other letters but that do not have a decomposed form
+COLLATION_FOLDS = str.maketrans({
+    'ß': 'ss',
+    'æ': 'ae',
+    'œ': 'oe',
+    'ø': 'o',
+    'đ': 'd',
+    'ð': 'd',
+    'ł': 'l',
+    'ħ': 'h',
+    'ı': 'i',
+    'ŧ': 't'
+})
+
 
 def merge_date_ranges(dates):
     """Merge date ranges.
@@ -89,7 +111,8 @@ def str_to_datetime(ts):
 
     This functions supports several date formats like YYYY-MM-DD, MM-DD-YYYY
     and YY-MM-DD. When the given data is None or an empty string, the function
-    returns None.
+    returns None. Strings with the shapes YYYY-MM-DD and YYYY-MM-DDTHH:MM:SS
+    are parsed by a faster path.
 
     :param ts: string to convert
 
@@ -102,11 +125,32 @@ def str_to_datetime(ts):
         return None
 
     try:
-        return dateutil.parser.parse(ts).replace(tzinfo=None)
+        return _parse_datetime(ts)
     except Exception:
         raise InvalidDateError(date=str(ts))
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_datetime(ts):
+    """Parse a date string, trying strict ISO-8601 shapes first.
+
+    Results are memoized because the same dates, like the default
+    ones of the enrollments, are repeated through the inputs.
+    """
+    m = ISO_DATETIME_REGEX.match(ts)
+
+    if m:
+        time = m.group(1)
+        fmt = '%Y-%m-%d' + (time[0] + '%H:%M:%S' if time else '')
+
+        try:
+            return datetime.datetime.strptime(ts, fmt)
+        except ValueError:
+            pass
+
+    return dateutil.parser.parse(ts).replace(tzinfo=None)
+
+
 def to_unicode(x, unaccent=False):
     """Convert a string to unicode"""
     s = str(x)
@@ -119,6 +163,183 @@ def to_unicode(x, unaccent=False):
     return s
 
 
+def fold_case_and_accents(s):
+    """Convert a string to the form used to index it.
+
+    The string is converted to lower case and its accents are
+    removed. Compatibility characters, like ligatures, are decomposed
+    and letters such as 'ß' are replaced by their equivalent ('ss').
+    This way, strings the collation of the registry considers equal
+    have the same form in most of the cases.
+
+    :param s: string to convert
+
+    :returns: the folded string
+    """
+    s = unicodedata.normalize('NFKD', str(s).lower())
+    s = ''.join([c for c in s if unicodedata.category(c) != 'Mn'])
+
+    return s.translate(COLLATION_FOLDS)
+
+
+def is_trigram_indexable(s):
+    """Check whether the trigrams of a string can be used to match it.
+
+    Only the strings that are made of printable ASCII characters, once
+    they are folded, are indexable. The collation may consider other
+    characters equal to some of these or even ignore them, so the
+    trigrams of strings with those characters cannot be trusted.
+
+    :param s: string to check
+
+    :returns: True when the string is indexable; False otherwise
+    """
+    if not s:
+        return True
+
+    return all(' ' <= c <= '~' for c in fold_case_and_accents(s))
+
+
+def trigrams(s):
+    """Split a string into its set of trigrams.
+
+    The string is folded using `fold_case_and_accents` before
+    splitting it. This means 'Jöhn' and 'john' will generate
+    the same trigrams. Strings shorter than three characters do not
+    have any trigram, so an empty set is returned for them.
+
+    :param s: string to split
+
+    :returns: a set of trigrams encoded as UTF-8 bytes
+    """
+    if not s:
+        return set()
+
+    s = fold_case_and_accents(s)
+
+    return {s[i:i + 3].encode('UTF-8', errors="surrogateescape")
+            for i in range(len(s) - 2)}
+
+
+class DomainTrie(object):
+    """Suffix trie of domain names.
+
+    Domains are stored using their labels in reverse order, so
+    'example.com' is stored as 'com' -> 'example'. This allows to
+    find every stored domain which is a suffix of a given domain,
+    on a number of steps that only depends on the number of labels
+    of that domain. Domains are case insensitive.
+
+    :param domains: list of domains to add to the trie
+    """
+    def __init__(self, domains=None):
+        self._root = {}
+        self._size = 0
+
+        for domain in domains or []:
+            self.add(domain)
+
+    def __len__(self):
+        return self._size
+
+    def add(self, domain):
+        """Add a domain to the trie.
+
+        :param domain: domain name to add
+        """
+        node = self._root
+
+        for label in self._labels(domain):
+            node = node.setdefault(label, {})
+
+        if None not in node:
+            self._size += 1
+
+        node[None] = domain
+
+    def matches(self, domain):
+        """Find the stored domains which are suffixes of a domain.
+
+        A stored domain matches when it is equal to the given domain
+        or when the given domain is one of its sub-domains. For example,
+        'example.com' matches with 'example.com' and 'mail.example.com'
+        but it does not match with 'myexample.com'.
+
+        :param domain: domain name to look for
+
+        :returns: list of stored domains sorted from the longest
+            to the shortest match
+        """
+        node = self._root
+        found = []
+
+        for label in self._labels(domain):
+            node = node.get(label)
+
+            if node is None:
+                break
+            if None in node:
+                found.append(node[None])
+
+        found.reverse()
+
+        return found
+
+    def longest_match(self, domain):
+        """Find the longest stored domain which is a suffix of a domain.
+
+        :param domain: domain name to look for
+
+        :returns: the longest stored domain that matches or `None`
+            when there is not any match
+        """
+        found = self.matches(domain)
+        return found[0] if found else None
+
+    @staticmethod
+    def _labels(domain):
+        return reversed(domain.strip('.').lower().split('.'))
+
+
+class IntervalIndex(object):
+    """Sorted index of closed intervals.
+
+    Intervals are stored sorted by their start point. Looking for
+    the intervals that contain a point requires a binary search
+    to discard those that start after it, followed by a scan over
+    the remaining ones from the latest to the earliest start.
+
+    :param intervals: list of `(start, end, value)` tuples
+    """
+    def __init__(self, intervals=None):
+        self._intervals = sorted(intervals or [], key=lambda i: i[0])
+        self._starts = [i[0] for i in self._intervals]
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def find(self, point):
+        """Find the interval that contains a point.
+
+        When several intervals contain the point, the one that
+        starts later is selected.
+
+        :param point: point to look for
+
+        :returns: the value of the interval that contains the point;
+            `None` when the point is not in any interval
+        """
+        pos = bisect.bisect_right(self._starts, point)
+
+        for i in range(pos - 1, -1, -1):
+            _, end, value = self._intervals[i]
+
+            if point <= end:
+                return value
+
+        return None
+
+
 def uuid(source, email=None, name=None, username=None):
     """Get the UUID related to the identity data.
 
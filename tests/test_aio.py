@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import asyncio
+import datetime
+import sys
+import unittest
+import unittest.mock
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from sortinghat import aio, api
+from sortinghat.db.model import UniqueIdentity
+from sortinghat.exceptions import InvalidValueError, NotFoundError
+
+from tests.base import TestDatabaseCaseBase
+
+
+class TestAsyncAPI(TestDatabaseCaseBase):
+    """Unit tests for the asynchronous API"""
+
+    def load_test_dataset(self):
+        pass
+
+    def setUp(self):
+        super(TestAsyncAPI, self).setUp()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super(TestAsyncAPI, self).tearDown()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_add_and_retrieve(self):
+        """Check if entities are added and retrieved asynchronously"""
+
+        async def scenario():
+            uuid = await aio.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                          'John Smith', 'jsmith')
+            await aio.add_organization(self.db, 'Example')
+            await aio.add_enrollment(self.db, uuid, 'Example')
+
+            uids = await aio.unique_identities(self.db, uuid)
+            rols = await aio.enrollments(self.db, uuid=uuid)
+
+            return uuid, uids, rols
+
+        uuid, uids, rols = self.run_async(scenario())
+
+        self.assertEqual(len(uids), 1)
+        self.assertIsInstance(uids[0], UniqueIdentity)
+        self.assertEqual(uids[0].uuid, uuid)
+        self.assertEqual(len(rols), 1)
+        self.assertEqual(rols[0].organization.name, 'Example')
+
+    def test_concurrent_calls(self):
+        """Check if concurrent calls return their own results"""
+
+        api.add_organization(self.db, 'Example')
+
+        async def scenario():
+            calls = [aio.add_unique_identity(self.db, 'uuid-%s' % i)
+                     for i in range(10)]
+            await asyncio.gather(*calls)
+
+            calls = [aio.unique_identities(self.db, 'uuid-%s' % i)
+                     for i in range(10)]
+            return await asyncio.gather(*calls)
+
+        results = self.run_async(scenario())
+
+        uuids = [uids[0].uuid for uids in results]
+        self.assertListEqual(uuids, ['uuid-%s' % i for i in range(10)])
+
+    def test_iter_unique_identities(self):
+        """Check if unique identities are iterated asynchronously"""
+
+        for i in range(5):
+            api.add_unique_identity(self.db, 'uuid-%s' % i)
+
+        async def scenario():
+            uuids = []
+
+            async for uid in aio.iter_unique_identities(self.db, chunk_size=2):
+                uuids.append(uid.uuid)
+
+            return uuids
+
+        uuids = self.run_async(scenario())
+        self.assertListEqual(uuids, ['uuid-%s' % i for i in range(5)])
+
+    def test_iter_in_batches(self):
+        """Check if unique identities are fetched in batches"""
+
+        for i in range(5):
+            api.add_unique_identity(self.db, 'uuid-%s' % i)
+
+        async def scenario():
+            uuids = []
+
+            async for uid in aio.iter_unique_identities(self.db, chunk_size=2):
+                uuids.append(uid.uuid)
+
+            return uuids
+
+        with unittest.mock.patch('sortinghat.aio.run', wraps=aio.run) as run:
+            uuids = self.run_async(scenario())
+
+        self.assertListEqual(uuids, ['uuid-%s' % i for i in range(5)])
+
+        # Three batches with 2, 2 and 1 unique identities
+        self.assertEqual(run.call_count, 3)
+
+    def test_iter_concurrently(self):
+        """Check if an iterator can be shared by several tasks"""
+
+        for i in range(9):
+            api.add_unique_identity(self.db, 'uuid-%s' % i)
+
+        async def consume(uidentities):
+            uuids = []
+
+            async for uid in uidentities:
+                uuids.append(uid.uuid)
+
+            return uuids
+
+        async def scenario():
+            uidentities = aio.iter_unique_identities(self.db, chunk_size=2)
+            tasks = [consume(uidentities) for _ in range(4)]
+            return await asyncio.gather(*tasks)
+
+        results = self.run_async(scenario())
+
+        uuids = sorted(uuid for result in results for uuid in result)
+        self.assertListEqual(uuids, ['uuid-%s' % i for i in range(9)])
+
+    def test_changes(self):
+        """Check if the changes are listed asynchronously"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_unique_identity(self.db, 'John Doe')
+
+        async def scenario():
+            return await aio.changes(self.db, limit=1)
+
+        changes = self.run_async(scenario())
+
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0].eid, 'John Smith')
+        self.assertEqual(changes[0].action, 'add')
+
+    def test_affiliations_at(self):
+        """Check if affiliations are found asynchronously"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_unique_identity(self.db, 'John Doe')
+        api.add_organization(self.db, 'Example')
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(1999, 1, 1),
+                           datetime.datetime(2001, 1, 1))
+
+        date = datetime.datetime(2000, 1, 1)
+
+        async def scenario():
+            org = await aio.affiliation_at(self.db, 'John Smith', date)
+            orgs = await aio.affiliations_at(self.db, [('John Smith', date),
+                                                       ('John Doe', date)])
+            return org, orgs
+
+        org, orgs = self.run_async(scenario())
+
+        self.assertEqual(org, 'Example')
+        self.assertListEqual(orgs, ['Example', None])
+
+    def test_errors(self):
+        """Check if errors are raised on the awaiting coroutine"""
+
+        async def not_found():
+            await aio.unique_identities(self.db, 'John Smith')
+
+        async def invalid_chunk_size():
+            async for _ in aio.iter_unique_identities(self.db, chunk_size=0):
+                pass
+
+        async def unknown_affiliation():
+            await aio.affiliation_at(self.db, 'John Smith',
+                                     datetime.datetime(2000, 1, 1))
+
+        self.assertRaises(NotFoundError, self.run_async, not_found())
+        self.assertRaises(InvalidValueError, self.run_async, invalid_chunk_size())
+        self.assertRaises(NotFoundError, self.run_async, unknown_affiliation())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -21,15 +21,21 @@
 #
 
 import datetime
+import os
 import sys
+import tempfile
 import unittest
+import unittest.mock
 
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 
 from sortinghat import api
-from sortinghat.db.model import UniqueIdentity, Identity, Profile,\
-    Organization, Domain, Country, Enrollment, MatchingBlacklist
+from sortinghat.db.cache import disable_affiliations_cache, enable_affiliations_cache
+from sortinghat.db.database import Database
+from sortinghat.db.api import log_change
+from sortinghat.db.model import ModelBase, UniqueIdentity, Identity, IdentityTrigram, Profile,\
+    Organization, Domain, Country, Enrollment, MatchingBlacklist, Change, RegistryInfo
 from sortinghat.exceptions import AlreadyExistsError, NotFoundError
 from sortinghat.matcher import create_identity_matcher
 
@@ -62,6 +68,76 @@ class TestAPICaseBase(TestDatabaseCaseBase):
         pass
 
 
+class TestReadOnlyEngine(TestAPICaseBase):
+    """Unit tests for routing read-only functions to a read-only engine"""
+
+    def setUp(self):
+        super(TestReadOnlyEngine, self).setUp()
+
+        fd, self.replica = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+
+        self.rdb = Database(read_only_url='sqlite:///' + self.replica,
+                            **self.db_kwargs)
+        ModelBase.metadata.create_all(self.rdb._ro_engine)
+
+    def tearDown(self):
+        self.rdb._ro_engine.dispose()
+        os.remove(self.replica)
+
+        super(TestReadOnlyEngine, self).tearDown()
+
+    def test_read_only_routing(self):
+        """Check if reads use the read-only engine and writes the primary"""
+
+        api.add_organization(self.rdb, 'Example')
+        api.add_unique_identity(self.rdb, 'John Smith')
+
+        # Writes went to the primary
+        self.assertEqual(len(api.registry(self.db)), 1)
+        self.assertEqual(len(api.unique_identities(self.db)), 1)
+
+        # The replica is empty, so reads do not find anything
+        self.assertListEqual(api.registry(self.rdb), [])
+        self.assertListEqual(api.unique_identities(self.rdb), [])
+        self.assertRaises(NotFoundError, api.unique_identities,
+                          self.rdb, 'John Smith')
+
+        # Data is found on the replica once it is replicated
+        with self.rdb.connect(read_only=True) as session:
+            session.add(Organization(name='Example'))
+
+        orgs = api.registry(self.rdb)
+        self.assertEqual(len(orgs), 1)
+        self.assertEqual(orgs[0].name, 'Example')
+
+    def test_read_from_primary(self):
+        """Check if reads can be forced to use the primary"""
+
+        api.add_unique_identity(self.rdb, 'John Smith')
+
+        with self.rdb.read_from_primary():
+            self.assertTrue(self.rdb.reading_from_primary)
+
+            with self.rdb.read_from_primary():
+                uids = api.unique_identities(self.rdb, 'John Smith')
+                self.assertEqual(uids[0].uuid, 'John Smith')
+
+            uids = api.unique_identities(self.rdb)
+            self.assertEqual(len(uids), 1)
+
+        self.assertFalse(self.rdb.reading_from_primary)
+        self.assertListEqual(api.unique_identities(self.rdb), [])
+
+    def test_no_read_only_engine(self):
+        """Check if the primary is used when there is no read-only engine"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 1)
+
+
 class TestAddUniqueIdentity(TestAPICaseBase):
     """Unit tests for add_unique_identity"""
 
@@ -1906,6 +1982,105 @@ class TestMergeEnrollments(TestAPICaseBase):
             self.assertEqual(len(enrollments), 2)
 
 
+class TestMergeAllEnrollments(TestAPICaseBase):
+    """Unit tests for merge_all_enrollments"""
+
+    def test_merge_all_enrollments(self):
+        """Check if it merges the enrollments on every organization"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_organization(self.db, 'Example')
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(1900, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(2008, 1, 1),
+                           datetime.datetime(2100, 1, 1))
+
+        api.add_organization(self.db, 'Bitergia')
+        api.add_enrollment(self.db, 'John Smith', 'Bitergia',
+                           datetime.datetime(1900, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.add_enrollment(self.db, 'John Smith', 'Bitergia',
+                           datetime.datetime(2008, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.add_enrollment(self.db, 'John Smith', 'Bitergia',
+                           datetime.datetime(2010, 1, 2),
+                           datetime.datetime(2100, 1, 1))
+
+        # Enrollments of other identities will not be merged
+        api.add_unique_identity(self.db, 'John Doe')
+        api.add_enrollment(self.db, 'John Doe', 'Example',
+                           datetime.datetime(1900, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.add_enrollment(self.db, 'John Doe', 'Example',
+                           datetime.datetime(2008, 1, 1),
+                           datetime.datetime(2100, 1, 1))
+
+        api.merge_all_enrollments(self.db, 'John Smith')
+
+        enrollments = api.enrollments(self.db, 'John Smith')
+        self.assertEqual(len(enrollments), 3)
+
+        rol = enrollments[0]
+        self.assertEqual(rol.organization.name, 'Bitergia')
+        self.assertEqual(rol.start, datetime.datetime(2008, 1, 1))
+        self.assertEqual(rol.end, datetime.datetime(2010, 1, 1))
+
+        rol = enrollments[1]
+        self.assertEqual(rol.organization.name, 'Bitergia')
+        self.assertEqual(rol.start, datetime.datetime(2010, 1, 2))
+        self.assertEqual(rol.end, datetime.datetime(2100, 1, 1))
+
+        rol = enrollments[2]
+        self.assertEqual(rol.organization.name, 'Example')
+        self.assertEqual(rol.start, datetime.datetime(2008, 1, 1))
+        self.assertEqual(rol.end, datetime.datetime(2010, 1, 1))
+
+        enrollments = api.enrollments(self.db, 'John Doe')
+        self.assertEqual(len(enrollments), 2)
+
+    def test_last_modified(self):
+        """Check if last modification date is updated only on changes"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_organization(self.db, 'Example')
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(2008, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+
+        uid = api.unique_identities(self.db, 'John Smith')[0]
+        before = uid.last_modified
+
+        api.merge_all_enrollments(self.db, 'John Smith')
+
+        uid = api.unique_identities(self.db, 'John Smith')[0]
+        self.assertEqual(uid.last_modified, before)
+
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(1900, 1, 1),
+                           datetime.datetime(2009, 1, 1))
+
+        uid = api.unique_identities(self.db, 'John Smith')[0]
+        before = uid.last_modified
+
+        api.merge_all_enrollments(self.db, 'John Smith')
+
+        uid = api.unique_identities(self.db, 'John Smith')[0]
+        self.assertGreater(uid.last_modified, before)
+
+        enrollments = api.enrollments(self.db, 'John Smith')
+        self.assertEqual(len(enrollments), 1)
+
+    def test_not_found_uuid(self):
+        """Check if it fails when the unique identity is not found"""
+
+        self.assertRaisesRegex(NotFoundError,
+                               NOT_FOUND_ERROR % {'entity': 'John Smith'},
+                               api.merge_all_enrollments,
+                               self.db, 'John Smith')
+
+
 class TestMergeUniqueIdentities(TestAPICaseBase):
     """Unit tests for merge_unique_identities"""
 
@@ -2465,6 +2640,81 @@ class TestMatchIdentities(TestAPICaseBase):
                                self.db, 'Jane Roe', matcher)
 
 
+class TestMatchUniqueIdentities(TestAPICaseBase):
+    """Unit tests for match_unique_identities"""
+
+    def load_test_dataset(self):
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                         uuid='John Smith')
+        api.add_identity(self.db, 'scm', name='John Smith', uuid='John Smith')
+
+        api.add_unique_identity(self.db, 'Smith J.')
+        api.add_identity(self.db, 'mls', 'JSmith@example.com',
+                         uuid='Smith J.')
+
+        api.add_unique_identity(self.db, 'John Doe')
+        api.add_identity(self.db, 'mls', 'johndoe@example.com', uuid='John Doe')
+
+        api.add_unique_identity(self.db, 'Jane Rae')
+        api.add_identity(self.db, 'scm', 'janerae@example.com', 'Jane Rae', uuid='Jane Rae')
+
+        api.add_unique_identity(self.db, 'JRae')
+        api.add_identity(self.db, 'mls', name='Jane Rae', username='jrae', uuid='JRae')
+
+        api.add_unique_identity(self.db, 'Jane')
+        api.add_identity(self.db, 'unknown', 'janerae@example.com', 'Jane', uuid='Jane')
+
+        api.add_unique_identity(self.db, 'Empty')
+
+    def test_match_unique_identities(self):
+        """Test if it returns the same matches than match_identities"""
+
+        matcher = create_identity_matcher('default')
+        uuids = ['John Smith', 'Smith J.', 'John Doe',
+                 'Jane Rae', 'JRae', 'Jane', 'Empty']
+
+        matches = api.match_unique_identities(self.db, uuids, matcher)
+
+        self.assertEqual(len(matches), 7)
+
+        for uuid in uuids:
+            expected = sorted(u.uuid for u in api.match_identities(self.db, uuid, matcher))
+            self.assertListEqual(matches[uuid], expected)
+
+        self.assertListEqual(matches['Jane Rae'], ['Jane'])
+        self.assertListEqual(matches['Empty'], [])
+
+    def test_match_subset(self):
+        """Test if only the given unique identities are matched"""
+
+        matcher = create_identity_matcher('email')
+
+        matches = api.match_unique_identities(self.db, ['Jane', 'Jane Rae'],
+                                              matcher, chunk_size=1)
+
+        self.assertDictEqual(matches, {'Jane': ['Jane Rae'],
+                                       'Jane Rae': ['Jane']})
+
+    def test_not_found_unique_identities(self):
+        """Test if unique identities not found are not included"""
+
+        matcher = create_identity_matcher('default')
+
+        matches = api.match_unique_identities(self.db, ['Jane Roe', 'John Doe'],
+                                              matcher)
+
+        self.assertDictEqual(matches, {'John Doe': []})
+
+    def test_invalid_chunk_size(self):
+        """Check if it fails when chunk size is lower than 1"""
+
+        matcher = create_identity_matcher('default')
+
+        self.assertRaises(ValueError, api.match_unique_identities,
+                          self.db, ['John Doe'], matcher, chunk_size=0)
+
+
 class TestUniqueIdentities(TestAPICaseBase):
     """Unit tests for unique_identities"""
 
@@ -2615,6 +2865,90 @@ class TestUniqueIdentities(TestAPICaseBase):
                           self.db, 'John Smith', 'scm')
 
 
+class TestIterUniqueIdentities(TestAPICaseBase):
+    """Unit tests for iter_unique_identities"""
+
+    def test_iter_unique_identities(self):
+        """Check if it iterates over the registry of unique identities in chunks"""
+
+        # Add a country
+        with self.db.connect() as session:
+            us = Country(code='US', name='United States of America', alpha3='USA')
+            session.add(us)
+
+        # Add some identities
+        jsmith_uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                       'John Smith', 'jsmith')
+        api.add_identity(self.db, 'scm', 'jsmith@bitergia.com', uuid=jsmith_uuid)
+        api.add_identity(self.db, 'mls', 'jsmith@bitergia.com', uuid=jsmith_uuid)
+        api.edit_profile(self.db, jsmith_uuid, email='jsmith@example.com',
+                         is_bot=True, country_code='US')
+
+        jdoe_uuid = api.add_identity(self.db, 'scm', 'jdoe@example.com',
+                                     'John Doe', 'jdoe')
+        api.add_identity(self.db, 'scm', 'jdoe@libresoft.es', uuid=jdoe_uuid)
+
+        api.add_identity(self.db, 'its', 'jrae@example.com', 'Jane Rae')
+
+        # Tests
+        for chunk_size in (1, 2, 3, 1000):
+            uidentities = [uid for uid in api.iter_unique_identities(self.db,
+                                                                     chunk_size=chunk_size)]
+            self.assertEqual(len(uidentities), 3)
+
+            uid = uidentities[0]
+            self.assertEqual(uid.uuid, '90ce2a1cc1c683b5c60690642aa56985ef56e268')
+            self.assertEqual(len(uid.identities), 1)
+
+            uid = uidentities[1]
+            self.assertEqual(uid.uuid, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
+            self.assertEqual(uid.profile.email, 'jsmith@example.com')
+            self.assertEqual(uid.profile.country.code, 'US')
+            self.assertEqual(len(uid.identities), 3)
+
+            uid = uidentities[2]
+            self.assertEqual(uid.uuid, 'c6d2504fde0e34b78a185c4b709e5442d045451c')
+            self.assertEqual(len(uid.identities), 2)
+
+    def test_iter_unique_identities_source(self):
+        """Check if it only returns the unique identities assigned to a source"""
+
+        jsmith_uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                       'John Smith', 'jsmith')
+        api.add_identity(self.db, 'scm', 'jsmith@bitergia.com', uuid=jsmith_uuid)
+        api.add_identity(self.db, 'mls', 'jsmith@bitergia.com', uuid=jsmith_uuid)
+
+        jdoe_uuid = api.add_identity(self.db, 'scm', 'jdoe@example.com',
+                                     'John Doe', 'jdoe')
+        api.add_identity(self.db, 'scm', 'jdoe@libresoft.es', uuid=jdoe_uuid)
+
+        uidentities = [uid for uid in api.iter_unique_identities(self.db, source='scm',
+                                                                 chunk_size=1)]
+        self.assertEqual(len(uidentities), 2)
+        self.assertEqual(uidentities[0].uuid, jsmith_uuid)
+        self.assertEqual(len(uidentities[0].identities), 3)
+        self.assertEqual(uidentities[1].uuid, jdoe_uuid)
+
+        uidentities = [uid for uid in api.iter_unique_identities(self.db, source='mls')]
+        self.assertEqual(len(uidentities), 1)
+        self.assertEqual(uidentities[0].uuid, jsmith_uuid)
+
+        uidentities = [uid for uid in api.iter_unique_identities(self.db, source='its')]
+        self.assertListEqual(uidentities, [])
+
+    def test_empty_registry(self):
+        """Check whether it does not return anything when the registry is empty"""
+
+        uidentities = [uid for uid in api.iter_unique_identities(self.db)]
+        self.assertListEqual(uidentities, [])
+
+    def test_invalid_chunk_size(self):
+        """Check whether it raises an exception when chunk size is invalid"""
+
+        with self.assertRaises(ValueError):
+            next(api.iter_unique_identities(self.db, chunk_size=0))
+
+
 class TestSearchUniqueIdentities(TestAPICaseBase):
     """Unit tests for search_unique_identities"""
 
@@ -2658,6 +2992,125 @@ class TestSearchUniqueIdentities(TestAPICaseBase):
         self.assertEqual(uids[0].uuid, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
         self.assertEqual(len(uids[0].identities), 3)
 
+    def test_search_with_trigrams(self):
+        """Check if the results using the trigrams index are the same of a full scan"""
+
+        jsmith_uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                       'John Smith', 'jsmith')
+        api.add_identity(self.db, 'scm', 'jsmith@bitergia.com', uuid=jsmith_uuid)
+
+        jdoe_uuid = api.add_identity(self.db, 'scm', 'jdoe@example.com',
+                                     'John Doe', 'jdoe')
+        api.add_identity(self.db, 'mls', 'jdoe@libresoft.es',
+                         'jdoe', 'jdoe', uuid=jdoe_uuid)
+
+        # Terms with trigrams
+        uids = api.search_unique_identities(self.db, 'SMITH')
+        self.assertEqual(len(uids), 1)
+        self.assertEqual(uids[0].uuid, jsmith_uuid)
+
+        uids = api.search_unique_identities(self.db, 'example.com')
+        self.assertEqual(len(uids), 2)
+        self.assertEqual(uids[0].uuid, jsmith_uuid)
+        self.assertEqual(uids[1].uuid, jdoe_uuid)
+
+        # All the trigrams are found but the term is not
+        self.assertRaises(NotFoundError, api.search_unique_identities,
+                          self.db, 'smithsmi')
+
+        # Short terms and terms with wildcards
+        uids = api.search_unique_identities(self.db, 'do')
+        self.assertEqual(len(uids), 1)
+        self.assertEqual(uids[0].uuid, jdoe_uuid)
+
+        uids = api.search_unique_identities(self.db, 'j%@libresoft')
+        self.assertEqual(len(uids), 1)
+        self.assertEqual(uids[0].uuid, jdoe_uuid)
+
+    def test_trigrams_index(self):
+        """Check if the trigrams index is updated when identities are added or removed"""
+
+        jsmith_uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                       'John Smith', 'jsmith')
+        api.add_identity(self.db, 'scm', name='Jo')
+
+        with self.db.connect() as session:
+            grams = session.query(IdentityTrigram).\
+                filter(IdentityTrigram.identity_id == jsmith_uuid).all()
+            grams = sorted([g.trigram for g in grams])
+
+            self.assertEqual(len(grams), 22)
+            self.assertEqual(grams[0], b' sm')
+            self.assertEqual(grams[-1], b'xam')
+
+            # Identity 'Jo' does not have trigrams but its source does
+            grams = session.query(IdentityTrigram.trigram).distinct().all()
+            self.assertEqual(len(grams), 22)
+
+        api.delete_unique_identity(self.db, jsmith_uuid)
+
+        with self.db.connect() as session:
+            grams = session.query(IdentityTrigram).\
+                filter(IdentityTrigram.identity_id == jsmith_uuid).all()
+            self.assertListEqual(grams, [])
+
+    def test_reindex_outdated_trigrams(self):
+        """Check if identities are indexed again when the trigrams version changes"""
+
+        jsmith_uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                       'John Smith', 'jsmith')
+
+        # Simulate a registry indexed with an older version
+        with self.db.connect() as session:
+            session.query(IdentityTrigram).delete()
+            session.add(IdentityTrigram(trigram=b'old', identity_id=jsmith_uuid))
+            session.query(RegistryInfo).\
+                filter(RegistryInfo.name == RegistryInfo.TRIGRAMS_VERSION).\
+                update({RegistryInfo.value: '1'})
+
+        Database(**self.db_kwargs)
+
+        with self.db.connect() as session:
+            grams = session.query(IdentityTrigram.trigram).\
+                filter(IdentityTrigram.identity_id == jsmith_uuid).all()
+            self.assertEqual(len(grams), 22)
+            self.assertNotIn((b'old',), grams)
+
+            info = session.query(RegistryInfo).\
+                filter(RegistryInfo.name == RegistryInfo.TRIGRAMS_VERSION).one()
+            self.assertEqual(info.value, IdentityTrigram.VERSION)
+
+        # Up to date registries are not indexed again
+        with unittest.mock.patch.object(Database, '_Database__index_identities') as mock_index:
+            Database(**self.db_kwargs)
+            mock_index.assert_not_called()
+
+    def test_search_unindexed_identities(self):
+        """Check if identities with values that cannot be indexed are always candidates"""
+
+        jsmith_uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                       'John Smith', 'jsmith')
+        lstrasse_uuid = api.add_identity(self.db, 'scm', name='Þórr Straße')
+
+        with self.db.connect() as session:
+            grams = session.query(IdentityTrigram.identity_id).\
+                filter(IdentityTrigram.trigram == IdentityTrigram.UNINDEXED).all()
+            self.assertListEqual(grams, [(lstrasse_uuid,)])
+
+        # Folded terms use the index
+        uids = api.search_unique_identities(self.db, 'Straße')
+        self.assertEqual(len(uids), 1)
+        self.assertEqual(uids[0].uuid, lstrasse_uuid)
+
+        # Terms that cannot be indexed do a full scan
+        uids = api.search_unique_identities(self.db, 'Þórr')
+        self.assertEqual(len(uids), 1)
+        self.assertEqual(uids[0].uuid, lstrasse_uuid)
+
+        uids = api.search_unique_identities(self.db, 'smith')
+        self.assertEqual(len(uids), 1)
+        self.assertEqual(uids[0].uuid, jsmith_uuid)
+
     def test_search_4bytes_utf8_identities(self):
         """Check if it returns the unique identities which have 4 bytes UTF8-characters"""
 
@@ -2880,6 +3333,94 @@ class TestSearchUniqueIdentitiesSlice(TestAPICaseBase):
                           self.db, None, 1, -1)
 
 
+class TestSearchUniqueIdentitiesPage(TestAPICaseBase):
+    """Unit tests for search_unique_identities_page"""
+
+    def test_search_unique_identities_page(self):
+        """Check if it returns pages of unique identities that match with the criteria"""
+
+        api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                         'John Smith', 'jsmith')
+        api.add_identity(self.db, 'scm', 'jsmith@bitergia.com')
+        api.add_identity(self.db, 'mls', 'jsmith@bitergia.com')
+        api.add_identity(self.db, 'scm', 'jdoe@example.com', 'John Doe', 'jdoe')
+
+        # Tests
+        uids, token, ntotal = api.search_unique_identities_page(self.db, 'jsmith', 2)
+        self.assertEqual(len(uids), 2)
+        self.assertIsNotNone(token)
+        self.assertIsNone(ntotal)
+        self.assertEqual(uids[0].uuid, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
+        self.assertEqual(uids[1].uuid, 'acced28b86278f00a21080d695ecb34b81a1828f')
+
+        uids, token, ntotal = api.search_unique_identities_page(self.db, 'jsmith', 2,
+                                                                token=token)
+        self.assertEqual(len(uids), 1)
+        self.assertIsNone(token)
+        self.assertIsNone(ntotal)
+        self.assertEqual(uids[0].uuid, 'ebcda394c978d50847d60015892f9ca0f0ccde65')
+
+        # None values can also be used
+        uids, token, ntotal = api.search_unique_identities_page(self.db, None, 100)
+        self.assertEqual(len(uids), 4)
+        self.assertIsNone(token)
+        self.assertEqual(uids[0].uuid, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
+        self.assertEqual(uids[1].uuid, 'acced28b86278f00a21080d695ecb34b81a1828f')
+        self.assertEqual(uids[2].uuid, 'c6d2504fde0e34b78a185c4b709e5442d045451c')
+        self.assertEqual(uids[3].uuid, 'ebcda394c978d50847d60015892f9ca0f0ccde65')
+
+    def test_count(self):
+        """Check if the total number of unique identities is returned and kept between pages"""
+
+        uuid = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                'John Smith', 'jsmith')
+        api.add_identity(self.db, 'scm', None, None, 'jsmith', uuid=uuid)
+        api.add_identity(self.db, 'scm', 'jsmith@bitergia.com')
+        api.add_identity(self.db, 'mls', 'jsmith@bitergia.com')
+
+        uids, token, ntotal = api.search_unique_identities_page(self.db, 'jsmith', 2,
+                                                                count=True)
+        self.assertEqual(len(uids), 2)
+        self.assertEqual(ntotal, 3)
+
+        # Adding a new identity does not change the count of the search
+        api.add_identity(self.db, 'its', 'jsmith@bitergia.com')
+
+        uids, token, ntotal = api.search_unique_identities_page(self.db, 'jsmith', 2,
+                                                                token=token, count=True)
+        self.assertEqual(ntotal, 3)
+
+        # Counts are calculated again on new searches
+        uids, token, ntotal = api.search_unique_identities_page(self.db, 'jsmith', 2,
+                                                                count=True)
+        self.assertEqual(ntotal, 4)
+
+    def test_empty_registry(self):
+        """Check whether it returns an empty list when the registry is empty"""
+
+        uids, token, ntotal = api.search_unique_identities_page(self.db, None, 100,
+                                                                count=True)
+        self.assertListEqual(uids, [])
+        self.assertIsNone(token)
+        self.assertEqual(ntotal, 0)
+
+    def test_invalid_limit(self):
+        """Check whether it raises an exception when limit value is invalid"""
+
+        self.assertRaises(ValueError, api.search_unique_identities_page,
+                          self.db, None, 0)
+        self.assertRaises(ValueError, api.search_unique_identities_page,
+                          self.db, None, -1)
+
+    def test_invalid_token(self):
+        """Check whether it raises an exception when the token is not valid"""
+
+        self.assertRaises(ValueError, api.search_unique_identities_page,
+                          self.db, None, 10, token='abcdefghij')
+        self.assertRaises(ValueError, api.search_unique_identities_page,
+                          self.db, None, 10, token='e30=')
+
+
 class TestSearchLastModifiedIdentities(TestAPICaseBase):
     """Unit tests for last_modified_identities"""
 
@@ -2978,6 +3519,117 @@ class TestSearchLastModifiedIdentities(TestAPICaseBase):
         self.assertListEqual(uuids, [])
 
 
+class TestChanges(TestAPICaseBase):
+    """Unit tests for changes"""
+
+    def test_changes(self):
+        """Check if it returns the changes made on the registry"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        jsmith_id = api.add_identity(self.db, 'scm', 'jsmith@example.com',
+                                     uuid='John Smith')
+        api.add_organization(self.db, 'Example')
+        api.add_enrollment(self.db, 'John Smith', 'Example')
+        api.edit_profile(self.db, 'John Smith', name='John Smith')
+        api.delete_identity(self.db, jsmith_id)
+
+        changes = api.changes(self.db)
+        self.assertEqual(len(changes), 5)
+
+        entries = [(c.entity, c.action, c.uuid) for c in changes]
+        expected = [('uidentity', 'add', 'John Smith'),
+                    ('identity', 'add', 'John Smith'),
+                    ('enrollment', 'add', 'John Smith'),
+                    ('profile', 'update', 'John Smith'),
+                    ('identity', 'delete', 'John Smith')]
+        self.assertListEqual(entries, expected)
+
+        self.assertEqual(changes[0].eid, 'John Smith')
+        self.assertEqual(changes[1].eid, jsmith_id)
+        self.assertEqual(changes[4].eid, jsmith_id)
+
+        seqs = [c.seq for c in changes]
+        self.assertListEqual(seqs, sorted(seqs))
+
+    def test_after_seq_and_limit(self):
+        """Check if the log can be followed in batches"""
+
+        for uuid in ('A', 'B', 'C', 'D', 'E'):
+            api.add_unique_identity(self.db, uuid)
+
+        changes = api.changes(self.db, limit=2)
+        self.assertListEqual([c.eid for c in changes], ['A', 'B'])
+
+        changes = api.changes(self.db, after_seq=changes[-1].seq, limit=2)
+        self.assertListEqual([c.eid for c in changes], ['C', 'D'])
+
+        changes = api.changes(self.db, after_seq=changes[-1].seq, limit=2)
+        self.assertListEqual([c.eid for c in changes], ['E'])
+
+        changes = api.changes(self.db, after_seq=changes[-1].seq)
+        self.assertListEqual(changes, [])
+
+    def test_merge_logs_changes(self):
+        """Check if merging enrollments logs the bulk changes"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_organization(self.db, 'Example')
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(1900, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(2008, 1, 1),
+                           datetime.datetime(2100, 1, 1))
+
+        last = api.changes(self.db)[-1].seq
+
+        api.merge_enrollments(self.db, 'John Smith', 'Example')
+
+        changes = api.changes(self.db, after_seq=last)
+        actions = sorted(c.action for c in changes)
+        self.assertListEqual(actions, ['add', 'delete', 'delete'])
+
+        enrollments = api.enrollments(self.db, 'John Smith')
+        added = [c for c in changes if c.action == 'add'][0]
+        self.assertEqual(added.eid, str(enrollments[0].id))
+
+    def test_commit_order(self):
+        """Check if changes are numbered in the order they are committed"""
+
+        with self.db.connect() as first:
+            log_change(first, 'uidentity', 'A', Change.ADD, uuid='A')
+            first.flush()
+
+            # This transaction starts later but commits first
+            with self.db.connect() as second:
+                log_change(second, 'uidentity', 'B', Change.ADD, uuid='B')
+
+            changes = api.changes(self.db)
+            self.assertListEqual([c.eid for c in changes], ['B'])
+            last = changes[-1].seq
+
+        # Following the log from the last change returns the other one
+        changes = api.changes(self.db, after_seq=last)
+        self.assertListEqual([c.eid for c in changes], ['A'])
+        self.assertGreater(changes[0].seq, last)
+
+    def test_rollback(self):
+        """Check if changes are not logged when an operation fails"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+
+        self.assertRaises(AlreadyExistsError, api.add_unique_identity,
+                          self.db, 'John Smith')
+
+        changes = api.changes(self.db)
+        self.assertEqual(len(changes), 1)
+
+    def test_invalid_limit(self):
+        """Check if it fails when limit is not valid"""
+
+        self.assertRaises(ValueError, api.changes, self.db, limit=0)
+
+
 class TestSearchProfiles(TestAPICaseBase):
     """Unit tests for search_profiles"""
 
@@ -3264,6 +3916,40 @@ class TestDomains(TestAPICaseBase):
         self.assertEqual(dom0.domain, 'u.example.com')
         self.assertEqual(dom0.organization.name, 'Example')
 
+    def test_top_domains_updated(self):
+        """Check if top domains are updated when the registry changes"""
+
+        api.add_organization(self.db, 'Example')
+        api.add_domain(self.db, 'Example', 'example.com', is_top_domain=True)
+
+        doms = api.domains(self.db, 'u.example.com', top=True)
+        self.assertEqual(len(doms), 1)
+        self.assertEqual(doms[0].domain, 'example.com')
+
+        # New top domains are found
+        api.add_organization(self.db, 'Bitergia')
+        api.add_domain(self.db, 'Bitergia', 'u.example.com', is_top_domain=True)
+
+        doms = api.domains(self.db, 'es.u.example.com', top=True)
+        self.assertEqual(len(doms), 2)
+        self.assertEqual(doms[0].domain, 'example.com')
+        self.assertEqual(doms[1].domain, 'u.example.com')
+        self.assertEqual(doms[1].organization.name, 'Bitergia')
+
+        # Updated domains are found
+        api.add_domain(self.db, 'Example', 'u.example.com',
+                       is_top_domain=False, overwrite=True)
+
+        doms = api.domains(self.db, 'es.u.example.com', top=True)
+        self.assertEqual(len(doms), 1)
+        self.assertEqual(doms[0].domain, 'example.com')
+
+        # Removed domains are not found
+        api.delete_organization(self.db, 'Example')
+
+        self.assertRaises(NotFoundError, api.domains,
+                          self.db, 'es.u.example.com', True)
+
     def test_empty_registry(self):
         """Check whether it returns an empty list when the registry is empty"""
 
@@ -3713,6 +4399,196 @@ class TestEnrollments(TestAPICaseBase):
                                'John Smith', 'LibreSoft')
 
 
+class TestEnrollmentsByUUID(TestAPICaseBase):
+    """Unit tests for enrollments_by_uuid"""
+
+    def test_enrollments_by_uuid(self):
+        """Check if it returns the enrollments grouped by uuid"""
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_unique_identity(self.db, 'John Doe')
+        api.add_unique_identity(self.db, 'Jane Rae')
+
+        api.add_organization(self.db, 'Example')
+        api.add_enrollment(self.db, 'John Smith', 'Example')
+        api.add_enrollment(self.db, 'John Doe', 'Example')
+
+        api.add_organization(self.db, 'Bitergia')
+        api.add_enrollment(self.db, 'John Smith', 'Bitergia')
+        api.add_enrollment(self.db, 'John Smith', 'Bitergia',
+                           datetime.datetime(1999, 1, 1),
+                           datetime.datetime(2000, 1, 1))
+
+        enrollments = api.enrollments_by_uuid(self.db,
+                                              ['John Smith', 'Jane Rae',
+                                               'John Smith', 'Unknown'],
+                                              chunk_size=1)
+
+        self.assertListEqual(sorted(enrollments.keys()),
+                             ['Jane Rae', 'John Smith', 'Unknown'])
+        self.assertListEqual(enrollments['Jane Rae'], [])
+        self.assertListEqual(enrollments['Unknown'], [])
+
+        rols = enrollments['John Smith']
+        self.assertEqual(len(rols), 3)
+
+        rol = rols[0]
+        self.assertIsInstance(rol, Enrollment)
+        self.assertEqual(rol.uidentity.uuid, 'John Smith')
+        self.assertEqual(rol.organization.name, 'Bitergia')
+        self.assertEqual(rol.start, datetime.datetime(1900, 1, 1))
+
+        rol = rols[1]
+        self.assertEqual(rol.organization.name, 'Bitergia')
+        self.assertEqual(rol.start, datetime.datetime(1999, 1, 1))
+        self.assertEqual(rol.end, datetime.datetime(2000, 1, 1))
+
+        rol = rols[2]
+        self.assertEqual(rol.organization.name, 'Example')
+
+    def test_empty_uuids(self):
+        """Check if it returns an empty dict when no uuids are given"""
+
+        enrollments = api.enrollments_by_uuid(self.db, [])
+        self.assertDictEqual(enrollments, {})
+
+    def test_invalid_chunk_size(self):
+        """Check if it fails when chunk size is not valid"""
+
+        self.assertRaises(ValueError, api.enrollments_by_uuid,
+                          self.db, ['John Smith'], chunk_size=0)
+
+
+class TestAffiliationAt(TestAPICaseBase):
+    """Unit tests for affiliation_at and affiliations_at"""
+
+    def setUp(self):
+        super(TestAffiliationAt, self).setUp()
+
+        api.add_unique_identity(self.db, 'John Smith')
+        api.add_unique_identity(self.db, 'John Doe')
+        api.add_organization(self.db, 'Example')
+        api.add_organization(self.db, 'Bitergia')
+
+        api.add_enrollment(self.db, 'John Smith', 'Example',
+                           datetime.datetime(1900, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.add_enrollment(self.db, 'John Smith', 'Bitergia',
+                           datetime.datetime(2008, 1, 1),
+                           datetime.datetime(2100, 1, 1))
+
+    def tearDown(self):
+        disable_affiliations_cache()
+        super(TestAffiliationAt, self).tearDown()
+
+    def test_affiliation_at(self):
+        """Check if it returns the organization on the given date"""
+
+        org = api.affiliation_at(self.db, 'John Smith',
+                                 datetime.datetime(2000, 1, 1))
+        self.assertEqual(org, 'Example')
+
+        org = api.affiliation_at(self.db, 'John Smith',
+                                 datetime.datetime(2015, 1, 1))
+        self.assertEqual(org, 'Bitergia')
+
+        # Overlapping enrollments; the latest one is selected
+        org = api.affiliation_at(self.db, 'John Smith',
+                                 datetime.date(2009, 1, 1))
+        self.assertEqual(org, 'Bitergia')
+
+        org = api.affiliation_at(self.db, 'John Doe',
+                                 datetime.datetime(2000, 1, 1))
+        self.assertIsNone(org)
+
+    def test_timezone(self):
+        """Check if dates with timezone are converted to UTC"""
+
+        tz = datetime.timezone(datetime.timedelta(hours=-2))
+        date = datetime.datetime(2010, 1, 1, 1, 0, 0, tzinfo=tz)
+
+        org = api.affiliation_at(self.db, 'John Smith', date)
+        self.assertEqual(org, 'Bitergia')
+
+        date = datetime.datetime(2009, 12, 31, 23, 0, 0, tzinfo=tz)
+
+        org = api.affiliation_at(self.db, 'John Smith', date)
+        self.assertEqual(org, 'Bitergia')
+
+    def test_not_found(self):
+        """Check if it fails when the unique identity does not exist"""
+
+        self.assertRaisesRegex(NotFoundError,
+                               NOT_FOUND_ERROR % {'entity': 'Jane Rae'},
+                               api.affiliation_at, self.db, 'Jane Rae',
+                               datetime.datetime(2000, 1, 1))
+
+    def test_invalid_date(self):
+        """Check if it fails when the date is not valid"""
+
+        self.assertRaises(ValueError, api.affiliation_at,
+                          self.db, 'John Smith', '2000-01-01')
+
+    def test_affiliations_at(self):
+        """Check if it returns the organizations of several pairs"""
+
+        pairs = [('John Smith', datetime.datetime(2000, 1, 1)),
+                 ('Jane Rae', datetime.datetime(2000, 1, 1)),
+                 ('John Doe', datetime.datetime(2000, 1, 1)),
+                 ('John Smith', datetime.datetime(2015, 1, 1))]
+
+        orgs = api.affiliations_at(self.db, pairs, chunk_size=1)
+        self.assertListEqual(orgs, ['Example', None, None, 'Bitergia'])
+
+        orgs = api.affiliations_at(self.db, [])
+        self.assertListEqual(orgs, [])
+
+        self.assertRaises(ValueError, api.affiliations_at,
+                          self.db, pairs, chunk_size=0)
+
+    def test_cache(self):
+        """Check if cached affiliations are invalidated on changes"""
+
+        cache = enable_affiliations_cache()
+        date = datetime.datetime(2000, 1, 1)
+
+        org = api.affiliation_at(self.db, 'John Doe', date)
+        self.assertIsNone(org)
+
+        org = api.affiliation_at(self.db, 'John Doe', date)
+        self.assertIsNone(org)
+        self.assertDictEqual(cache.stats(),
+                             {'size': 1, 'hits': 1, 'misses': 1})
+
+        api.add_enrollment(self.db, 'John Doe', 'Example')
+
+        org = api.affiliation_at(self.db, 'John Doe', date)
+        self.assertEqual(org, 'Example')
+
+        # Bulk changes also invalidate the cache
+        api.add_enrollment(self.db, 'John Doe', 'Bitergia',
+                           datetime.datetime(1999, 1, 1),
+                           datetime.datetime(2005, 1, 1))
+        api.add_enrollment(self.db, 'John Doe', 'Bitergia',
+                           datetime.datetime(2004, 1, 1),
+                           datetime.datetime(2010, 1, 1))
+        api.affiliation_at(self.db, 'John Doe', date)
+        api.merge_enrollments(self.db, 'John Doe', 'Bitergia')
+
+        org = api.affiliation_at(self.db, 'John Doe',
+                                 datetime.datetime(2007, 1, 1))
+        self.assertEqual(org, 'Bitergia')
+
+        api.delete_organization(self.db, 'Bitergia')
+
+        org = api.affiliation_at(self.db, 'John Doe', date)
+        self.assertEqual(org, 'Example')
+
+        api.delete_unique_identity(self.db, 'John Doe')
+        self.assertRaises(NotFoundError, api.affiliation_at,
+                          self.db, 'John Doe', date)
+
+
 class TestBlacklist(TestAPICaseBase):
     """Unit tests for blacklist"""
 
@@ -20,7 +20,12 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import datetime
+import json
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 if '..' not in sys.path:
@@ -42,6 +47,12 @@ Unique identity 17ab00ed3825ec2f50483e33c88df223264182ba (jroe@example.com) affi
 Unique identity 17ab00ed3825ec2f50483e33c88df223264182ba (jroe@bitergia.com) affiliated to Bitergia
 Unique identity dc31d2afbee88a6d1dbc1ef05ec827b878067744 (jsmith@us.example.com) affiliated to Example"""
 
+AFFILIATE_SINCE_OUTPUT = """Unique identity 108f508fea9861d86c8d07a197489cc630bec446 (janedoe@it.u.example.com) affiliated to Example Alt"""
+
+AFFILIATE_DOMAIN_OUTPUT = """Unique identity dc31d2afbee88a6d1dbc1ef05ec827b878067744 (jsmith@example.net) affiliated to LibreSoft"""
+
+AFFILIATE_DELETED_DOMAIN_OUTPUT = """Unique identity 108f508fea9861d86c8d07a197489cc630bec446 (janedoe@it.u.example.com) affiliated to Example"""
+
 AFFILIATE_EMPTY_OUTPUT = ""
 
 MULTIPLE_DOMAIN_WARNING = "Warning: multiple top domains for %(subdomain)s sub-domain. Domain %(domain)s selected."
@@ -161,6 +172,140 @@ class TestAffiliate(TestAffiliateCaseBase):
                          MULTIPLE_DOMAIN_WARNING % {'subdomain': 'it.u.example.com',
                                                     'domain': 'u.example.com'})
 
+    def test_enrollments_stored(self):
+        """Check if new enrollments are stored in the registry"""
+
+        uuid = '17ab00ed3825ec2f50483e33c88df223264182ba'
+        before = api.unique_identities(self.db, uuid)[0].last_modified
+
+        code = self.cmd.affiliate()
+        self.assertEqual(code, CMD_SUCCESS)
+
+        enrollments = api.enrollments(self.db, uuid)
+        self.assertEqual(len(enrollments), 2)
+        self.assertEqual(enrollments[0].organization.name, 'Bitergia')
+        self.assertEqual(enrollments[1].organization.name, 'Example')
+
+        after = api.unique_identities(self.db, uuid)[0].last_modified
+        self.assertGreater(after, before)
+
+        # Running it again does not create new enrollments
+        code = self.cmd.affiliate()
+        self.assertEqual(code, CMD_SUCCESS)
+
+        output = sys.stdout.getvalue().strip()
+        self.assertEqual(output, AFFILIATE_OUTPUT)
+
+        enrollments = api.enrollments(self.db)
+        self.assertEqual(len(enrollments), 4)
+
+        # New enrollments were logged
+        changes = [c for c in api.changes(self.db)
+                   if c.entity == 'enrollment' and c.action == 'add']
+        self.assertListEqual(sorted(c.eid for c in changes),
+                             sorted(str(enr.id) for enr in enrollments))
+
+    def test_since(self):
+        """Check if only unique identities modified since the given date are affiliated"""
+
+        before = datetime.datetime.utcnow()
+
+        api.add_identity(self.db, 'scm', 'janedoe@it.u.example.com')
+
+        code = self.cmd.affiliate(since=before)
+        self.assertEqual(code, CMD_SUCCESS)
+
+        output = sys.stdout.getvalue().strip()
+        self.assertEqual(output, AFFILIATE_SINCE_OUTPUT)
+
+    def test_watermark(self):
+        """Check incremental runs using a watermark file"""
+
+        tmpdir = tempfile.mkdtemp(prefix='sortinghat_')
+        watermark = os.path.join(tmpdir, 'watermark.json')
+
+        try:
+            # First run affiliates everything
+            code = self.cmd.affiliate(watermark=watermark)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            output = sys.stdout.getvalue().strip()
+            self.assertEqual(output, AFFILIATE_OUTPUT)
+
+            with open(watermark, 'r') as f:
+                obj = json.load(f)
+            self.assertIn('time', obj)
+            self.assertListEqual(obj['domains']['u.example.com'],
+                                 [True, obj['domains']['u.example.com'][1], 'Example Alt'])
+
+            # Nothing changed, so nothing is affiliated
+            code = self.cmd.affiliate(watermark=watermark)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            output = sys.stdout.getvalue().strip()
+            self.assertEqual(output, AFFILIATE_OUTPUT)
+
+            # New domains affiliate old identities
+            api.add_domain(self.db, 'LibreSoft', 'example.net')
+
+            code = self.cmd.affiliate(watermark=watermark)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            output = sys.stdout.getvalue().strip()
+            self.assertEqual(output, AFFILIATE_OUTPUT + '\n' + AFFILIATE_DOMAIN_OUTPUT)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_watermark_deleted_domains(self):
+        """Check if identities on domains deleted since the last run are affiliated"""
+
+        tmpdir = tempfile.mkdtemp(prefix='sortinghat_')
+        watermark = os.path.join(tmpdir, 'watermark.json')
+
+        api.add_identity(self.db, 'scm', 'janedoe@it.u.example.com')
+
+        try:
+            code = self.cmd.affiliate(watermark=watermark)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            output = sys.stdout.getvalue().strip()
+            self.assertEqual(output, AFFILIATE_OUTPUT_ALT)
+
+            # Nothing changed, so nothing is affiliated
+            code = self.cmd.affiliate(watermark=watermark)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            output = sys.stdout.getvalue().strip()
+            self.assertEqual(output, AFFILIATE_OUTPUT_ALT)
+
+            # Without its top domain, the email falls on 'example.com'
+            api.delete_domain(self.db, 'Example Alt', 'u.example.com')
+
+            code = self.cmd.affiliate(watermark=watermark)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            output = sys.stdout.getvalue().strip()
+            self.assertEqual(output, AFFILIATE_OUTPUT_ALT + '\n' + AFFILIATE_DELETED_DOMAIN_OUTPUT)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_invalid_watermark(self):
+        """Check if it fails when the watermark file is not valid"""
+
+        tmpfile = tempfile.mkstemp()[1]
+
+        try:
+            with open(tmpfile, 'w') as f:
+                f.write('{"time": "2018-01-01"}')
+
+            code = self.cmd.affiliate(watermark=tmpfile)
+            self.assertNotEqual(code, CMD_SUCCESS)
+
+            output = sys.stderr.getvalue().strip()
+            self.assertTrue(output.startswith('Error: invalid watermark file'))
+        finally:
+            os.remove(tmpfile)
+
     def test_empty_registry(self):
         """Check output when the registry is empty"""
 
@@ -21,9 +21,13 @@
 #
 
 import datetime
+import json
 import os.path
+import shutil
 import sys
+import tempfile
 import unittest
+import unittest.mock
 import warnings
 
 if '..' not in sys.path:
@@ -31,10 +35,12 @@ if '..' not in sys.path:
 
 from sortinghat import api
 from sortinghat.command import CMD_SUCCESS
-from sortinghat.cmd.load import Load
-from sortinghat.db.model import Country
+from sortinghat.cmd.load import Load, _Journal, _LoadState
+from sortinghat.db.model import Country, Profile
+from sortinghat.matcher import create_identity_matcher
 from sortinghat.parsing.sh import SortingHatParser
-from sortinghat.exceptions import CODE_MATCHER_NOT_SUPPORTED_ERROR, CODE_INVALID_FORMAT_ERROR
+from sortinghat.exceptions import CODE_MATCHER_NOT_SUPPORTED_ERROR, CODE_INVALID_FORMAT_ERROR, \
+    CODE_LOAD_ERROR, CODE_VALUE_ERROR, AlreadyExistsError, NotFoundError
 
 from tests.base import TestCommandCaseBase, datadir
 
@@ -45,15 +51,18 @@ LOAD_IDENTITIES_MATCHING_ERROR = "Error: mock identity matcher is not supported"
 LOAD_ORGS_INVALID_FORMAT_ERROR = r"Error: invalid json format\. Expecting .+ line \d+ column \d+ \(char \d+\)"
 LOAD_ORGS_MISSING_KEYS_ERROR = "Error: invalid json format. Attribute is_top not found"
 LOAD_ORGS_IS_TOP_ERROR = "Error: invalid json format. 'is_top' must have a bool value"
+LOAD_INVALID_JOBS_ERROR = "Error: 'jobs' must be greater than 0"
+LOAD_STDIN_JOBS_ERROR = "Error: '--jobs' cannot be used reading from the standard input"
+LOAD_RESUME_NO_CHECKPOINT_ERROR = "Error: '--resume' requires a checkpoint file"
+LOAD_CHECKPOINT_JOBS_ERROR = "Error: checkpoints can only be used loading a single input with one job"
+LOAD_CHECKPOINT_MISMATCH_ERROR = r"Error: checkpoint file .+ does not match the input"
+LOAD_PROGRESS_OUTPUT = r"\d+ unique identities processed \(\d+\.\d/s, \d+%"
 
 # Output
 
-LOAD_OUTPUT = """Domain api.bitergia.com added to organization Bitergia
-Domain bitergia.com added to organization Bitergia
-Domain bitergia.net added to organization Bitergia
-Domain test.bitergia.com added to organization Bitergia
-Domain example.com added to organization Example
-Domain example.net added to organization Example
+LOAD_OUTPUT = """Loading organizations...
+3/3 organizations loaded
+6/6 domains loaded
 Loading blacklist...
 Entry  added to the blacklist
 Entry  added to the blacklist
@@ -145,6 +154,8 @@ Loading unique identities...
 -- profile e8284285566fdc1f41c8a22bb84a295fc3c4cbb3 updated
 -- loading enrollments
 -- enrollments loaded
++ e8284285566fdc1f41c8a22bb84a295fc3c4cbb3 (old e8284285566fdc1f41c8a22bb84a295fc3c4cbb3) loaded
+=====
 
 New match found
 
@@ -154,29 +165,33 @@ New match found
 + 8253035bc847e70ddd13f7a721faf6f3dd159d7a
   * -	jsmith@example	-	unknown
 Unique identity e8284285566fdc1f41c8a22bb84a295fc3c4cbb3 merged on 8253035bc847e70ddd13f7a721faf6f3dd159d7a
-+ 8253035bc847e70ddd13f7a721faf6f3dd159d7a (old e8284285566fdc1f41c8a22bb84a295fc3c4cbb3) loaded
-=====
 1/1 unique identities loaded"""
 
 # Organization outputs
 
-LOAD_SH_ORGS_OUTPUT = """Domain api.bitergia.com added to organization Bitergia
-Domain bitergia.com added to organization Bitergia
-Domain bitergia.net added to organization Bitergia
-Domain test.bitergia.com added to organization Bitergia
-Domain example.net added to organization Bitergia
-Domain example.com added to organization Example"""
-
-LOAD_ORGS_OVERWRITE_OUTPUT = """Domain api.bitergia.com added to organization Bitergia
-Domain bitergia.com added to organization Bitergia
-Domain bitergia.net added to organization Bitergia
-Domain test.bitergia.com added to organization Bitergia
-Domain example.net added to organization Bitergia
-Domain example.com added to organization Example
-Domain example.net added to organization Example"""
+LOAD_SH_ORGS_OUTPUT = """Loading organizations...
+3/3 organizations loaded
+6/7 domains loaded"""
+
+LOAD_ORGS_OVERWRITE_OUTPUT = """Loading organizations...
+3/3 organizations loaded
+7/7 domains loaded"""
+
+LOAD_ORGS_RELOAD_OUTPUT = """Loading organizations...
+2/3 organizations loaded
+5/7 domains loaded"""
+
+LOAD_ORGS_COLLATION_OUTPUT = """Loading organizations...
+1/2 organizations loaded
+2/2 domains loaded"""
+
+LOAD_ORGS_COLLATION_WARNING = """Warning: Organization 'Bitérgia' already exists in the registry. Organization not updated."""
 
 LOAD_ORGS_OUTPUT_WARNING = """Warning: Domain 'example.net' already exists in the registry. Not updated."""
 
+LOAD_ORGS_RELOAD_WARNING = """Warning: Domain 'bitergia.com' already exists in the registry. Not updated.
+Warning: Domain 'example.net' already exists in the registry. Not updated."""
+
 
 class TestLoadCaseBase(TestCommandCaseBase):
     """Defines common setup and teardown methods on loadunit tests"""
@@ -192,6 +207,13 @@ class TestLoadCaseBase(TestCommandCaseBase):
     def sort_identities(self, ids):
         return sorted(ids, key=lambda x: x.id)
 
+    def patch_cmd(self, attribute, value):
+        """Set an attribute of the shared command until the test ends"""
+
+        patcher = unittest.mock.patch.object(self.cmd, attribute, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def load_test_dataset(self):
         # Add country
         with self.db.connect() as session:
@@ -277,6 +299,193 @@ class TestLoadCommand(TestLoadCaseBase):
         output = sys.stderr.getvalue().strip().split('\n')[0]
         self.assertEqual(output, LOAD_IDENTITIES_INVALID_JSON_FORMAT_ERROR)
 
+    def test_load_several_files(self):
+        """Test to load identities from several files and directories"""
+
+        def registry():
+            uids = api.unique_identities(self.db)
+            return {uid.uuid: sorted(i.id for i in uid.identities)
+                    for uid in uids}
+
+        tmpdir = tempfile.mkdtemp(prefix='sortinghat_')
+
+        try:
+            files = [datadir('sortinghat_valid.json'),
+                     datadir('sortinghat_valid_updated.json'),
+                     datadir('sortinghat_no_strict_valid.json')]
+
+            for name in files:
+                shutil.copy(name, tmpdir)
+
+            code = self.cmd.run('--identities', *files)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            expected = registry()
+            self.assertEqual(len(expected), 4)
+
+            # Files of a directory are loaded concurrently
+            self.db.clear()
+
+            code = self.cmd.run('--identities', '--jobs', '2', tmpdir)
+            self.assertEqual(code, CMD_SUCCESS)
+            self.assertDictEqual(registry(), expected)
+
+            # Loading them again does not change the registry
+            code = self.cmd.run('--identities', '--jobs', '2', *files)
+            self.assertEqual(code, CMD_SUCCESS)
+            self.assertDictEqual(registry(), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_load_several_files_in_groups(self):
+        """Test if unique identities of several files are loaded in groups"""
+
+        files = [datadir('sortinghat_valid.json'),
+                 datadir('sortinghat_valid_updated.json')]
+
+        self.cmd.BATCH_SIZE = 1
+        load_partitions = self.cmd._Load__load_partitions
+
+        with unittest.mock.patch.object(self.cmd, '_Load__load_partitions',
+                                        wraps=load_partitions) as mock_load:
+            code = self.cmd.run('--identities', '--jobs', '2', *files)
+
+        self.assertEqual(code, CMD_SUCCESS)
+
+        # Each group has, at most, a batch per job
+        sizes = [len(args[0]) for args, _ in mock_load.call_args_list]
+        self.assertGreater(len(sizes), 1)
+        self.assertLessEqual(max(sizes), 2)
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 3)
+
+    def test_load_several_files_invalid_file(self):
+        """Test if nothing is loaded when any of the files is invalid"""
+
+        code = self.cmd.run('--identities', '--jobs', '2',
+                            datadir('sortinghat_valid.json'),
+                            datadir('sortinghat_invalid.json'))
+        self.assertEqual(code, CODE_INVALID_FORMAT_ERROR)
+
+        output = sys.stderr.getvalue().strip().split('\n')[0]
+        expected = datadir('sortinghat_invalid.json') + ': ' + LOAD_IDENTITIES_INVALID_JSON_FORMAT_ERROR[7:]
+        self.assertEqual(output, 'Error: ' + expected)
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 0)
+
+    def test_invalid_jobs(self):
+        """Test if it fails when the number of jobs is not valid"""
+
+        code = self.cmd.run('--jobs', '0', datadir('sortinghat_valid.json'))
+        self.assertEqual(code, CODE_VALUE_ERROR)
+
+        output = sys.stderr.getvalue().strip()
+        self.assertEqual(output, LOAD_INVALID_JOBS_ERROR)
+
+    def test_jobs_standard_input(self):
+        """Test if it fails when several jobs read the standard input"""
+
+        code = self.cmd.run('--jobs', '2')
+        self.assertEqual(code, CODE_VALUE_ERROR)
+
+        code = self.cmd.run('--jobs', '2', datadir('sortinghat_valid.json'), '-')
+        self.assertEqual(code, CODE_VALUE_ERROR)
+
+        output = sys.stderr.getvalue().strip().split('\n')
+        self.assertEqual(output, [LOAD_STDIN_JOBS_ERROR, LOAD_STDIN_JOBS_ERROR])
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 0)
+
+    def test_load_resume(self):
+        """Test if an interrupted load is resumed from its checkpoint"""
+
+        def registry():
+            uids = api.unique_identities(self.db)
+            return {uid.uuid: sorted(i.id for i in uid.identities)
+                    for uid in uids}
+
+        code = self.cmd.run('--identities', datadir('sortinghat_valid.json'))
+        self.assertEqual(code, CMD_SUCCESS)
+        expected = registry()
+
+        self.db.clear()
+
+        tmpdir = tempfile.mkdtemp(prefix='sortinghat_')
+        checkpoint = os.path.join(tmpdir, 'load.log')
+
+        commit = _Journal.commit
+        commits = []
+
+        def interrupt(journal, *args):
+            if commits:
+                raise RuntimeError("interrupted")
+            commits.append(args)
+            commit(journal, *args)
+
+        try:
+            self.patch_cmd('BATCH_SIZE', 1)
+
+            with unittest.mock.patch.object(_Journal, 'commit', autospec=True,
+                                            side_effect=interrupt):
+                with self.assertRaises(RuntimeError):
+                    self.cmd.run('--identities', '--checkpoint', checkpoint,
+                                 datadir('sortinghat_valid.json'))
+
+            code = self.cmd.run('--identities', '--checkpoint', checkpoint, '--resume',
+                                datadir('sortinghat_valid.json'))
+            self.assertEqual(code, CMD_SUCCESS)
+            self.assertDictEqual(registry(), expected)
+
+            output = sys.stdout.getvalue()
+            self.assertIn("Resuming after 1 unique identities", output)
+
+            # A completed load is not run again
+            code = self.cmd.run('--identities', '--checkpoint', checkpoint, '--resume',
+                                datadir('sortinghat_valid.json'))
+            self.assertEqual(code, CMD_SUCCESS)
+            self.assertDictEqual(registry(), expected)
+
+            # The checkpoint was recorded for another input
+            code = self.cmd.run('--identities', '--checkpoint', checkpoint, '--resume',
+                                datadir('sortinghat_valid_updated.json'))
+            self.assertEqual(code, CODE_LOAD_ERROR)
+
+            output = sys.stderr.getvalue().strip().split('\n')[-1]
+            self.assertRegex(output, LOAD_CHECKPOINT_MISMATCH_ERROR)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_invalid_checkpoint_options(self):
+        """Test if it fails when checkpoint options are not valid"""
+
+        code = self.cmd.run('--resume', datadir('sortinghat_valid.json'))
+        self.assertEqual(code, CODE_VALUE_ERROR)
+
+        output = sys.stderr.getvalue().strip().split('\n')[-1]
+        self.assertEqual(output, LOAD_RESUME_NO_CHECKPOINT_ERROR)
+
+        code = self.cmd.run('--jobs', '2', '--checkpoint', '/tmp/load.log',
+                            datadir('sortinghat_valid.json'))
+        self.assertEqual(code, CODE_VALUE_ERROR)
+
+        output = sys.stderr.getvalue().strip().split('\n')[-1]
+        self.assertEqual(output, LOAD_CHECKPOINT_JOBS_ERROR)
+
+    def test_load_progress(self):
+        """Test if the progress of the load is reported"""
+
+        self.patch_cmd('BATCH_SIZE', 1)
+        self.patch_cmd('PROGRESS_INTERVAL', 0)
+
+        code = self.cmd.run('--identities', datadir('sortinghat_valid.json'))
+        self.assertEqual(code, CMD_SUCCESS)
+
+        output = sys.stdout.getvalue()
+        self.assertRegex(output, LOAD_PROGRESS_OUTPUT)
+
     def test_load_organizations(self):
         """Test to load organizations from a file"""
 
@@ -295,6 +504,44 @@ class TestLoadCommand(TestLoadCaseBase):
         output = sys.stderr.getvalue().strip()
         self.assertEqual(output, LOAD_ORGS_OUTPUT_WARNING)
 
+    def test_load_organizations_by_row(self):
+        """Test if organizations are loaded one by one when the bulk load fails"""
+
+        error = AlreadyExistsError(entity='Organization', eid='Example')
+
+        with unittest.mock.patch.object(Load, '_Load__import_organizations_in_bulk',
+                                        side_effect=error):
+            code = self.cmd.run('--orgs', datadir('sortinghat_orgs_valid.json'))
+            self.assertEqual(code, CMD_SUCCESS)
+
+        orgs = api.registry(self.db)
+        self.assertEqual(len(orgs), 3)
+
+        output = sys.stdout.getvalue().strip()
+        self.assertEqual(output, LOAD_SH_ORGS_OUTPUT)
+
+        output = sys.stderr.getvalue().strip()
+        self.assertEqual(output, LOAD_ORGS_OUTPUT_WARNING)
+
+    def test_load_organizations_equal_on_collation(self):
+        """Test if organizations the registry considers equal are only added once"""
+
+        code = self.cmd.run('--orgs', datadir('sortinghat_orgs_collation.json'))
+        self.assertEqual(code, CMD_SUCCESS)
+
+        output = sys.stdout.getvalue().strip()
+        self.assertEqual(output, LOAD_ORGS_COLLATION_OUTPUT)
+
+        output = sys.stderr.getvalue().strip()
+        self.assertEqual(output, '')
+
+        orgs = api.registry(self.db)
+        self.assertEqual(len(orgs), 1)
+        self.assertEqual(orgs[0].name, 'Bitergia')
+
+        domains = [dom.domain for dom in orgs[0].domains]
+        self.assertListEqual(sorted(domains), ['bitergia.com', 'bitergia.org'])
+
     def test_load_organizations_overwrite(self):
         """Test to load organizations from a file with overwrite parameter set"""
 
@@ -304,6 +551,48 @@ class TestLoadCommand(TestLoadCaseBase):
         output = sys.stdout.getvalue().strip()
         self.assertEqual(output, LOAD_ORGS_OVERWRITE_OUTPUT)
 
+        # The last organization given for a domain is the one assigned
+        domains = {dom.domain: (dom.organization.name, dom.is_top_domain)
+                   for dom in api.domains(self.db)}
+        self.assertEqual(len(domains), 6)
+        self.assertEqual(domains['example.net'], ('Example', True))
+        self.assertEqual(domains['bitergia.com'], ('Bitergia', True))
+        self.assertEqual(domains['api.bitergia.com'], ('Bitergia', False))
+
+    def test_load_organizations_reload(self):
+        """Test to load organizations that are already in the registry"""
+
+        api.add_organization(self.db, 'Example')
+        api.add_domain(self.db, 'Example', 'bitergia.com', is_top_domain=False)
+
+        code = self.cmd.run('--orgs', datadir('sortinghat_orgs_valid.json'))
+        self.assertEqual(code, CMD_SUCCESS)
+
+        output = sys.stdout.getvalue().strip()
+        self.assertEqual(output, LOAD_ORGS_RELOAD_OUTPUT)
+
+        output = sys.stderr.getvalue().strip()
+        self.assertEqual(output, LOAD_ORGS_RELOAD_WARNING)
+
+        # Stored domains are only reassigned with overwrite
+        domains = {dom.domain: (dom.organization.name, dom.is_top_domain)
+                   for dom in api.domains(self.db)}
+        self.assertEqual(len(domains), 6)
+        self.assertEqual(domains['bitergia.com'], ('Example', False))
+
+        code = self.cmd.run('--orgs', '--overwrite',
+                            datadir('sortinghat_orgs_valid.json'))
+        self.assertEqual(code, CMD_SUCCESS)
+
+        domains = {dom.domain: (dom.organization.name, dom.is_top_domain)
+                   for dom in api.domains(self.db)}
+        self.assertEqual(len(domains), 6)
+        self.assertEqual(domains['bitergia.com'], ('Bitergia', True))
+        self.assertEqual(domains['example.net'], ('Example', True))
+
+        orgs = api.registry(self.db)
+        self.assertEqual(len(orgs), 3)
+
     def test_invalid_format(self):
         """Check whether it prints an error when parsing invalid files"""
 
@@ -651,6 +940,77 @@ class TestLoadIdentities(TestLoadCaseBase):
         self.assertEqual(ids[1].id, '880b3dfcb3a08712e5831bddc3dfe81fc5d7b331')
         self.assertEqual(ids[2].id, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
 
+    def test_matching_merge_order(self):
+        """Check if profiles are merged as when matching one by one"""
+
+        def uidentity(uuid, name, email):
+            return {'uuid': uuid,
+                    'profile': {'uuid': uuid, 'name': name, 'email': None,
+                                'gender': None, 'is_bot': False,
+                                'country': None},
+                    'identities': [{'id': uuid, 'uuid': uuid, 'name': None,
+                                    'email': email, 'username': uuid.lower(),
+                                    'source': 'scm'}],
+                    'enrollments': []}
+
+        # Loaded in uuid order; '0000' matches both stored unique
+        # identities and 'CCCC' matches '0000' once it is loaded
+        content = json.dumps({
+            'blacklist': [],
+            'organizations': {},
+            'uidentities': {
+                '0000': uidentity('0000', 'Jane Smith', 'jsmith@example.com'),
+                'CCCC': uidentity('CCCC', 'J. Smith', 'jsmith@example.com')
+            }
+        })
+
+        def add_stored():
+            for uuid, name in (('AAAA', 'John Smith'), ('BBBB', None)):
+                api.add_unique_identity(self.db, uuid)
+                api.add_identity(self.db, 'git', email='jsmith@example.com',
+                                 username=uuid.lower(), uuid=uuid)
+                api.edit_profile(self.db, uuid, name=name)
+
+        def registry():
+            return [(uid.uuid, uid.profile.name, len(uid.identities))
+                    for uid in api.unique_identities(self.db)]
+
+        add_stored()
+
+        code = self.cmd.import_identities(SortingHatParser(content),
+                                          matching='default')
+        self.assertEqual(code, CMD_SUCCESS)
+        loaded = registry()
+
+        # Load again, this time merging each unique identity right
+        # after loading it, as the command used to do
+        self.db.clear()
+        self.load_test_dataset()
+        add_stored()
+
+        matcher = create_identity_matcher('default')
+
+        for uuid in ('0000', 'CCCC'):
+            stored = {uid.uuid for uid in api.unique_identities(self.db)}
+
+            self.cmd.import_identities(SortingHatParser(json.dumps({
+                'blacklist': [],
+                'organizations': {},
+                'uidentities': {uuid: json.loads(content)['uidentities'][uuid]}
+            })))
+
+            uid = [uid for uid in api.unique_identities(self.db)
+                   if uid.uuid not in stored][0]
+
+            for match in api.match_identities(self.db, uid.uuid, matcher):
+                api.merge_unique_identities(self.db, uid.uuid, match.uuid)
+                uid = match
+
+        expected = registry()
+
+        self.assertListEqual(loaded, expected)
+        self.assertListEqual(loaded, [('BBBB', 'John Smith', 4)])
+
     def test_matching_no_strict(self):
         """Check if identities with no strict matching are merged"""
 
@@ -860,6 +1220,33 @@ class TestLoadIdentities(TestLoadCaseBase):
         enrollments = api.enrollments(self.db, uid.uuid)
         self.assertEqual(len(enrollments), 1)
 
+    def test_reset_orphaned_unique_identities(self):
+        """Check if unique identities left without identities are removed on reset"""
+
+        api.add_unique_identity(self.db, 'orphan')
+        api.edit_profile(self.db, 'orphan', name='John Doe')
+        jdoe_id = api.add_identity(self.db, 'scm', email='jdoe@example.org',
+                                   uuid='orphan')
+
+        parser = self.get_parser(datadir('sortinghat_valid.json'))
+
+        code = self.cmd.import_identities(parser, reset=True)
+        self.assertEqual(code, CMD_SUCCESS)
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 3)
+
+        self.assertRaises(NotFoundError, api.unique_identities,
+                          self.db, 'orphan')
+
+        # The identity was moved to its own unique identity
+        uid = api.unique_identities(self.db, jdoe_id)[0]
+        self.assertEqual([i.id for i in uid.identities], [jdoe_id])
+        self.assertEqual(uid.profile.name, None)
+
+        with self.db.connect() as session:
+            self.assertEqual(session.query(Profile).filter(Profile.uuid == 'orphan').count(), 0)
+
     def test_dates_out_of_bounds(self):
         """Check dates when they are out of bounds"""
 
@@ -892,6 +1279,130 @@ class TestLoadIdentities(TestLoadCaseBase):
         self.assertEqual(rol1.start, datetime.datetime(1900, 1, 1, 0, 0))
         self.assertEqual(rol1.end, datetime.datetime(2100, 1, 1, 0, 0))
 
+    def test_load_in_batches(self):
+        """Check if unique identities are loaded when they span several batches"""
+
+        # Jane Roe identities are already stored
+        api.add_identity(self.db, 'unknown', email='jroe@bitergia.com')
+
+        self.patch_cmd('BATCH_SIZE', 1)
+
+        parser = self.get_parser(datadir('sortinghat_valid.json'))
+
+        code = self.cmd.import_identities(parser)
+        self.assertEqual(code, CMD_SUCCESS)
+
+        # Check the contents of the registry
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 2)
+
+        # Jane Roe
+        uid = uids[0]
+        self.assertEqual(uid.uuid, '22d1b20763c6f5822bdda8508957486c547bb9de')
+        self.assertEqual(uid.profile.name, 'Jane Roe')
+        self.assertEqual(uid.profile.country_code, 'US')
+
+        ids = self.sort_identities(uid.identities)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0].id, '17ab00ed3825ec2f50483e33c88df223264182ba')
+        self.assertEqual(ids[1].id, '22d1b20763c6f5822bdda8508957486c547bb9de')
+        self.assertEqual(ids[2].id, '322397ed782a798ffd9d0bc7e293df4292fe075d')
+
+        enrollments = api.enrollments(self.db, uid.uuid)
+        self.assertEqual(len(enrollments), 3)
+
+        # John Smith
+        uid = uids[1]
+        self.assertEqual(uid.uuid, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
+        self.assertEqual(uid.profile.gender, 'male')
+
+        ids = self.sort_identities(uid.identities)
+        self.assertEqual(len(ids), 2)
+
+        enrollments = api.enrollments(self.db, uid.uuid)
+        self.assertEqual(len(enrollments), 1)
+
+        # Bulk writes are also recorded on the change log
+        changes = api.changes(self.db)
+        added = [c.eid for c in changes
+                 if c.entity == 'identity' and c.action == 'add']
+        self.assertEqual(len(added), 5)
+
+        added = [c.eid for c in changes
+                 if c.entity == 'enrollment' and c.action == 'add']
+        self.assertEqual(len(added), 4)
+
+    def test_load_duplicated_identities(self):
+        """Check if unique identities sharing identities are loaded together"""
+
+        parser = self.get_parser(datadir('sortinghat_identities_duplicated.json'))
+
+        with unittest.mock.patch.object(_LoadState, 'merge') as mock_merge:
+            code = self.cmd.import_identities(parser)
+            self.assertEqual(code, CMD_SUCCESS)
+
+            # Nothing was merged on the registry
+            mock_merge.assert_not_called()
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 1)
+
+        uid = uids[0]
+        self.assertEqual(uid.uuid, '19ceda90a616f4e90e0fc51dfc6e25ee44c8b307')
+
+        ids = self.sort_identities(uid.identities)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0].id, '19ceda90a616f4e90e0fc51dfc6e25ee44c8b307')
+        self.assertEqual(ids[0].source, 'mls')
+        self.assertEqual(ids[1].id, '3de180633322e853861f9ee5f50a87e007b51058')
+        self.assertEqual(ids[1].username, None)
+        self.assertEqual(ids[2].id, 'c6d2504fde0e34b78a185c4b709e5442d045451c')
+        self.assertEqual(ids[2].username, 'jdoe')
+
+        self.assertEqual(uid.profile.email, 'jdoe@example.com')
+
+    def test_load_identities_of_skipped_unique_identities(self):
+        """Check if identities shared with a skipped unique identity are loaded"""
+
+        parser = self.get_parser(datadir('sortinghat_identities_skipped.json'))
+
+        code = self.cmd.import_identities(parser)
+        self.assertEqual(code, CMD_SUCCESS)
+
+        uids = api.unique_identities(self.db)
+        self.assertEqual(len(uids), 1)
+
+        uid = uids[0]
+        self.assertEqual(uid.uuid, '5c4e9db16fb76216da8126054c077c5c8cd08b0d')
+
+        ids = self.sort_identities(uid.identities)
+        self.assertEqual(len(ids), 2)
+        self.assertEqual(ids[0].id, '5c4e9db16fb76216da8126054c077c5c8cd08b0d')
+        self.assertEqual(ids[0].source, 'mls')
+        self.assertEqual(ids[1].id, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
+        self.assertEqual(ids[1].source, 'scm')
+
+    def test_organizations_equal_on_collation(self):
+        """Check if organizations the registry considers equal are only added once"""
+
+        parser = self.get_parser(datadir('sortinghat_orgs_collation.json'))
+
+        code = self.cmd.import_identities(parser, verbose=True)
+        self.assertEqual(code, CMD_SUCCESS)
+
+        output = sys.stderr.getvalue().strip()
+        self.assertEqual(output, LOAD_ORGS_COLLATION_WARNING)
+
+        orgs = api.registry(self.db)
+        self.assertEqual(len(orgs), 1)
+        self.assertEqual(orgs[0].name, 'Bitergia')
+
+        enrollments = api.enrollments(self.db, 'a9b403e150dd4af8953a52a4bb841051e4b705d9')
+        self.assertEqual(len(enrollments), 2)
+
+        for rol in enrollments:
+            self.assertEqual(rol.organization.name, 'Bitergia')
+
     def test_invalid_matching_method(self):
         """Check if it fails when an invalid matching method is given"""
 
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import io
+import sys
+import threading
+import unittest
+import unittest.mock
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from sortinghat.command import Command, buffered_output, get_template
+
+
+MERGE_OUTPUT = """Unique identity a merged on b
+Unique identity c merged on d
+"""
+
+MERGE_QUIET_OUTPUT = """1 blacklist entries added
+2 unique identities merged
+"""
+
+
+class MockEntry:
+    excluded = 'x'
+
+
+class MockCommand(Command):
+    """Command that displays the result of some merges"""
+
+    def __init__(self, **kwargs):
+        super(MockCommand, self).__init__(**kwargs)
+        self.written = []
+
+    @buffered_output
+    def merge(self, pairs):
+        for from_uuid, to_uuid in pairs:
+            self.display('merge.tmpl', from_uuid=from_uuid, to_uuid=to_uuid)
+            self.written.append(sys.stdout.getvalue())
+
+    @buffered_output
+    def blacklist_and_merge(self, pairs):
+        self.display('load_blacklist.tmpl', entry=MockEntry())
+        self.merge(pairs)
+
+
+class TestCommand(unittest.TestCase):
+    """Unit tests for Command class"""
+
+    def test_get_template(self):
+        """Check if compiled templates are shared"""
+
+        t = get_template('merge.tmpl')
+        self.assertIs(get_template('merge.tmpl'), t)
+
+    def test_buffered_output(self):
+        """Check if the output is written when the buffered method returns"""
+
+        cmd = MockCommand()
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cmd.merge([('a', 'b'), ('c', 'd')])
+
+            self.assertEqual(cmd.written, ['', ''])
+            self.assertEqual(stdout.getvalue(), MERGE_OUTPUT)
+
+    def test_buffer_size(self):
+        """Check if the output is written when the buffer is full"""
+
+        cmd = MockCommand()
+        cmd.OUTPUT_BUFFER_SIZE = 1
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cmd.merge([('a', 'b'), ('c', 'd')])
+
+            self.assertEqual(cmd.written, MERGE_OUTPUT.splitlines(keepends=True)[0:1] +
+                             [MERGE_OUTPUT])
+            self.assertEqual(stdout.getvalue(), MERGE_OUTPUT)
+
+    def test_flush_on_warning(self):
+        """Check if the output is written before a warning"""
+
+        cmd = MockCommand()
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout, \
+                unittest.mock.patch('sys.stderr', new_callable=io.StringIO):
+            cmd._buffering += 1
+            cmd.display('merge.tmpl', from_uuid='a', to_uuid='b')
+            self.assertEqual(stdout.getvalue(), '')
+
+            cmd.warning('mock warning')
+            self.assertEqual(stdout.getvalue(), MERGE_OUTPUT.splitlines(keepends=True)[0])
+
+    def test_concurrent_output(self):
+        """Check if the output written by several threads is not lost"""
+
+        cmd = MockCommand()
+        cmd.OUTPUT_BUFFER_SIZE = 64
+
+        def write(n):
+            for i in range(500):
+                cmd.write("%s-%s\n" % (n, i))
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cmd._buffering += 1
+
+            threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            cmd.flush()
+            lines = stdout.getvalue().splitlines()
+
+        expected = ["%s-%s" % (n, i) for n in range(4) for i in range(500)]
+        self.assertListEqual(sorted(lines), sorted(expected))
+
+    def test_quiet(self):
+        """Check if a summary is displayed in quiet mode"""
+
+        cmd = MockCommand(quiet=True)
+
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cmd.blacklist_and_merge([('a', 'b'), ('c', 'd')])
+            self.assertEqual(stdout.getvalue(), MERGE_QUIET_OUTPUT)
+
+        # Output not buffered is always displayed
+        with unittest.mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            cmd.display('merge.tmpl', from_uuid='a', to_uuid='b')
+            self.assertEqual(stdout.getvalue(), MERGE_OUTPUT.splitlines(keepends=True)[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,6 +23,9 @@ import datetime
 import unittest
 
 from sortinghat.db import api
+from sortinghat.db.cache import (EntitiesCache,
+                                 enable_entities_cache,
+                                 disable_entities_cache)
 from sortinghat.db.model import (MAX_PERIOD_DATE,
                                  MIN_PERIOD_DATE,
                                  UniqueIdentity,
@@ -220,6 +223,158 @@ class TestFindCountry(TestDBAPICaseBase):
             self.assertEqual(country, None)
 
 
+class TestEntitiesCache(TestDBAPICaseBase):
+    """Unit tests for the entities cache of find functions"""
+
+    def setUp(self):
+        super(TestEntitiesCache, self).setUp()
+        self.cache = enable_entities_cache(max_size=10)
+
+    def tearDown(self):
+        disable_entities_cache()
+        super(TestEntitiesCache, self).tearDown()
+
+    def test_cached_entities(self):
+        """Check if entities are retrieved from the cache"""
+
+        with self.db.connect() as session:
+            api.add_organization(session, 'Example')
+
+        with self.db.connect() as session:
+            org = api.find_organization(session, 'Example')
+            self.assertEqual(org.name, 'Example')
+
+        self.assertDictEqual(self.cache.stats(),
+                             {'size': 1, 'hits': 0, 'misses': 1})
+
+        with self.db.connect() as session:
+            org = api.find_organization(session, 'Example')
+            self.assertIsInstance(org, Organization)
+            self.assertEqual(org.name, 'Example')
+
+            # Cached entities can be used on the session
+            uidentity = api.add_unique_identity(session, 'John Smith')
+            api.enroll(session, uidentity, org)
+
+        self.assertDictEqual(self.cache.stats(),
+                             {'size': 1, 'hits': 1, 'misses': 1})
+
+        with self.db.connect() as session:
+            enrollments = session.query(Enrollment).all()
+            self.assertEqual(len(enrollments), 1)
+            self.assertEqual(enrollments[0].organization.name, 'Example')
+
+    def test_not_found_entities(self):
+        """Check if not found entities are not cached"""
+
+        with self.db.connect() as session:
+            org = api.find_organization(session, 'Example')
+            self.assertIsNone(org)
+
+            api.add_organization(session, 'Example')
+
+        with self.db.connect() as session:
+            org = api.find_organization(session, 'Example')
+            self.assertEqual(org.name, 'Example')
+
+        self.assertDictEqual(self.cache.stats(),
+                             {'size': 1, 'hits': 0, 'misses': 2})
+
+    def test_rollback(self):
+        """Check if entities are not cached when the transaction fails"""
+
+        session = self.db._Session()
+        api.add_organization(session, 'Example')
+        api.find_organization(session, 'Example')
+        session.rollback()
+        session.close()
+
+        self.assertEqual(len(self.cache), 0)
+
+        with self.db.connect() as session:
+            org = api.find_organization(session, 'Example')
+            self.assertIsNone(org)
+
+    def test_invalidate_on_update(self):
+        """Check if modified entities are removed from the cache"""
+
+        with self.db.connect() as session:
+            uidentity = api.add_unique_identity(session, 'John Smith')
+            api.add_unique_identity(session, 'John Doe')
+            api.add_identity(session, uidentity, 'A', 'scm', name='John Smith')
+
+        with self.db.connect() as session:
+            identity = api.find_identity(session, 'A')
+            self.assertEqual(identity.uuid, 'John Smith')
+
+        self.assertEqual(len(self.cache), 1)
+
+        with self.db.connect() as session:
+            identity = api.find_identity(session, 'A')
+            uidentity = api.find_unique_identity(session, 'John Doe')
+            api.move_identity(session, identity, uidentity)
+
+        with self.db.connect() as session:
+            identity = api.find_identity(session, 'A')
+            self.assertEqual(identity.uuid, 'John Doe')
+
+    def test_invalidate_on_delete(self):
+        """Check if the cache is cleared when an entity is deleted"""
+
+        with self.db.connect() as session:
+            org = api.add_organization(session, 'Example')
+            api.add_domain(session, org, 'example.com')
+
+        with self.db.connect() as session:
+            api.find_organization(session, 'Example')
+            api.find_domain(session, 'example.com')
+
+        self.assertEqual(len(self.cache), 2)
+
+        with self.db.connect() as session:
+            org = api.find_organization(session, 'Example')
+            api.delete_organization(session, org)
+
+        self.assertEqual(len(self.cache), 0)
+
+        with self.db.connect() as session:
+            self.assertIsNone(api.find_organization(session, 'Example'))
+            self.assertIsNone(api.find_domain(session, 'example.com'))
+
+    def test_lru(self):
+        """Check if the least recently used entries are removed first"""
+
+        cache = EntitiesCache(max_size=2)
+        cache.put('a', 1, {'id': 1}, 0)
+        cache.put('b', 2, {'id': 2}, 0)
+
+        self.assertDictEqual(cache.get('a'), {'id': 1})
+
+        cache.put('c', 3, {'id': 3}, 0)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertDictEqual(cache.get('a'), {'id': 1})
+        self.assertDictEqual(cache.get('c'), {'id': 3})
+        self.assertDictEqual(cache.stats(),
+                             {'size': 2, 'hits': 3, 'misses': 1})
+
+    def test_outdated_generation(self):
+        """Check if values read before an invalidation are not stored"""
+
+        cache = EntitiesCache()
+        generation = cache.generation
+        cache.invalidate(Organization, 1)
+        cache.put('a', 1, {'id': 1}, generation)
+
+        self.assertEqual(len(cache), 0)
+
+    def test_invalid_max_size(self):
+        """Check if it fails when the size is not valid"""
+
+        self.assertRaises(ValueError, EntitiesCache, max_size=0)
+
+
 class TestAddUniqueIdentity(TestDBAPICaseBase):
     """Unit tests for add_unique_identity"""
 
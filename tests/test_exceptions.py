@@ -20,6 +20,7 @@
 #     Santiago Dueñas <sduenas@bitergia.com>
 #
 
+import pickle
 import sys
 import unittest
 
@@ -67,6 +68,24 @@ class TestBaseError(unittest.TestCase):
         kwargs = {'code': 1, 'error': 'Fatal error'}
         self.assertRaises(KeyError, MockErrorArgs, **kwargs)
 
+    def test_pickle(self):
+        """Check if errors can be pickled and unpickled"""
+
+        e = MockErrorArgs(code=1, msg='Fatal error')
+        e = pickle.loads(pickle.dumps(e))
+
+        self.assertIsInstance(e, MockErrorArgs)
+        self.assertEqual("Mock error with args. Error: 1 Fatal error",
+                         str(e))
+
+        e = AlreadyExistsError(entity='Domain', eid='example.com')
+        e = pickle.loads(pickle.dumps(e))
+
+        self.assertEqual(e.entity, 'Domain')
+        self.assertEqual(e.eid, 'example.com')
+        self.assertEqual(str(e),
+                         "Domain 'example.com' already exists in the registry")
+
 
 class TestAlreadyExistsError(unittest.TestCase):
 
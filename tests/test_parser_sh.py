@@ -21,15 +21,18 @@
 #
 
 import datetime
+import io
+import json
 import sys
 import unittest
+import unittest.mock
 
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 
 from sortinghat.db.model import UniqueIdentity, Organization, Domain, MatchingBlacklist
 from sortinghat.exceptions import InvalidFormatError
-from sortinghat.parsing.sh import SortingHatParser
+from sortinghat.parsing.sh import JSONStreamReader, SortingHatParser, SortingHatStreamParser
 
 from tests.base import TestCommandCaseBase, datadir
 
@@ -373,5 +376,213 @@ class TestSortingHatParser(TestBaseCase):
             SortingHatParser(None)
 
 
+class TestSortingHatStreamParser(TestBaseCase):
+    """Test SortingHat stream parser with some inputs"""
+
+    def open_file(self, filename):
+        return open(filename, 'r', encoding='UTF-8')
+
+    def test_same_as_parser(self):
+        """Check whether it returns the same data than SortingHatParser"""
+
+        for filename in ('sortinghat_valid.json', 'sortinghat_orgs_valid.json',
+                         'sortinghat_identities_profiles.json'):
+            expected = SortingHatParser(self.read_file(datadir(filename)))
+
+            with self.open_file(datadir(filename)) as fd:
+                parser = SortingHatStreamParser(fd)
+
+                uids = list(parser.identities)
+                self.assertEqual([uid.uuid for uid in uids],
+                                 [uid.uuid for uid in expected.identities])
+
+                for uid, exp in zip(uids, expected.identities):
+                    self.assertEqual([i.id for i in uid.identities],
+                                     [i.id for i in exp.identities])
+                    self.assertEqual([(e.organization.name, e.start, e.end) for e in uid.enrollments],
+                                     [(e.organization.name, e.start, e.end) for e in exp.enrollments])
+
+                orgs = parser.organizations
+                self.assertEqual([org.name for org in orgs],
+                                 [org.name for org in expected.organizations])
+
+                for org, exp in zip(orgs, expected.organizations):
+                    self.assertEqual([(d.domain, d.is_top_domain) for d in org.domains],
+                                     [(d.domain, d.is_top_domain) for d in exp.domains])
+
+                bl = parser.blacklist
+                self.assertEqual([b.excluded for b in bl],
+                                 [b.excluded for b in expected.blacklist])
+
+    def test_identities_generator(self):
+        """Check whether identities are read one at a time"""
+
+        with self.open_file(datadir('sortinghat_valid.json')) as fd:
+            parser = SortingHatStreamParser(fd)
+            uids = parser.identities
+
+            uid = next(uids)
+            self.assertIsInstance(uid, UniqueIdentity)
+            self.assertEqual(uid.uuid, '0000000000000000000000000000000000000000')
+
+            uid = next(uids)
+            self.assertEqual(uid.uuid, '03e12d00e37fd45593c49a5a5a1652deca4cf302')
+
+    def read_all(self, parser):
+        """Read the data of a parser in the order 'load' does"""
+
+        return parser.blacklist, parser.organizations, list(parser.identities)
+
+    def test_not_valid_stream(self):
+        """Check whether it raises the same errors than SortingHatParser"""
+
+        files = (('sortinghat_invalid.json', SH_INVALID_JSON_FORMAT_ERROR),
+                 ('sortinghat_blacklist_empty_strings.json', SH_BL_EMPTY_STRING_ERROR),
+                 ('sortinghat_ids_missing_keys.json', SH_IDS_MISSING_KEYS_ERROR),
+                 ('sortinghat_orgs_missing_keys.json', SH_ORGS_MISSING_KEYS_ERROR),
+                 ('sortinghat_ids_invalid_date.json', SH_IDS_DATETIME_ERROR),
+                 ('sortinghat_ids_invalid_is_bot.json', SH_IDS_IS_BOT_ERROR),
+                 ('sortinghat_ids_invalid_type_gender_acc.json', SH_IDS_GENDER_ACC_TYPE_ERROR),
+                 ('sortinghat_ids_invalid_range_gender_acc.json', SH_IDS_GENDER_ACC_RANGE_ERROR),
+                 ('sortinghat_orgs_invalid_top.json', SH_ORGS_IS_TOP_ERROR))
+
+        for filename, error in files:
+            with self.assertRaisesRegex(InvalidFormatError, error):
+                with self.open_file(datadir(filename)) as fd:
+                    self.read_all(SortingHatStreamParser(fd))
+
+        content = '{"blacklist": [], "organizations": {} "uidentities": {}}'
+
+        with self.assertRaisesRegex(InvalidFormatError, SH_INVALID_JSON_FORMAT_ERROR):
+            self.read_all(SortingHatStreamParser(io.StringIO(content)))
+
+    def test_fingerprint_and_progress(self):
+        """Check the fingerprint and the progress of the stream"""
+
+        expected = SortingHatParser(self.read_file(datadir('sortinghat_valid.json')))
+
+        with self.open_file(datadir('sortinghat_valid.json')) as fd:
+            parser = SortingHatStreamParser(fd)
+            self.assertEqual(parser.fingerprint, expected.fingerprint)
+
+            uids = parser.identities
+            next(uids)
+            self.assertGreater(parser.progress, 0.0)
+            self.assertLessEqual(parser.progress, 1.0)
+
+            # Reading the fingerprint does not alter the stream
+            self.assertEqual(parser.fingerprint, expected.fingerprint)
+            uid = next(uids)
+            self.assertEqual(uid.uuid, '03e12d00e37fd45593c49a5a5a1652deca4cf302')
+
+            list(uids)
+            self.assertEqual(parser.progress, 1.0)
+
+        with self.open_file(datadir('sortinghat_orgs_valid.json')) as fd:
+            parser = SortingHatStreamParser(fd)
+            self.assertNotEqual(parser.fingerprint, expected.fingerprint)
+
+    def test_single_pass(self):
+        """Check whether the stream is read only once"""
+
+        content = self.read_file(datadir('sortinghat_valid.json'))
+        expected = SortingHatParser(content)
+
+        fd = io.StringIO(content)
+        parser = SortingHatStreamParser(fd)
+
+        with unittest.mock.patch.object(fd, 'seek', wraps=fd.seek) as seek:
+            bl, orgs, uids = self.read_all(parser)
+
+        seek.assert_not_called()
+        self.assertEqual([b.excluded for b in bl],
+                         [b.excluded for b in expected.blacklist])
+        self.assertEqual([org.name for org in orgs],
+                         sorted(json.loads(content)['organizations']))
+        self.assertEqual([uid.uuid for uid in uids],
+                         [uid.uuid for uid in expected.identities])
+        self.assertEqual(parser.progress, 1.0)
+
+    def test_sections_order(self):
+        """Check whether sections are read in any order"""
+
+        content = '{"uidentities": {"A": {"uuid": "A", "profile": null, "identities": [], "enrollments": []}}, ' \
+                  '"blacklist": ["root"], "organizations": {"Example": []}}'
+
+        parser = SortingHatStreamParser(io.StringIO(content))
+        bl, orgs, uids = self.read_all(parser)
+
+        self.assertEqual([b.excluded for b in bl], ['root'])
+        self.assertEqual([org.name for org in orgs], ['Example'])
+        self.assertEqual([uid.uuid for uid in uids], ['A'])
+
+    def test_json_errors(self):
+        """Check whether JSON errors are located on the whole stream"""
+
+        content = self.read_file(datadir('sortinghat_invalid.json'))
+
+        import json
+        with self.assertRaises(ValueError) as cm:
+            json.loads(content)
+
+        expected = "invalid json format. %s" % str(cm.exception)
+
+        with self.assertRaises(InvalidFormatError) as cm:
+            reader = JSONStreamReader(io.StringIO(content), chunk_size=16)
+            reader.skip_value()
+
+        self.assertEqual(str(cm.exception), expected)
+
+    def test_missing_section(self):
+        """Check whether it fails when a section is not found"""
+
+        with self.assertRaisesRegex(InvalidFormatError, "Attribute blacklist not found"):
+            parser = SortingHatStreamParser(io.StringIO('{"uidentities": {}, "organizations": {}}'))
+            self.read_all(parser)
+
+    def test_empty_stream(self):
+        """Check whether it raises an exception when the stream is empty"""
+
+        with self.assertRaisesRegex(InvalidFormatError,
+                                    ORGS_STREAM_INVALID_ERROR):
+            SortingHatStreamParser(io.StringIO(''))
+
+
+class TestJSONStreamReader(unittest.TestCase):
+    """Unit tests for JSONStreamReader"""
+
+    def test_iterate(self):
+        """Check whether it reads nested values using small chunks"""
+
+        content = '{"a": [1, "x\\"y", {"b": null}], "c": {"d": 12.5e3}, "e": true}'
+
+        reader = JSONStreamReader(io.StringIO(content), chunk_size=3)
+        result = {}
+
+        for key in reader.iter_object():
+            if key == 'a':
+                result[key] = []
+                for _ in reader.iter_array():
+                    result[key].append(reader.read_value())
+            elif key == 'c':
+                reader.skip_value()
+            else:
+                result[key] = reader.read_value()
+
+        reader.expect_end()
+
+        self.assertDictEqual(result, {'a': [1, 'x"y', {'b': None}], 'e': True})
+
+    def test_extra_data(self):
+        """Check whether it fails when there is data after the document"""
+
+        reader = JSONStreamReader(io.StringIO('{} {}'))
+        reader.skip_value()
+
+        with self.assertRaisesRegex(InvalidFormatError,
+                                    r"Extra data: line 1 column 4 \(char 3\)"):
+            reader.expect_end()
+
+
 if __name__ == "__main__":
     unittest.main(buffer=True, exit=False)
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2014-2019 Bitergia
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Santiago Dueñas <sduenas@bitergia.com>
+#
+
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+if '..' not in sys.path:
+    sys.path.insert(0, '..')
+
+from sortinghat import api
+from sortinghat.profiler import QueryProfiler, find_caller
+
+from tests.base import TestDatabaseCaseBase
+
+
+class TestQueryProfiler(TestDatabaseCaseBase):
+    """Unit tests for QueryProfiler"""
+
+    def load_test_dataset(self):
+        pass
+
+    def test_profile(self):
+        """Check if statements are attributed to the API functions"""
+
+        with QueryProfiler(command='test') as profiler:
+            api.add_organization(self.db, 'Example')
+            api.add_domain(self.db, 'Example', 'example.com')
+            api.registry(self.db)
+
+        # Statements run after stopping are not profiled
+        api.registry(self.db)
+
+        summary = profiler.summary()
+        self.assertEqual(summary['command'], 'test')
+        self.assertGreater(summary['elapsed'], 0)
+
+        functions = {f['function']: f for f in summary['functions']}
+        self.assertListEqual(sorted(functions.keys()),
+                             ['api.add_domain', 'api.add_organization',
+                              'api.registry'])
+
+        # Organizations and their domains are read with two statements
+        self.assertEqual(functions['api.registry']['statements'], 2)
+
+        self.assertEqual(summary['statements'],
+                         sum(f['statements'] for f in summary['functions']))
+        self.assertLessEqual(len(summary['slowest']), 10)
+
+        for query in summary['slowest']:
+            self.assertIn(query['function'], functions)
+
+    def test_report(self):
+        """Check if it writes a summary table"""
+
+        with QueryProfiler(command='test') as profiler:
+            api.add_organization(self.db, 'Example')
+
+        output = io.StringIO()
+        profiler.report(output)
+
+        lines = output.getvalue().split('\n')
+        self.assertEqual(lines[0], "Profile of 'test' command")
+        self.assertTrue(lines[1].startswith('function'))
+        self.assertTrue(lines[2].startswith('api.add_organization'))
+        self.assertTrue(lines[3].startswith('total'))
+
+    def test_dump(self):
+        """Check if it writes the statistics to a JSON file"""
+
+        with QueryProfiler(command='test') as profiler:
+            api.registry(self.db)
+
+        tmpfile = tempfile.mkstemp()[1]
+
+        try:
+            profiler.dump(tmpfile)
+
+            with open(tmpfile, 'r') as f:
+                obj = json.load(f)
+        finally:
+            os.remove(tmpfile)
+
+        self.assertEqual(obj['command'], 'test')
+        self.assertEqual(obj['functions'][0]['function'], 'api.registry')
+
+    def test_unknown_caller(self):
+        """Check if it returns an unknown caller outside the API and commands"""
+
+        self.assertEqual(find_caller(), '<unknown>')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -23,13 +23,17 @@
 import datetime
 import sys
 import unittest
+import unittest.mock
+
+import dateutil.parser
 
 if '..' not in sys.path:
     sys.path.insert(0, '..')
 
 from sortinghat.exceptions import InvalidDateError
-from sortinghat.utils import merge_date_ranges, str_to_datetime, \
-    to_unicode, uuid
+from sortinghat.utils import DomainTrie, IntervalIndex, merge_date_ranges, \
+    is_trigram_indexable, str_to_datetime, to_unicode, trigrams, uuid, \
+    _parse_datetime
 
 DATE_OUT_OF_BOUNDS_ERROR = "%(type)s %(date)s is out of bounds"
 SOURCE_NONE_OR_EMPTY_ERROR = "source cannot be"
@@ -183,11 +187,76 @@ class TestStrToDatetime(unittest.TestCase):
         self.assertIsInstance(date, datetime.datetime)
         self.assertEqual(date, datetime.datetime(2001, 12, 1, 23, 15, 32))
 
+    def test_iso_dates(self):
+        """Check if it converts ISO dates like the generic parser does"""
+
+        dates = ['1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                 '2001-12-01T23:15:32', '2001-12-01 23:15:32',
+                 '2001-12-01', '2001-12-01T23:15:32+02:00',
+                 '2001-12-01T23:15:32.500000', '20011201']
+
+        for ts in dates:
+            expected = dateutil.parser.parse(ts).replace(tzinfo=None)
+
+            date = str_to_datetime(ts)
+            self.assertIsInstance(date, datetime.datetime)
+            self.assertEqual(date, expected)
+            self.assertIsNone(date.tzinfo)
+
+            # Parsed dates are memoized
+            self.assertIs(str_to_datetime(ts), date)
+
+    def test_iso_dates_fast_path(self):
+        """Check if ISO dates without offsets or fractions skip the generic parser"""
+
+        dates = [('2001-12-01', datetime.datetime(2001, 12, 1)),
+                 ('2001-12-01T23:15:32', datetime.datetime(2001, 12, 1, 23, 15, 32)),
+                 ('2001-12-01 23:15:32', datetime.datetime(2001, 12, 1, 23, 15, 32))]
+
+        _parse_datetime.cache_clear()
+
+        with unittest.mock.patch('dateutil.parser.parse',
+                                 wraps=dateutil.parser.parse) as mock_parse:
+            for ts, expected in dates:
+                date = str_to_datetime(ts)
+                self.assertEqual(date, expected)
+                self.assertIsNone(date.tzinfo)
+
+            mock_parse.assert_not_called()
+
+    def test_iso_dates_fallback(self):
+        """Check if dates with offsets or fractions are parsed by the generic parser"""
+
+        dates = [('2001-12-01T23:15:32+02:00', datetime.datetime(2001, 12, 1, 23, 15, 32)),
+                 ('2001-12-01T23:15:32-05:30', datetime.datetime(2001, 12, 1, 23, 15, 32)),
+                 ('2001-12-01T23:15:32Z', datetime.datetime(2001, 12, 1, 23, 15, 32)),
+                 ('2001-12-01T23:15:32.500000', datetime.datetime(2001, 12, 1, 23, 15, 32, 500000)),
+                 ('2001-12-01T23:15:32.123+02:00', datetime.datetime(2001, 12, 1, 23, 15, 32, 123000))]
+
+        _parse_datetime.cache_clear()
+
+        with unittest.mock.patch('dateutil.parser.parse',
+                                 wraps=dateutil.parser.parse) as mock_parse:
+            for ts, expected in dates:
+                date = str_to_datetime(ts)
+                self.assertEqual(date, expected)
+
+                # Offsets are discarded, not applied
+                self.assertIsNone(date.tzinfo)
+
+            self.assertEqual(mock_parse.call_count, len(dates))
+
+            # Dates with the fast path shape that strptime rejects
+            # are given to the generic parser, which fails too
+            self.assertRaises(InvalidDateError, str_to_datetime, '2001-02-29')
+            self.assertEqual(mock_parse.call_count, len(dates) + 1)
+
     def test_invalid_date(self):
         """Check whether it fails with an invalid date"""
 
         self.assertRaises(InvalidDateError, str_to_datetime, '2001-13-01')
         self.assertRaises(InvalidDateError, str_to_datetime, '2001-04-31')
+        self.assertRaises(InvalidDateError, str_to_datetime, '2001-04-31T00:00:00')
 
     def test_invalid_format(self):
         """Check whether it fails with invalid formats"""
@@ -239,6 +308,136 @@ class TestToUnicode(unittest.TestCase):
         self.assertEqual(result, '1234')
 
 
+class TestTrigrams(unittest.TestCase):
+    """Unit tests for trigrams function"""
+
+    def test_trigrams(self):
+        """Check if it splits a string into its set of trigrams"""
+
+        result = trigrams('jsmith')
+        self.assertSetEqual(result, {b'jsm', b'smi', b'mit', b'ith'})
+
+        result = trigrams('aaaa')
+        self.assertSetEqual(result, {b'aaa'})
+
+    def test_normalized_trigrams(self):
+        """Check if trigrams are calculated over the lower case and unaccent string"""
+
+        result = trigrams('JÖHN')
+        self.assertSetEqual(result, {b'joh', b'ohn'})
+
+        result = trigrams('😂😂😂')
+        self.assertSetEqual(result, {'😂😂😂'.encode('utf-8')})
+
+    def test_collation_folds(self):
+        """Check if letters equal to others on the collation are folded"""
+
+        result = trigrams('Straße')
+        self.assertSetEqual(result, trigrams('strasse'))
+
+        result = trigrams('ﬁnæl')
+        self.assertSetEqual(result, {b'fin', b'ina', b'nae', b'ael'})
+
+    def test_indexable(self):
+        """Check which strings can be matched using their trigrams"""
+
+        self.assertTrue(is_trigram_indexable('jsmith@example.com'))
+        self.assertTrue(is_trigram_indexable('Jöhn Straße'))
+        self.assertTrue(is_trigram_indexable(''))
+        self.assertTrue(is_trigram_indexable(None))
+        self.assertTrue(is_trigram_indexable('Łukasz'))
+        self.assertFalse(is_trigram_indexable('Þórr'))
+        self.assertFalse(is_trigram_indexable('john\u00adsmith'))
+        self.assertFalse(is_trigram_indexable('😂😂😂'))
+
+    def test_short_strings(self):
+        """Check if it returns an empty set when the string is too short"""
+
+        self.assertSetEqual(trigrams('ab'), set())
+        self.assertSetEqual(trigrams(''), set())
+        self.assertSetEqual(trigrams(None), set())
+
+
+class TestIntervalIndex(unittest.TestCase):
+    """Unit tests for IntervalIndex class"""
+
+    def test_find(self):
+        """Check if it finds the interval that contains a point"""
+
+        index = IntervalIndex([(10, 20, 'b'), (1, 5, 'a'), (15, 30, 'c')])
+        self.assertEqual(len(index), 3)
+
+        self.assertEqual(index.find(1), 'a')
+        self.assertEqual(index.find(5), 'a')
+        self.assertEqual(index.find(12), 'b')
+        self.assertEqual(index.find(30), 'c')
+
+        # When several intervals match, the latest start wins
+        self.assertEqual(index.find(17), 'c')
+
+    def test_not_found(self):
+        """Check if it returns None when no interval contains the point"""
+
+        index = IntervalIndex([(1, 5, 'a'), (10, 20, 'b')])
+
+        self.assertIsNone(index.find(0))
+        self.assertIsNone(index.find(7))
+        self.assertIsNone(index.find(21))
+
+        index = IntervalIndex()
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.find(1))
+
+
+class TestDomainTrie(unittest.TestCase):
+    """Unit tests for DomainTrie class"""
+
+    def test_matches(self):
+        """Check if it finds the domains which are suffixes of a domain"""
+
+        trie = DomainTrie(['example.com', 'u.example.com', 'bitergia.com'])
+        self.assertEqual(len(trie), 3)
+
+        result = trie.matches('us.u.example.com')
+        self.assertListEqual(result, ['u.example.com', 'example.com'])
+
+        result = trie.matches('u.example.com')
+        self.assertListEqual(result, ['u.example.com', 'example.com'])
+
+        result = trie.matches('bitergia.com')
+        self.assertListEqual(result, ['bitergia.com'])
+
+    def test_no_matches(self):
+        """Check if it does not match domains sharing only some characters"""
+
+        trie = DomainTrie(['example.com'])
+
+        self.assertListEqual(trie.matches('myexample.com'), [])
+        self.assertListEqual(trie.matches('example.org'), [])
+        self.assertListEqual(trie.matches('com'), [])
+        self.assertIsNone(trie.longest_match('myexample.com'))
+
+    def test_longest_match(self):
+        """Check if it returns the longest match"""
+
+        trie = DomainTrie()
+        trie.add('example.com')
+        trie.add('u.example.com')
+        trie.add('u.example.com')
+        self.assertEqual(len(trie), 2)
+
+        self.assertEqual(trie.longest_match('es.u.example.com'), 'u.example.com')
+        self.assertEqual(trie.longest_match('es.example.com'), 'example.com')
+
+    def test_case_insensitive(self):
+        """Check if domains are case insensitive"""
+
+        trie = DomainTrie(['Example.com'])
+
+        self.assertListEqual(trie.matches('mail.EXAMPLE.com'), ['Example.com'])
+        self.assertListEqual(trie.matches('.example.com'), ['Example.com'])
+
+
 class TestUUID(unittest.TestCase):
     """Unit tests for uuid function"""
 